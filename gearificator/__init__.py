@@ -20,5 +20,3 @@ lgr = get_logger()
 lgr.setLevel(logging.INFO)
 FORMAT = '%(asctime)-15s [%(levelname)8s] %(message)s'
 logging.basicConfig(format=FORMAT)
-
-from nipype.interfaces.ants.registration import ANTS
\ No newline at end of file
@@ -31,6 +31,7 @@ import nipype
 import re
 from collections import OrderedDict
 from nipype.interfaces.base import traits
+from six import string_types
 
 from . import nipype_handlers
 
@@ -185,6 +186,52 @@ def get_trait_handler(trait):
     return handler, handler_name
 
 
+def get_fingerprint_data(cls):
+    """Describe input/output specs of the interface for its gear fingerprint
+
+    Only JSON-serializable, and stable across the sessions, information is
+    returned so it could be used to decide if the gear needs to be
+    regenerated
+    """
+    return OrderedDict(
+        (spec_name, [
+            (opt, describe_trait(trait))
+            for opt, trait in sorted(getattr(cls, spec_name)().items())
+        ])
+        for spec_name in ('input_spec', 'output_spec')
+    )
+
+
+def describe_trait(trait):
+    """Return a JSON-serializable description of the trait"""
+    handler = trait.handler
+    rec = OrderedDict()
+    rec['type'] = trait.trait_type.__class__.__name__
+    rec['default'] = _jsonable(trait.default)
+    rec['default_kind'] = trait.default_kind
+    rec['metadata'] = _jsonable(getattr(handler, '_metadata', {}))
+    for attr in 'values', '_low', '_high':
+        if hasattr(handler, attr):
+            rec[attr] = _jsonable(getattr(handler, attr))
+    inner_traits = getattr(trait, 'inner_traits', None)
+    if inner_traits:
+        rec['inner'] = [describe_trait(t) for t in inner_traits]
+    return rec
+
+
+def _jsonable(v):
+    """Convert v into something JSON-serializable and free of object ids"""
+    if v is None or isinstance(v, (bool, int, float) + string_types):
+        return v
+    if isinstance(v, (list, tuple, set, frozenset)):
+        return [_jsonable(i) for i in v]
+    if isinstance(v, dict):
+        return OrderedDict(
+            (str(k), _jsonable(v[k])) for k in sorted(v, key=str))
+    # some object (e.g. 'parent' trait) -- only its type is stable
+    return '<%s>' % v.__class__.__name__
+
+
 def extract_manifest(cls, defaults={}):
     """
 
@@ -248,45 +295,39 @@ def extract_manifest(cls, defaults={}):
     return manifest, outputs
 
 
-def get_suite(obj, docker_image=None):
+# Debian packages providing tools for the interfaces, if package is not
+# named after the nipype.interfaces submodule
+SUITE_PACKAGES = {
+    'fsl': 'fsl-core',
+    'dcm2nii': 'dcm2niix',
+}
+
+
+def get_suite(obj, docker_image=None, deb_packages=(), group=None):
     """Given the object deduce the "suite" for the Flywheel spec for groupping
+
+    Versions of deb_packages are queried along with the one for the suite,
+    so they all get cached for the docker_image (and the group of images it
+    belongs to, see gear.get_pkg_versions)
     """
     names = obj.__module__.split('.')
     assert names[0] == 'nipype'
     assert names[1] == 'interfaces'
 
     suite = "%s" % names[2].upper()
-    from ..gear import subprocess_call
-    cmd2pkg = {
-        'fsl': 'fsl-core', 'dcm2nii': 'dcm2niix',
-    }.get(names[2].lower(), names[2].lower())
-    if docker_image:
-        # TODO: add a check if docker image exists already
-        # and if not -- add "unknown" as the version
-        qcmd = ['docker', 'run', '--rm', '--entrypoint=dpkg', docker_image]
+    from ..gear import get_pkg_versions
+    pkg = SUITE_PACKAGES.get(names[2].lower(), names[2].lower())
+    versions = get_pkg_versions(
+        docker_image, [pkg] + list(deb_packages), group=group)
+    version = versions.get(pkg)
+    if version:
+        suite += " %s" % version.split(':', 1)[-1].split('.')[0]
     else:
-        qcmd = ['dpkg']
-    dpkg_output, err = subprocess_call(qcmd + ['-l', cmd2pkg])
-    suite += " %s" \
-             % get_pkg_version(dpkg_output).split(':', 1)[-1].split('.')[0]
+        # image might not be built yet or package is not installed
+        suite += " unknown"
     return suite
 
 
-def get_pkg_version(dpkg_output):
-    hits = [l for l in dpkg_output.splitlines() if l.startswith('ii ')]
-    assert len(hits) == 1
-    return hits[0].split()[2]
-
-
-def test_get_pkg_version():
-    assert get_pkg_version("""Desired=U
-||/ Name           Version        Architecture Description
-+++-==============-==============-============-=========================================
-ii  fsl-core       5.0.9-4~nd90+1 all          metapackage for the latest version of FSL
-    """) == "5.0.9-4~nd90+1"
-    assert get_pkg_version("ii  fsl-core       1:6.0.9-4") == "1:6.0.9-4"
-
-
 def test_get_suite():
     # temp one
     from nipype.interfaces.fsl.preprocess import ApplyWarp
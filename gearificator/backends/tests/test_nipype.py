@@ -4,7 +4,7 @@ from os.path import join as opj
 from pprint import pprint
 
 from gearificator.run import load_interface_from_manifest
-from gearificator.gear import create_gear
+from gearificator.gear import create_gear, get_gear_fingerprint
 from gearificator.utils import chpwd
 
 from pytest import fixture
@@ -194,3 +194,15 @@ def test_fsl_bet(geardir):
         assert "undefined" not in cmdline
         assert cmdline == "bet %s %s -s" \
                % (config['in_file'], opj(geardir.outputs, "fixed_brain.nii.gz"))
+
+
+def test_gear_fingerprint():
+    from nipype.interfaces.fsl.preprocess import BET, FAST
+    from gearificator.backends import nipype as backend
+    fp = get_gear_fingerprint(BET, backend, defaults={'output_type': 'NIFTI'})
+    assert fp == get_gear_fingerprint(
+        BET, backend, defaults={'output_type': 'NIFTI'})
+    assert fp != get_gear_fingerprint(
+        BET, backend, defaults={'output_type': 'NIFTI_GZ'})
+    assert fp != get_gear_fingerprint(
+        FAST, backend, defaults={'output_type': 'NIFTI'})
@@ -9,3 +9,4 @@ from .cli_base import cli
 # individual commands are defined and bound within those files
 from . import spec
 from . import spec_tests
+from . import validator
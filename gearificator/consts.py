@@ -35,7 +35,23 @@ DOCKER_IMAGE_REPO = "gearificator"
 GEAR_MANIFEST_FILENAME = "manifest.json"
 GEAR_RUN_FILENAME = "run"
 GEAR_CONFIG_FILENAME = "config.json"
+# Runtime plan, precompiled from the manifest while creating the gear.
+# The version must be bumped whenever the schema of the plan changes
+GEAR_PLAN_FILENAME = "plan.json"
+GEAR_PLAN_VERSION = 2
+# Environment variable pointing to the directory to cache results of the
+# interface runs in (see run.ResultsCache)
+RESULTS_CACHE_ENVVAR = "GEARIFICATOR_RESULTS_CACHE"
+# Where the results cache gets mounted into the gear containers ran in tests
+RESULTS_CACHE_MOUNT = "/cache"
+# Stored alongside the generated gear to decide if it needs regeneration
+GEAR_FINGERPRINT_FILENAME = ".gearificator-fingerprint.json"
+# Label of the gear docker image with the digest of its build context
+DOCKER_CONTEXT_DIGEST_LABEL = "gearificator.context-digest"
 
 GEAR_FLYWHEEL_DIR = "/flywheel/v0"
+# Resources used by the run, stored in the output directory
+GEAR_METRICS_FILENAME = ".gearificator-metrics.json"
+GEAR_METRICS_VERSION = 2
 GEAR_INPUTS_DIR = "input"
 GEAR_OUTPUT_DIR = "output"
\ No newline at end of file
@@ -0,0 +1,240 @@
+#emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 noet:
+"""Asynchronous execution of external commands
+
+All external commands (docker build/push/run, fw gear upload, ...) are ran
+as asyncio subprocesses within an event loop running in a dedicated thread.
+Commands are assigned to "lanes" (build, push, test, ...), each of which has
+its own limit on the number of commands running at once, so e.g. pushes of
+some gears could proceed while others are still being built.
+
+Every process has its own engine (see `get_engine`), so the limits are per
+process and not shared among e.g. the worker processes.
+
+Outputs of the commands are streamed into log files as they come, and only
+a bounded tail of them is kept in memory.
+"""
+
+import asyncio
+import os
+import os.path as op
+import shutil
+import signal
+import tempfile
+import threading
+
+from six import string_types
+
+from . import get_logger
+from .exceptions import CommandError, CommandTimeout
+
+lgr = get_logger('engine')
+
+# Maximal number of commands to be ran at once within a lane
+LANE_LIMITS = {
+    'build': 2,
+    'push': 8,
+    'upload': 4,
+    'test': 4,
+    'query': 8,
+}
+# For any lane not listed in LANE_LIMITS
+DEFAULT_LANE_LIMIT = 4
+# How much of the stdout/stderr (in bytes) to keep in memory
+TAIL_SIZE = 64 * 1024
+# Seconds to wait for a terminated (upon timeout) command to exit before it
+# gets killed
+KILL_GRACE = 10
+_READ_SIZE = 64 * 1024
+
+
+class CommandEngine(object):
+    """Runs commands within an asyncio event loop in a separate thread
+
+    Coroutines (e.g. run) could be scheduled into the loop via submit, which
+    returns concurrent.futures.Future, or blocking call could be used from
+    any other thread.
+    """
+
+    def __init__(self, lane_limits=None):
+        self.lane_limits = dict(LANE_LIMITS, **(lane_limits or {}))
+        self._semaphores = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='gearificator-engine')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the loop (and its thread)"""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _get_semaphore(self, lane):
+        # must be called only from within the loop
+        if lane not in self._semaphores:
+            self._semaphores[lane] = asyncio.Semaphore(
+                self.lane_limits.get(lane, DEFAULT_LANE_LIMIT))
+        return self._semaphores[lane]
+
+    def submit(self, coro):
+        """Schedule coroutine into the loop and return concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def call(self, cmd, **kwargs):
+        """Blocking run of the command.  See `run` for the arguments"""
+        return self.submit(self.run(cmd, **kwargs)).result()
+
+    async def run(self, cmd, lane=None, cwd=None, logsdir=None, env=None,
+                  stdin=None, timeout=None):
+        """Run the command, under cwd and logs stored under logsdir
+
+        Parameters
+        ----------
+        cmd: list or str
+        lane: str, optional
+          Lane to run the command in.  It would wait while the lane is
+          at its limit of running commands
+        cwd: str, optional
+        logsdir: str, optional
+          Directory to store 'out' and 'err' logs in.  If not provided,
+          temporary one is used and removed if command succeeds
+        env: dict, optional
+        stdin: file, optional
+          File (with a fileno) to feed to the command.  By default the
+          command gets no input
+        timeout: float, optional
+          Seconds to wait for the command to finish.  Then the command, with
+          all the processes it has started, is terminated (and killed if
+          it does not exit within KILL_GRACE seconds), and CommandTimeout
+          is raised
+
+        Returns
+        -------
+        stdout, stderr
+          Only last TAIL_SIZE bytes of each are returned
+        """
+        if isinstance(cmd, string_types):
+            cmd = [cmd]
+        lane = lane or 'default'
+        if not logsdir:
+            logsdir = tempfile.mkdtemp(prefix="gearificator")
+            delete_logs = True
+        else:
+            delete_logs = False
+        if not op.exists(logsdir):
+            os.makedirs(logsdir)
+        log_stdout_path = op.join(logsdir, 'out')
+        log_stderr_path = op.join(logsdir, 'err')
+
+        async with self._get_semaphore(lane):
+            lgr.debug("Running %s (lane %s)", cmd, lane)
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL if stdin is None else stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=env,
+                cwd=cwd,
+                # in its own process group, so could be killed along with
+                # all its children
+                start_new_session=timeout is not None
+            )
+            timed_out = False
+            with open(log_stdout_path, 'wb') as log_stdout, \
+                    open(log_stderr_path, 'wb') as log_stderr:
+                streams = asyncio.gather(
+                    _stream(proc.stdout, log_stdout),
+                    _stream(proc.stderr, log_stderr),
+                )
+                try:
+                    exit_code = await asyncio.wait_for(proc.wait(), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    lgr.warning("%s did not finish within %s sec, terminating",
+                                cmd, timeout)
+                    exit_code = await _terminate(proc)
+                outs = await streams
+        outs = [out.decode('utf-8', 'replace') for out in outs]
+
+        if timed_out:
+            raise CommandTimeout(
+                "Running %s under %s timed out after %s sec. See %s"
+                % (" ".join(map(lambda x: "'%s'" % x, cmd)),
+                   cwd, timeout, log_stderr_path),
+                timeout=timeout, cmd=cmd, exit_code=exit_code, outs=outs)
+        if exit_code:
+            raise CommandError(
+                "Running %s under %s failed. Exit: %d. See %s"
+                % (" ".join(map(lambda x: "'%s'" % x, cmd)),
+                   cwd, exit_code, log_stderr_path),
+                cmd=cmd, exit_code=exit_code, outs=outs)
+        elif delete_logs:
+            # delete logs only if clear since otherwise nothing to inspect
+            shutil.rmtree(logsdir)
+        lgr.debug(" finished running with out=%s err=%s", *outs)
+        return outs
+
+
+async def _terminate(proc):
+    """Terminate the process group of proc, killing it if needed
+
+    Returns exit code of the process
+    """
+    for sig in signal.SIGTERM, signal.SIGKILL:
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            # all exited already
+            pass
+        try:
+            return await asyncio.wait_for(proc.wait(), KILL_GRACE)
+        except asyncio.TimeoutError:
+            lgr.debug("%d did not exit within %s sec after %s",
+                      proc.pid, KILL_GRACE, sig)
+    return await proc.wait()
+
+
+async def _stream(reader, f):
+    """Copy all from reader into the file f, and return the tail"""
+    tail = bytearray()
+    while True:
+        chunk = await reader.read(_READ_SIZE)
+        if not chunk:
+            break
+        f.write(chunk)
+        f.flush()
+        tail += chunk
+        if len(tail) > TAIL_SIZE:
+            del tail[:-TAIL_SIZE]
+    return bytes(tail)
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the engine of the current process, creating it if needed"""
+    global _engine, _engine_pid
+    with _engine_lock:
+        # a forked process (e.g. a worker) gets a copy of the engine without
+        # its thread, so it needs its own
+        if _engine is None or _engine_pid != os.getpid():
+            _engine = CommandEngine()
+            _engine_pid = os.getpid()
+        return _engine
+
+
+def set_lane_limits(**limits):
+    """Set limits of concurrently running commands for the lanes
+
+    Should be called before any command is ran.
+    """
+    global _engine
+    with _engine_lock:
+        LANE_LIMITS.update(limits)
+        if _engine is not None and _engine_pid == os.getpid():
+            _engine.close()
+        # Engine would get recreated with new limits whenever needed
+        _engine = None
@@ -1,2 +1,22 @@
 class UnknownBackend(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class CommandError(RuntimeError):
+    """External command exited with non-0 exit code
+
+    Besides the message, provides cmd, exit_code and outs (tails of
+    stdout and stderr) as attributes
+    """
+    def __init__(self, msg, cmd=None, exit_code=None, outs=None):
+        super(CommandError, self).__init__(msg)
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.outs = outs
+
+
+class CommandTimeout(CommandError):
+    """External command did not finish within its timeout and was killed"""
+    def __init__(self, msg, timeout=None, **kwargs):
+        super(CommandTimeout, self).__init__(msg, **kwargs)
+        self.timeout = timeout
@@ -3,97 +3,156 @@
 """Utilities for gear creation/management
 """
 
+import hashlib
 import json
 import os
 import shutil
-import subprocess
+import tarfile
 import tempfile
+import threading
+import uuid
 
 from collections import OrderedDict
+from glob import glob
 from importlib import import_module
 from os import path as op
-from subprocess import Popen
 
 from gearificator import __version__, get_logger
 from gearificator.consts import (
+    DOCKER_CONTEXT_DIGEST_LABEL,
+    DOCKER_IMAGE_REPO,
     GEAR_FLYWHEEL_DIR,
     GEAR_RUN_FILENAME, GEAR_MANIFEST_FILENAME,
     MANIFEST_CUSTOM_SECTION, MANIFEST_CUSTOM_INTERFACE, MANIFEST_CUSTOM_OUTPUTS,
     GEAR_INPUTS_DIR, GEAR_OUTPUT_DIR, GEAR_CONFIG_FILENAME,
+    GEAR_FINGERPRINT_FILENAME, GEAR_PLAN_FILENAME, GEAR_PLAN_VERSION,
+    RESULTS_CACHE_ENVVAR, RESULTS_CACHE_MOUNT,
+)
+from gearificator.engine import KILL_GRACE, get_engine
+from gearificator.exceptions import (
+    CommandError,
+    CommandTimeout,
+    UnknownBackend,
+)
+from gearificator.run import (
+    create_plan,
+    get_manifest,
+    load_interface_from_manifest,
+)
+from gearificator.utils import (
+    dump_json,
+    get_cache_dir,
+    load_json,
+    write_if_changed,
 )
-from gearificator.exceptions import UnknownBackend
-from gearificator.run import load_interface_from_manifest, get_manifest
 from gearificator.validator import validate_manifest
 
 lgr = get_logger('gear')
 
 
-def subprocess_call(cmd, cwd=None, logsdir=None, env=None):
+def subprocess_call(cmd, cwd=None, logsdir=None, env=None, lane=None,
+                    stdin=None, timeout=None):
     """A helper to run a command, under cwd and logs stored under logsdir
 
-    Returns stdout, stderr
+    The command is ran by the engine within the lane, so the call blocks
+    while the lane is busy running other commands.  See `CommandEngine.run`
+    for the other arguments.
+
+    Returns stdout, stderr (their tails if too long)
     """
-    if not logsdir:
-        logsdir = tempfile.mkdtemp(prefix="gearificator")
-        delete_logs = True
-    else:
-        delete_logs = False
+    return get_engine().call(
+        cmd, lane=lane, cwd=cwd, logsdir=logsdir, env=env, stdin=stdin,
+        timeout=timeout)
 
-    try:
-        # TODO: if not logsdir - make tempdir
-        if not op.exists(logsdir):
-            os.makedirs(logsdir)
-        # now just execute that gear in the directory
-        log_stdout_path = op.join(logsdir, 'out')
-        log_stderr_path = op.join(logsdir, 'err')
-        with open(log_stdout_path, 'w') as log_stdout, \
-                open(log_stderr_path, 'w') as log_stderr:
-            lgr.debug("Running %s", cmd)
-            exit_code = subprocess.call(
-                cmd,
-                stdin=subprocess.PIPE,
-                stdout=log_stdout,
-                stderr=log_stderr,
-                env=env,
-                cwd=cwd
-            )
-        outs = [
-            open(f).read() for f in [log_stdout_path, log_stderr_path]
-        ]
-    finally:
-        pass
-    if exit_code:
-        # TODO: make custom one to return outs
-        raise RuntimeError(
-            "Running %s under %s failed. Exit: %d. See %s"
-            % (" ".join(map(
-                    lambda x: "'%s'" % x, cmd))  # to avoid u''
-               if isinstance(cmd, (list, tuple)) else cmd,
-               cwd, exit_code, log_stderr_path))
-    else:
-        # delete logs only if clear since otherwise nothing to inspect above
-        if delete_logs:
-            shutil.rmtree(logsdir)
 
-    lgr.debug(" finished running with out=%s err=%s", *outs)
-    return outs
+def _get_limits_cmd(limits):
+    """Return command prefix to run a command within the resource limits
+
+    memory is limited via RLIMIT_AS (prlimit), and cpus by CPU affinity
+    (taskset), both from util-linux.  Those apply the limits and exec the
+    command, so nothing has to be done in the forked child of our process,
+    which is not safe while other threads (e.g. of the engine) are running.
+    Limits, for which the tool is not available (e.g. on OSX), are not
+    applied.
+    """
+    cmd = []
+    memory = limits.get('memory')
+    if memory and _have_tool('prlimit', 'memory'):
+        cmd += ['prlimit', '--as=%d' % memory, '--']
+    cpus = limits.get('cpus')
+    if cpus and _have_tool('taskset', 'cpus'):
+        try:
+            cpuset = sorted(os.sched_getaffinity(0))
+        except AttributeError:  # not on Linux
+            cpuset = list(range(os.cpu_count() or 1))
+        cpuset = cpuset[:max(1, int(cpus))]
+        cmd += ['taskset', '--cpu-list', ','.join(map(str, cpuset))]
+    return cmd
+
+
+_warned_tools = set()
+
+
+def _have_tool(tool, limit):
+    """Return True if tool is available, warning that limit is ignored if not
+    """
+    if shutil.which(tool):
+        return True
+    if tool not in _warned_tools:
+        _warned_tools.add(tool)
+        lgr.warning("%s is not available, %s limit of the test runs is "
+                    "ignored", tool, limit)
+    return False
+
 
+def run_gear_native(gearpath, testdir, limits=None, results_cache=None):
+    """Run the gear from gearpath natively on the host within testdir
 
-def run_gear_native(gearpath, testdir):
-    # if we run natively, we have to copy manifest for the gear
-    for f in [GEAR_RUN_FILENAME, GEAR_MANIFEST_FILENAME]:
+    Parameters
+    ----------
+    limits: dict, optional
+      walltime (seconds), memory (bytes) and cpus (number of) limits for the
+      run.  Upon walltime the process with all its children gets killed
+    results_cache: str, optional
+      Directory to cache outputs of the interface runs in (see
+      `run.ResultsCache`)
+    """
+    limits = limits or {}
+    # if we run natively, we have to copy manifest (and plan) for the gear
+    for f in [GEAR_RUN_FILENAME, GEAR_MANIFEST_FILENAME, GEAR_PLAN_FILENAME]:
+        if f == GEAR_PLAN_FILENAME and not op.exists(op.join(gearpath, f)):
+            continue  # gears generated before plans were introduced
         shutil.copy(op.join(gearpath, f), testdir)
     #logsdir = op.join(testdir, '.gearificator', 'logs')
     logsdir = op.join(testdir, 'logs')
+    env = dict(os.environ, FLYWHEEL='.')  # op.abspath(testdir)),)
+    if results_cache:
+        env[RESULTS_CACHE_ENVVAR] = op.abspath(results_cache)
     outs = subprocess_call(
-        './run',
+        _get_limits_cmd(limits) + ['./run'],
         cwd=testdir,
         logsdir=logsdir,
-        env=dict(os.environ, FLYWHEEL='.'))  # op.abspath(testdir)),)
+        env=env,
+        lane='test',
+        timeout=limits.get('walltime'))
     return outs
 
 
-def run_gear_docker(dockerimage, testdir, cmd=None):
+def run_gear_docker(dockerimage, testdir, cmd=None, limits=None,
+                    results_cache=None):
+    """Run the gear docker image with testdir mounted as its input/output
+
+    Parameters
+    ----------
+    limits: dict, optional
+      walltime (seconds), memory (bytes) and cpus limits for the container.
+      Upon walltime the container gets stopped (killed if it does not exit
+      within KILL_GRACE seconds)
+    results_cache: str, optional
+      Directory to cache outputs of the interface runs in (see
+      `run.ResultsCache`).  Mounted into the container as RESULTS_CACHE_MOUNT
+    """
+    limits = limits or {}
     # copy/paste largely for now to RF later TODO
     logsdir = op.join(testdir, 'logs')  # common
 
@@ -101,44 +160,347 @@ def run_gear_docker(dockerimage, testdir, cmd=None):
         return ["-v", "%s/%s:%s/%s"
                 % (op.realpath(testdir), s, GEAR_FLYWHEEL_DIR, s)]
 
+    # inputs could be staged as symlinks, so their targets must be available
+    # (read-only) within the container under the same paths
+    symlinked_args = sum(
+        (["-v", "%s:%s:ro" % (p, p)]
+         for p in get_symlinked_paths(op.join(testdir, GEAR_INPUTS_DIR))),
+        [])
+
     if cmd:
         entry_point_args = ['--entrypoint="%s"' % cmd[0]]
         cmd_args = cmd[1:]
     else:
         entry_point_args = cmd_args = []
 
-    outs = subprocess_call(
-        ['docker', 'run', '--rm']
-        # run under current user so we don't need
-        # to deal with root owned results etc.
-        # Note: gears < 0.2.dev2 will might not have readable /flywheel
-        #       due to too restrictive permissions/umask?
-        + ["-u", "%s:%s" % (os.getuid(), os.getgid())]
-        + sum(map(_m, [GEAR_INPUTS_DIR, GEAR_OUTPUT_DIR, GEAR_CONFIG_FILENAME]), [])
-        + entry_point_args
-        + [dockerimage]
-        + cmd_args,
-        cwd=testdir,
-        logsdir=logsdir,
-        env=dict(os.environ, FLYWHEEL='.')
-    )
+    results_cache_args = []
+    if results_cache:
+        if not op.exists(results_cache):
+            os.makedirs(results_cache)
+        results_cache_args = [
+            '-v', '%s:%s' % (op.realpath(results_cache), RESULTS_CACHE_MOUNT),
+            '-e', '%s=%s' % (RESULTS_CACHE_ENVVAR, RESULTS_CACHE_MOUNT)]
+
+    limits_args = []
+    if limits.get('memory'):
+        limits_args += ['--memory', str(limits['memory'])]
+    if limits.get('cpus'):
+        limits_args += ['--cpus', str(limits['cpus'])]
+    # named so it could be stopped upon timeout, since killing the client
+    # does not stop the container
+    name = 'gearificator-test-%s' % uuid.uuid4().hex[:12]
+    try:
+        outs = subprocess_call(
+            ['docker', 'run', '--rm', '--name', name,
+             '--stop-timeout', str(KILL_GRACE)]
+            # run under current user so we don't need
+            # to deal with root owned results etc.
+            # Note: gears < 0.2.dev2 will might not have readable /flywheel
+            #       due to too restrictive permissions/umask?
+            + ["-u", "%s:%s" % (os.getuid(), os.getgid())]
+            + sum(map(_m, [GEAR_INPUTS_DIR, GEAR_OUTPUT_DIR, GEAR_CONFIG_FILENAME]), [])
+            + symlinked_args
+            + results_cache_args
+            + limits_args
+            + entry_point_args
+            + [dockerimage]
+            + cmd_args,
+            cwd=testdir,
+            logsdir=logsdir,
+            env=dict(os.environ, FLYWHEEL='.'),
+            lane='test',
+            timeout=limits.get('walltime')
+        )
+    except CommandTimeout:
+        lgr.info("Stopping container %s", name)
+        try:
+            subprocess_call(['docker', 'stop', name], lane='query')
+        except (CommandError, OSError) as exc:
+            lgr.debug("Failed to stop container %s: %s", name, exc)
+        raise
     return outs
 
 
-def build_gear(buildir, docker_image):
+def get_symlinked_paths(path):
+    """Return sorted real paths of all the symlinks under path"""
+    paths = set()
+    for root, dnames, fnames in os.walk(path):
+        for f in dnames + fnames:
+            fpath = op.join(root, f)
+            if op.islink(fpath):
+                paths.add(op.realpath(fpath))
+    return sorted(paths)
+
+
+def build_gear(buildir, docker_image, labels=None):
+    """Build docker image from the buildir
+
+    Only the files needed by the Dockerfile (see `get_build_context_files`)
+    are sent to docker as the build context.
+    """
     lgr.info("Building gear docker image %s", docker_image)
     if len(docker_image) > 128:
         raise ValueError("too long (%d) tag: %s" % len(docker_image), docker_image)
-    return subprocess_call(
-        ['docker', 'build', '-t', docker_image, '.'],
-        cwd=buildir,
-    )
+    label_args = []
+    for label in sorted(labels or {}):
+        label_args += ['--label', '%s=%s' % (label, labels[label])]
+    with tempfile.TemporaryFile(prefix="gearificator-context") as context:
+        write_build_context(buildir, context)
+        context.seek(0)
+        return subprocess_call(
+            ['docker', 'build', '-t', docker_image] + label_args + ['-'],
+            cwd=buildir,
+            lane='build',
+            stdin=context
+        )
+
+
+def _get_dockerfile_instructions(content):
+    """Yield (instruction, arguments) from the Dockerfile content"""
+    line = ''
+    for l in content.splitlines():
+        if not line and (not l.strip() or l.lstrip().startswith('#')):
+            continue
+        if l.rstrip().endswith('\\'):
+            line += l.rstrip()[:-1] + ' '
+            continue
+        line += l
+        instruction, _, args = line.strip().partition(' ')
+        line = ''
+        yield instruction.upper(), args.strip()
+
+
+def get_build_context_files(buildir):
+    """Return sorted relative paths of the files needed to build in buildir
+
+    Those are the Dockerfile and all the local sources of its COPY and ADD
+    instructions.
+    """
+    with open(op.join(buildir, 'Dockerfile')) as f:
+        content = f.read()
+    files = {'Dockerfile'}
+    for instruction, args in _get_dockerfile_instructions(content):
+        if instruction not in ('COPY', 'ADD'):
+            continue
+        if args.startswith('['):
+            srcs = json.loads(args)[:-1]
+        else:
+            srcs = args.split()[:-1]
+        if any(s.startswith('--from') for s in srcs):
+            # from another image/stage
+            continue
+        for src in srcs:
+            if src.startswith('--') or '://' in src:
+                continue
+            paths = glob(op.join(buildir, src))
+            if not paths:
+                raise ValueError(
+                    "%s %s: %s is not found under %s"
+                    % (instruction, args, src, buildir))
+            for path in paths:
+                if op.isdir(path):
+                    for root, _, fnames in os.walk(path):
+                        files.update(
+                            op.relpath(op.join(root, f), buildir)
+                            for f in fnames)
+                else:
+                    files.add(op.relpath(path, buildir))
+    return sorted(files)
+
+
+def write_build_context(buildir, fileobj):
+    """Write the build context for the buildir as a tar into fileobj
+
+    Tar is deterministic: only the content and permissions of the files
+    are stored.
+    """
+    with tarfile.open(fileobj=fileobj, mode='w') as tar:
+        for f in get_build_context_files(buildir):
+            path = op.join(buildir, f)
+            info = tar.gettarinfo(path, arcname=f)
+            info.mtime = 0
+            info.uid = info.gid = 0
+            info.uname = info.gname = ''
+            if info.isfile():
+                with open(path, 'rb') as fp:
+                    tar.addfile(info, fp)
+            else:
+                tar.addfile(info)
+
+
+def get_context_digest(buildir):
+    """Return digest of the files the gear docker image is built from"""
+    digest = hashlib.sha256()
+    for f in get_build_context_files(buildir):
+        with open(op.join(buildir, f), 'rb') as fp:
+            content = fp.read()
+        digest.update(('%s %d\n' % (f, len(content))).encode('utf-8'))
+        digest.update(content)
+    return digest.hexdigest()
+
+
+def get_docker_image_label(docker_image, label):
+    """Return value of the label of the local docker image
+
+    None is returned if there is no such image or label
+    """
+    try:
+        out, _ = subprocess_call(
+            ['docker', 'image', 'inspect', '--format',
+             '{{ index .Config.Labels "%s" }}' % label, docker_image],
+            lane='query'
+        )
+    except CommandError:
+        return None
+    except OSError as exc:
+        lgr.debug("Cannot inspect docker image %s: %s", docker_image, exc)
+        return None
+    out = out.strip()
+    # older dockers print "<no value>" for absent labels
+    return out if out and out != '<no value>' else None
+
+
+def get_docker_image_id(docker_image):
+    """Return ID of the docker image if it is present locally, None otherwise
+    """
+    try:
+        out, _ = subprocess_call(
+            ['docker', 'image', 'inspect', '--format', '{{.Id}}', docker_image],
+            lane='query'
+        )
+    except CommandError:
+        return None
+    except OSError as exc:
+        lgr.debug("Cannot inspect docker image %s: %s", docker_image, exc)
+        return None
+    return out.strip() or None
+
+
+# Versions of packages per group of images (see get_pkg_versions)
+_pkg_versions_by_group = {}
+
+
+def get_pkg_versions(docker_image=None, packages=(), group=None):
+    """Return versions of Debian packages installed in the docker image
+
+    All the packages are queried at once within a single container.  Results
+    are cached on disk keyed by the image ID, so the container would not be
+    ran again for the same image.  Images of the same group (e.g. built
+    from the same base image with the same set of packages) are assumed to
+    provide the same versions, so a container is ran only for the first one
+    of them within the session (unless the image ID is cached already).
+
+    Parameters
+    ----------
+    docker_image: str, optional
+      If not provided, packages are queried on the host
+    packages: iterable of str
+    group: hashable, optional
+
+    Returns
+    -------
+    dict
+      package -> version, or None if package is not installed.  Empty
+      dict if docker image is not present locally.
+    """
+    packages = sorted(set(packages))
+    versions = {}
+    cache_path = None
+    if docker_image:
+        image_id = get_docker_image_id(docker_image)
+        if not image_id:
+            lgr.warning("Docker image %s is not present, so cannot query "
+                        "versions of %s", docker_image, ', '.join(packages))
+            return {}
+        cache_path = op.join(
+            get_cache_dir('pkg-versions'),
+            '%s.json' % image_id.replace(':', '_'))
+        versions = load_json(cache_path, must_exist=False)
+
+    to_query = [p for p in packages if p not in versions]
+    group_versions = _pkg_versions_by_group.get(group, {}) \
+        if group is not None else {}
+    if to_query and all(p in group_versions for p in to_query):
+        # another image of the group was queried already, so no need to run
+        # a container
+        for p in to_query:
+            versions[p] = group_versions[p]
+    elif to_query:
+        qcmd = ['docker', 'run', '--rm', '--entrypoint=dpkg-query',
+                docker_image] if docker_image else ['dpkg-query']
+        qcmd += ['-W', '-f=${db:Status-Abbrev} ${Package} ${Version}\n']
+        try:
+            out, _ = subprocess_call(qcmd + to_query, lane='query')
+        except CommandError as exc:
+            if exc.exit_code != 1:
+                raise
+            # some packages were not found, but others were reported
+            out = exc.outs[0]
+        queried = parse_dpkg_query(out)
+        for p in to_query:
+            versions[p] = queried.get(p)
+    if to_query and cache_path:
+        write_if_changed(
+            cache_path, dump_json(OrderedDict(sorted(versions.items()))))
+    if group is not None:
+        _pkg_versions_by_group[group] = dict(group_versions, **versions)
+    return versions
+
+
+def parse_dpkg_query(out):
+    """Parse output of dpkg-query -W -f='${db:Status-Abbrev} ${Package} ${Version}\\n'
+
+    Returns
+    -------
+    dict
+      package -> version, only for installed packages
+    """
+    versions = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'ii':
+            versions[fields[1]] = fields[2]
+    return versions
+
+
+# Shared base images known to be present, so we do not check again
+_present_base_images = set()
+# So concurrently processed gears do not build the same base image
+_base_images_lock = threading.Lock()
+
+
+def get_shared_base_image(backend_name, base_image, deb_packages=[],
+                          build=True):
+    """Return the tag of the image to be shared among the gears of a backend
+
+    The tag is derived from the content of the base image Dockerfile, so
+    the image gets built (if build) only if it is not present yet.
+    """
+    content = create_base_dockerfile(base_image, deb_packages)
+    tag = '%s/base-%s:%s' % (
+        DOCKER_IMAGE_REPO, backend_name,
+        hashlib.sha256(content.encode('utf-8')).hexdigest()[:12])
+    if build:
+        with _base_images_lock:
+            if tag not in _present_base_images:
+                if not get_docker_image_id(tag):
+                    lgr.info("Building shared base image %s", tag)
+                    builddir = tempfile.mkdtemp(prefix="gearificator-base")
+                    try:
+                        with open(op.join(builddir, 'Dockerfile'), 'w') as f:
+                            f.write(content)
+                        build_gear(builddir, tag)
+                    finally:
+                        shutil.rmtree(builddir)
+                _present_base_images.add(tag)
+    return tag
 
 
 def docker_push_gear(docker_image):
     lgr.info("Pushing gear docker image %s", docker_image)
     return subprocess_call(
-        ['docker', 'push', docker_image]
+        ['docker', 'push', docker_image],
+        lane='push'
     )
 
 
@@ -147,6 +509,7 @@ def fw_upload_gear(geardir):
     return subprocess_call(
             ['fw', 'gear', 'upload'],
             cwd=geardir,
+            lane='upload'
     )
 
 
@@ -184,6 +547,9 @@ def create_gear(obj,
                 envvars={},
                 dummy=False,
                 base_image=None,
+                shared_base=False,
+                force=False,
+                reuse_image=False,
                 # TODO:
                 # category="analysis" # or "converter"
                 ):
@@ -197,6 +563,15 @@ def create_gear(obj,
       Generate a dummified dockerfile, which would not install any needed
       software.  To be used primarily for small uploads to troubleshoot
       web UI and our configuration settings
+    shared_base: bool, optional
+      Build the gear image on top of an image shared among all the gears
+      of the backend (and base_image), which gets built if not present
+    force: bool, optional
+      Regenerate (and rebuild) the gear even if its fingerprint did not
+      change since the last time it was generated
+    reuse_image: bool, optional
+      Do not build the docker image if the image with the same tag was
+      already built from exactly the same build context
     """
     lgr.info("Creating gear for %s", obj)
     gear_spec = OrderedDict() # just to ease inspection etc, let's return the full structure
@@ -212,6 +587,25 @@ def create_gear(obj,
         backend.get_version() if hasattr(backend, 'get_version') else ''
     ) #  + '.3'
 
+    fingerprint = get_gear_fingerprint(
+        obj, backend,
+        manifest_fields=manifest_fields,
+        defaults=defaults,
+        deb_packages=deb_packages,
+        pip_packages=pip_packages,
+        source_files=source_files,
+        prepend_paths=prepend_paths,
+        envvars=envvars,
+        dummy=dummy,
+        base_image=base_image,
+        shared_base=shared_base,
+    )
+    if not force:
+        uptodate_spec = get_uptodate_gear(outdir, fingerprint, build_docker)
+        if uptodate_spec:
+            lgr.info("Gear for %s is up to date", obj)
+            return uptodate_spec
+
     manifest, outputs = backend.extract_manifest(obj, defaults=defaults)
     if version:
         manifest['version'] = version
@@ -221,7 +615,7 @@ def create_gear(obj,
             manifest[f] += '-dummy'
     name = manifest['name']
     # Filter out undefined which were added just for consistent order
-    for f in manifest:
+    for f in list(manifest):
         if manifest[f] is None:
             manifest.pop(f)
 
@@ -255,17 +649,33 @@ def create_gear(obj,
     if 'label' not in manifest:
         manifest['label'] = getattr(obj, '__name__')
 
-    # Save manifest
     manifest_fname = os.path.join(outdir, GEAR_MANIFEST_FILENAME)
-    save_manifest(manifest, manifest_fname)
-
+    if hasattr(backend, 'get_suite'):
+        # Versions could be known only after the image is built, which in turn
+        # contains the manifest.  So we start with what we had figured out
+        # before, and the manifest would need to be rewritten only if
+        # versions changed.
+        prev_custom = load_json(manifest_fname, must_exist=False).get('custom', {})
+        if 'flywheel' in prev_custom:
+            custom['flywheel'] = prev_custom['flywheel']
+
+    # Serialize only once, and validate/check exactly what would be saved
+    # (e.g. tuples become lists)
+    manifest_content = dump_json(manifest)
+    saved_manifest = json.loads(manifest_content)
     if validate:
-        validate_manifest(manifest_fname)
+        validate_manifest(saved_manifest)
 
     # sanity check
-    interface = load_interface_from_manifest(manifest_fname)
+    interface = load_interface_from_manifest(saved_manifest)
     assert interface is obj
 
+    write_if_changed(manifest_fname, manifest_content)
+
+    # the runtime would not need to process the manifest
+    gear_spec['plan'] = plan = create_plan(saved_manifest)
+    write_if_changed(os.path.join(outdir, GEAR_PLAN_FILENAME), dump_json(plan))
+
     # TODO: create run
     gear_spec['run'] = create_run(
         os.path.join(outdir, 'run'),
@@ -274,92 +684,154 @@ def create_gear(obj,
         envvars=envvars
     )
 
+    base_image = base_image or getattr(backend, 'DOCKER_BASE_IMAGE', 'neurodebian')
+    backend_deb_packages = getattr(backend, 'DEB_PACKAGES', [])
+    shared_base_image = None
+    if shared_base and not dummy:
+        shared_base_image = gear_spec['shared_base_image'] = \
+            get_shared_base_image(
+                backend_name, base_image, backend_deb_packages,
+                build=build_docker)
+
     # Create a dedicated Dockerfile
     gear_spec['Dockerfile'] = create_dockerfile(
         os.path.join(outdir, "Dockerfile"),
-        base_image=base_image or getattr(backend, 'DOCKER_BASE_IMAGE', 'neurodebian'),
-        deb_packages=getattr(backend, 'DEB_PACKAGES', []),
+        base_image=base_image,
+        deb_packages=backend_deb_packages,
         extra_deb_packages=deb_packages,
         pip_packages=getattr(backend, 'PIP_PACKAGES', []) + pip_packages,
-        dummy=dummy
+        dummy=dummy,
+        shared_base_image=shared_base_image,
     )
 
     gear_spec['docker_image'] = docker_image
     if build_docker:
-        out, err = build_gear(outdir, docker_image)
-        gear_spec['docker_build_stdout'] = out
-        gear_spec['docker_build_stderr'] = err
+        context_digest = get_context_digest(outdir)
+        if reuse_image and get_docker_image_label(
+                docker_image, DOCKER_CONTEXT_DIGEST_LABEL) == context_digest:
+            lgr.info("Reusing present docker image %s", docker_image)
+            gear_spec['docker_reused'] = True
+        else:
+            out, err = build_gear(
+                outdir, docker_image,
+                labels={DOCKER_CONTEXT_DIGEST_LABEL: context_digest})
+            gear_spec['docker_build_stdout'] = out
+            gear_spec['docker_build_stderr'] = err
 
     if hasattr(backend, 'get_suite'):
-        custom["flywheel"] = {
-            "suite": backend.get_suite(obj, docker_image)
+        all_deb_packages = backend_deb_packages + deb_packages
+        custom['flywheel'] = {
+            "suite": backend.get_suite(
+                obj, docker_image,
+                deb_packages=all_deb_packages,
+                # all gears of the same base and packages have the same
+                # versions of them
+                group=(shared_base_image or base_image, dummy,
+                       tuple(sorted(all_deb_packages))))
         }
-        # and we resave it again, so inside gear docker it might actually differ
-        # unfortunately, but shouldn't matter I guess
+        # and we resave it again if changed, so inside gear docker it might
+        # actually differ unfortunately, but shouldn't matter I guess
         save_manifest(manifest, manifest_fname)
 
+    gear_spec['fingerprint'] = fingerprint
+    save_fingerprint(outdir, fingerprint, docker_image, build_docker)
     return gear_spec
 
 
-def save_manifest(manifest, manifest_fname):
-    with open(manifest_fname, 'w') as f:
-        json.dump(manifest, f, indent=2, separators=(',', ': '))
+def get_gear_fingerprint(obj, backend, **kwargs):
+    """Compute a fingerprint of everything a gear is generated from
 
+    Those are the interface (input/output specs as described by the backend),
+    versions of the backend, gearificator and the plan, and all the options
+    (kwargs) given to create_gear (%manifest, %params from the spec).
 
-def create_dockerfile(
+    Returns
+    -------
+    str
+      hexdigest
+    """
+    fingerprint_data = OrderedDict([
+        ('gearificator', __version__),
+        ('plan', GEAR_PLAN_VERSION),
+        ('backend', backend.get_version()
+            if hasattr(backend, 'get_version') else None),
+        ('interface', '%s:%s' % (obj.__module__, obj.__name__)),
+        ('specs', backend.get_fingerprint_data(obj)
+            if hasattr(backend, 'get_fingerprint_data') else None),
+        ('kwargs', kwargs),
+    ])
+    return hashlib.sha256(
+        json.dumps(fingerprint_data, sort_keys=True, default=repr)
+        .encode('utf-8')
+    ).hexdigest()
+
+
+def save_fingerprint(outdir, fingerprint, docker_image, docker_built):
+    fname = op.join(outdir, GEAR_FINGERPRINT_FILENAME)
+    if not docker_built:
+        # we might have built it before for the same fingerprint
+        rec = load_json(fname, must_exist=False)
+        docker_built = rec.get('fingerprint') == fingerprint \
+            and rec.get('docker_built', False)
+    write_if_changed(
         fname,
-        base_image,
-        deb_packages=[], extra_deb_packages=[], pip_packages=[],
-        dummy=False
-    ):
-    """Create a Dockerfile for the gear
+        dump_json(OrderedDict([
+            ('fingerprint', fingerprint),
+            ('docker_image', docker_image),
+            ('docker_built', docker_built),
+        ])))
 
-    ATM we aren't bothering establishing a common base image. So will rebuild
-    entire spec
+
+def get_uptodate_gear(outdir, fingerprint, build_docker):
+    """Return gear spec if gear in outdir was generated for the fingerprint
+
+    None is returned if the gear needs to be (re)generated, e.g. if any of
+    its files is missing or if the docker image was requested but not built
+    for this fingerprint.
     """
+    rec = load_json(op.join(outdir, GEAR_FINGERPRINT_FILENAME),
+                    must_exist=False)
+    if rec.get('fingerprint') != fingerprint:
+        return None
+    if not all(op.exists(op.join(outdir, f))
+               for f in (GEAR_MANIFEST_FILENAME, GEAR_PLAN_FILENAME,
+                         GEAR_RUN_FILENAME, 'Dockerfile')):
+        return None
+    if build_docker and not rec.get('docker_built'):
+        return None
+    return OrderedDict([
+        ('docker_image', rec['docker_image']),
+        ('fingerprint', fingerprint),
+        ('skipped', True),
+    ])
 
-    # to minimize image layers size
-    cleanup_cmd = "rm -rf /var/lib/apt/lists/* /tmp/* /var/tmp/*"
 
-    deb_packages_line = ' '.join(deb_packages) if deb_packages else ''
-    extra_deb_packages_str = (' '.join(extra_deb_packages) if extra_deb_packages else '')
-    extra_deb_packages_line = """
-RUN apt-get update \\ 
-    && apt-get install -y --no-install-recommends %(extra_deb_packages_str)s \\
-    && %(cleanup_cmd)s
-""" % locals()
-    pip_packages_str = ' '.join(pip_packages) if pip_packages else ''
-    pip_line = "RUN pip install %(pip_packages_str)s && %(cleanup_cmd)s" \
-            % locals()
+def save_manifest(manifest, manifest_fname):
+    """Save manifest, unless the file already has exactly the same content
 
-    if dummy:
-        base_image = 'busybox:latest'
+    Returns
+    -------
+    bool
+      True if the file was (re)written
+    """
+    return write_if_changed(manifest_fname, dump_json(manifest))
 
-    template = """\
+
+# Sections of the Dockerfile, to be interpolated with locals() of
+# create_dockerfile and create_base_dockerfile
+_DOCKERFILE_HEADER = """\
 FROM %(base_image)s
 MAINTAINER Yaroslav O. Halchenko <debian@onerussian.com>
     """
-    if not dummy:
-        if base_image.startswith('neurodebian:'):
-            template += """
+
+_DOCKERFILE_FREEZE = """
 # Make image reproducible based on the date/state of things in Debian/NeuroDebian
 # land.
 # Time format yyyymmdd 
 RUN nd_freeze 20190402
 """
-        else:
-            raise NotImplementedError(
-                "Did not bother implementing support for freeze for "
-                "non-neurodebian base images")
-            # Also below removed eatmydata since now by default is used for
-            # apt-get on neurodebian images
-# Not doing it since now using nd_freeze, no mirrors
-#         template += """
-# # Install additional APT mirror for NeuroDebian for better availability/resilience
-# RUN echo deb http://neurodeb.pirsquared.org data main contrib non-free >> /etc/apt/sources.list.d/neurodebian.sources.list
-# RUN echo deb http://neurodeb.pirsquared.org stretch main contrib non-free >> /etc/apt/sources.list.d/neurodebian.sources.list
-# """
-        template += """
+
+_DOCKERFILE_BASE_PACKAGES = """
 # To prevent interactive debconf during installations
 ARG DEBIAN_FRONTEND=noninteractive
 
@@ -379,7 +851,8 @@ RUN apt-get update \\
 # TEMPMOVE RUN git clone git://github.com/yarikoptic/gearificator /srv/gearificator && echo 7
 # TEMPMOVE RUN pip install -e /srv/gearificator
 """
-    template += """
+
+_DOCKERFILE_COMMON = """
 # Common to all gears settings
 ENV FLYWHEEL %s
 RUN mkdir -p ${FLYWHEEL}
@@ -388,32 +861,126 @@ RUN mkdir -p ${FLYWHEEL}
 ENV LC_ALL C.UTF-8
 """ % GEAR_FLYWHEEL_DIR
 
-    if not dummy:
-        template += """
+_DOCKERFILE_GEAR_PACKAGES = """
 # Now we do this particular Gear specific installations
 %(extra_deb_packages_line)s
 %(pip_line)s
     """
 
-        # TEMP do it here for now since it is volatile
-        template += """
-RUN git clone git://github.com/yarikoptic/gearificator /srv/gearificator && echo 7
+# TEMP do it in the gear image for now since it is volatile.  Not a part of
+# the shared base image, which is rebuilt only when its Dockerfile changes.
+# The version is echoed so docker does not reuse the cached layer of an
+# older gearificator
+_DOCKERFILE_GEARIFICATOR = """
+RUN git clone git://github.com/yarikoptic/gearificator /srv/gearificator && echo %(gearificator_version)s
 RUN pip install -e /srv/gearificator && %(cleanup_cmd)s
 """
-    template += """
+
+_DOCKERFILE_GEAR_FILES = """
 COPY run ${FLYWHEEL}/run
 COPY manifest.json ${FLYWHEEL}/manifest.json
+COPY plan.json ${FLYWHEEL}/plan.json
 RUN chmod a+rX -R ${FLYWHEEL}  # allow everyone access the content
 
 # Configure entrypoint
 ENTRYPOINT ["/flywheel/v0/run"]
 """
+
+# to minimize image layers size
+_CLEANUP_CMD = "rm -rf /var/lib/apt/lists/* /tmp/* /var/tmp/*"
+
+
+def _get_dockerfile_freeze(base_image):
+    if not base_image.startswith('neurodebian:'):
+        raise NotImplementedError(
+            "Did not bother implementing support for freeze for "
+            "non-neurodebian base images")
+        # Also below removed eatmydata since now by default is used for
+        # apt-get on neurodebian images
+    # Not doing it since now using nd_freeze, no mirrors
+    #         template += """
+    # # Install additional APT mirror for NeuroDebian for better availability/resilience
+    # RUN echo deb http://neurodeb.pirsquared.org data main contrib non-free >> /etc/apt/sources.list.d/neurodebian.sources.list
+    # RUN echo deb http://neurodeb.pirsquared.org stretch main contrib non-free >> /etc/apt/sources.list.d/neurodebian.sources.list
+    # """
+    return _DOCKERFILE_FREEZE
+
+
+def create_dockerfile(
+        fname,
+        base_image,
+        deb_packages=[], extra_deb_packages=[], pip_packages=[],
+        dummy=False,
+        shared_base_image=None,
+    ):
+    """Create a Dockerfile for the gear
+
+    By default the Dockerfile installs everything needed for the gear on top
+    of the base_image.  If shared_base_image (as produced from
+    create_base_dockerfile for the same base_image and deb_packages) is
+    provided, the Dockerfile would be just a thin layer on top of it with
+    gear specific extra_deb_packages, pip_packages, gearificator and files.
+    """
+    cleanup_cmd = _CLEANUP_CMD
+    gearificator_version = __version__
+
+    extra_deb_packages_str = (' '.join(extra_deb_packages) if extra_deb_packages else '')
+    extra_deb_packages_line = """
+RUN apt-get update \\ 
+    && apt-get install -y --no-install-recommends %(extra_deb_packages_str)s \\
+    && %(cleanup_cmd)s
+""" % locals()
+    pip_packages_str = ' '.join(pip_packages) if pip_packages else ''
+    pip_line = "RUN pip install %(pip_packages_str)s && %(cleanup_cmd)s" \
+            % locals()
+
+    if dummy:
+        base_image = 'busybox:latest'
+        template = _DOCKERFILE_HEADER + _DOCKERFILE_COMMON
+    elif shared_base_image:
+        base_image = shared_base_image
+        # ARG does not get inherited from the base image
+        template = _DOCKERFILE_HEADER + """
+ARG DEBIAN_FRONTEND=noninteractive
+
+# Now we do this particular Gear specific installations
+"""
+        # Do not even bother updating apt lists etc if nothing to install
+        if extra_deb_packages:
+            template += "%(extra_deb_packages_line)s"
+        if pip_packages:
+            template += "%(pip_line)s\n"
+        template += _DOCKERFILE_GEARIFICATOR
+    else:
+        deb_packages_line = ' '.join(deb_packages) if deb_packages else ''
+        template = _DOCKERFILE_HEADER \
+            + _get_dockerfile_freeze(base_image) \
+            + _DOCKERFILE_BASE_PACKAGES \
+            + _DOCKERFILE_COMMON \
+            + _DOCKERFILE_GEAR_PACKAGES \
+            + _DOCKERFILE_GEARIFICATOR
+    template += _DOCKERFILE_GEAR_FILES
     content = template % locals()
-    with open(fname, "w") as f:
-        f.write(content)
+    write_if_changed(fname, content)
     return content
 
 
+def create_base_dockerfile(base_image, deb_packages=[]):
+    """Return content of the Dockerfile for an image shared among the gears
+
+    It contains everything common to the gears of a backend: frozen
+    base_image and backend deb_packages.  gearificator itself gets installed
+    in the gears images, so they do not end up with a stale one.
+    """
+    cleanup_cmd = _CLEANUP_CMD
+    deb_packages_line = ' '.join(deb_packages) if deb_packages else ''
+    template = _DOCKERFILE_HEADER \
+        + _get_dockerfile_freeze(base_image) \
+        + _DOCKERFILE_BASE_PACKAGES \
+        + _DOCKERFILE_COMMON
+    return template % locals()
+
+
 def create_run(fname, source_files, prepend_paths=None, envvars={}):
     """Create the mighty "run" file which would be exactly the same in all of them
     """
@@ -436,8 +1003,6 @@ set -eu
             content += 'export %s=%s\n' % var
     # Finally actually run the thing
     content += "python -m gearificator \"$@\"\n"
-    with open(fname, 'w') as f:
-        f.write(content)
     # make it executable
-    os.chmod(fname, 0o755)
+    write_if_changed(fname, content, mode=0o755)
     return content
@@ -0,0 +1,120 @@
+#emacs: -*- mode: python-mode; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+#ex: set sts=4 ts=4 sw=4 noet:
+"""Persistent index of the objects (interfaces) found under dotted paths
+
+It allows to decide which paths lead to gears without importing them (and
+all the modules they depend on) on every run.  A record gets refreshed
+(and the object imported) only when the source file it was found in
+changes.
+"""
+
+import hashlib
+import os
+import os.path as op
+import sys
+
+from inspect import ismodule
+
+from . import get_logger
+from .utils import (
+    get_cache_dir,
+    JsonStore,
+)
+
+lgr = get_logger('index')
+
+
+def get_index_path():
+    """Path to the index for the current Python environment
+
+    Different environments would provide different modules, so each gets its
+    own index.
+    """
+    env_id = hashlib.md5(sys.executable.encode('utf-8')).hexdigest()[:8]
+    return op.join(get_cache_dir(), 'interfaces-%s.json' % env_id)
+
+
+def describe_object(obj):
+    """Describe the object to be stored in the index
+
+    Returns
+    -------
+    dict
+      with 'module', 'input_spec', 'output_spec' (bool's), 'source' (the
+      file where object was found, or None), 'mtime' of that source, and for
+      modules 'children' -- public attributes which are submodules of it or
+      not modules at all
+    """
+    is_module = ismodule(obj)
+    if is_module:
+        source = getattr(obj, '__file__', None)
+    else:
+        source = getattr(
+            sys.modules.get(getattr(obj, '__module__', None)), '__file__', None)
+    rec = {
+        'module': is_module,
+        'input_spec': bool(getattr(obj, 'input_spec', None)),
+        'output_spec': bool(getattr(obj, 'output_spec', None)),
+        'source': source,
+        'mtime': _get_mtime(source),
+    }
+    if is_module:
+        children = []
+        for attr in dir(obj):
+            if attr.startswith('_'):
+                continue
+            subobj = getattr(obj, attr)
+            if not ismodule(subobj) or \
+                    subobj.__name__.startswith(obj.__name__ + '.'):
+                children.append(attr)
+        rec['children'] = children
+    return rec
+
+
+def _get_mtime(path):
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class InterfaceIndex(JsonStore):
+    """Index of records describing objects found under dotted paths
+
+    Records are created (by importing the object) on the first access, and
+    stored in a JSON file by save().  A record is considered stale and gets
+    recreated if the mtime of its source file changed.
+
+    Parameters
+    ----------
+    path: str, optional
+      File to store the index in.  By default the one for the current Python
+      environment (see `get_index_path`)
+    """
+
+    # To be incremented whenever the structure of the records changes
+    VERSION = 1
+    KEY = 'records'
+    NAME = 'interfaces index'
+
+    def __init__(self, path=None):
+        super(InterfaceIndex, self).__init__(path or get_index_path())
+
+    def __getitem__(self, path):
+        rec = self._get(path)
+        if rec is not None and self._is_fresh(rec):
+            return rec
+        lgr.log(5, "Indexing %s", path)
+        from .spec import get_object_from_path
+        rec = describe_object(get_object_from_path(path))
+        if rec['source']:
+            # there is nothing to check freshness of otherwise
+            self._set(path, rec)
+        return rec
+
+    @staticmethod
+    def _is_fresh(rec):
+        return rec['mtime'] is not None \
+            and _get_mtime(rec['source']) == rec['mtime']
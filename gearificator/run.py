@@ -25,22 +25,27 @@
   THE SOFTWARE.
 """
 
+import hashlib
+import json
 import os
 import os.path as op
-
+import re
 import sys
 import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from glob import glob
 from importlib import import_module
 from os.path import (
     join as opj,
-    exists,
     dirname
 )
 
 from six import string_types
 
-from gearificator import get_logger
+from gearificator import __version__, get_logger
 from gearificator.consts import (
     # MANIFEST_BACKEND_FIELD,
     MANIFEST_CUSTOM_SECTION,
@@ -49,11 +54,22 @@ from gearificator.consts import (
     GEAR_MANIFEST_FILENAME,
     GEAR_CONFIG_FILENAME,
     GEAR_INPUTS_DIR,
-    GEAR_OUTPUT_DIR
+    GEAR_METRICS_FILENAME,
+    GEAR_METRICS_VERSION,
+    GEAR_OUTPUT_DIR,
+    GEAR_PLAN_FILENAME,
+    GEAR_PLAN_VERSION,
+    RESULTS_CACHE_ENVVAR,
 )
 from gearificator.utils import (
     load_json,
     chpwd,
+    DigestCache,
+    dump_json,
+    format_size,
+    get_cpu_count,
+    stage_file,
+    write_if_changed,
 )
 
 lgr = get_logger('runtime')
@@ -69,16 +85,73 @@ def load_interface(module_cls):
     return getattr(module, cls_name)
 
 
-def load_interface_from_manifest(j):
-    """Load the manifest.json and extract the interface definition
-    """
-    j = get_manifest(j)
+def get_interface_path(j):
+    """Return module:class of the interface defined in the manifest"""
     try:
-        module_cls = j['custom'][MANIFEST_CUSTOM_SECTION][MANIFEST_CUSTOM_INTERFACE]
+        return j['custom'][MANIFEST_CUSTOM_SECTION][MANIFEST_CUSTOM_INTERFACE]
     except Exception:
         raise ValueError("Did not find definition of the interface among %s"
                          % str(j.get('custom')))
-    return load_interface(module_cls)
+
+
+def load_interface_from_manifest(j):
+    """Load the manifest.json and extract the interface definition
+    """
+    return load_interface(get_interface_path(get_manifest(j)))
+
+
+def create_plan(manifest):
+    """Precompile the runtime plan from the manifest
+
+    The plan contains only what is needed to run the interface: its path,
+    inputs (name -> kwarg and whether it is optional), merged defaults of
+    the config, and the output fields to collect.  So at run time only
+    config.json needs to be applied on top of it.
+
+    Returns
+    -------
+    dict
+    """
+    manifest = get_manifest(manifest)
+    custom = manifest.get('custom', {}).get(MANIFEST_CUSTOM_SECTION, {})
+    plan = OrderedDict()
+    plan['version'] = GEAR_PLAN_VERSION
+    plan['interface'] = get_interface_path(manifest)
+    # includes versions of gearificator and the backend
+    plan['gear_version'] = manifest.get('version')
+    plan['inputs'] = OrderedDict(
+        (input_, OrderedDict([
+            ('kwarg', input_),
+            ('optional', input_params.get('optional', False))]))
+        for input_, input_params in manifest.get('inputs', {}).items()
+    )
+    # We do need to pass defaults from manifest since we might have
+    # provided custom ones
+    plan['defaults'] = OrderedDict(
+        (c, v['default'])
+        for c, v in manifest.get('config', {}).items()
+        if 'default' in v
+    )
+    plan['outputs'] = list(custom.get(MANIFEST_CUSTOM_OUTPUTS, {}))
+    return plan
+
+
+def load_plan(topdir):
+    """Load the runtime plan from topdir
+
+    Returns
+    -------
+    dict or None
+      None if there is no plan, or it is of some other version, so it
+      should be created from the manifest
+    """
+    plan = load_json(opj(topdir, GEAR_PLAN_FILENAME), must_exist=False)
+    if plan.get('version') != GEAR_PLAN_VERSION:
+        if plan:
+            lgr.warning("Ignoring plan of version %s, expected %s",
+                        plan.get('version'), GEAR_PLAN_VERSION)
+        return None
+    return plan
 
 
 def get_manifest(j):
@@ -95,48 +168,434 @@ def errorout(msg, exitcode=1):
     sys.exit(exitcode)
 
 
+class ResourceMonitor(object):
+    """Measure resources used by the process and its children in the context
+
+    CPU times are taken from getrusage for the process itself and its
+    (waited for) children.  Peak RSS is of the whole process tree, sampled
+    from /proc upon entering and exiting the context and every interval
+    seconds in between.  Peak RSS from getrusage is reported separately
+    (lifetime_peak_rss_*) since it is of the whole lifetime of the process
+    (and of the largest child), so could be reached before the context.
+    Bytes read and written (by the process and its waited for children) are
+    taken from /proc/self/io.  Metrics which could not be measured are None.
+    """
+
+    def __init__(self, interval=1.):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+        self._end = None
+        self._tree_peak_rss = 0
+
+    def __enter__(self):
+        self._start = self._get_counters()
+        self._tree_peak_rss = 0
+        self._sample_tree_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample_tree_rss()
+        self._end = self._get_counters()
+
+    @staticmethod
+    def _get_counters():
+        import resource
+        return {
+            'time': time.time(),
+            'self': resource.getrusage(resource.RUSAGE_SELF),
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN),
+            'io': _read_proc_io(),
+        }
+
+    def _sample_tree_rss(self):
+        rss = _get_tree_rss(os.getpid())
+        if rss:
+            self._tree_peak_rss = max(self._tree_peak_rss, rss)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._sample_tree_rss()
+
+    def get_metrics(self):
+        """Return metrics for the (exited) context"""
+        start, end = self._start, self._end
+
+        def delta(field):
+            return sum(getattr(end[w], field) - getattr(start[w], field)
+                       for w in ('self', 'children'))
+
+        def io_delta(field):
+            if start['io'] and end['io'] and field in end['io']:
+                return end['io'][field] - start['io'][field]
+            return None
+        return OrderedDict([
+            ('version', GEAR_METRICS_VERSION),
+            ('wall_time', end['time'] - start['time']),
+            ('cpu_user', delta('ru_utime')),
+            ('cpu_system', delta('ru_stime')),
+            ('peak_rss', self._tree_peak_rss or None),
+            # ru_maxrss is in kilobytes on Linux
+            ('lifetime_peak_rss_self', end['self'].ru_maxrss * 1024),
+            ('lifetime_peak_rss_children', end['children'].ru_maxrss * 1024),
+            ('read_bytes', io_delta('read_bytes')),
+            ('write_bytes', io_delta('write_bytes')),
+            ('read_chars', io_delta('rchar')),
+            ('write_chars', io_delta('wchar')),
+            ('cpus', get_cpu_count()),
+        ])
+
+
+def _read_proc_io(pid='self'):
+    """Return counters from /proc/PID/io, or None if not available"""
+    try:
+        with open('/proc/%s/io' % pid) as f:
+            return dict(
+                (k, int(v)) for k, v in
+                (line.split(':', 1) for line in f if ':' in line))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _get_tree_rss(pid):
+    """Return total RSS (in bytes) of the process and all its descendants"""
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return None
+    children = {}
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for p in pids:
+        try:
+            with open('/proc/%s/stat' % p) as f:
+                # comm could contain spaces and parens, so take what is
+                # after it: state, ppid, ..., rss is the 22nd
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue  # exited meanwhile
+        children.setdefault(int(fields[1]), []).append(int(p))
+        rss[int(p)] = int(fields[21]) * page_size
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += rss.get(p, 0)
+        todo.extend(children.get(p, []))
+    return total
+
+
+def save_metrics(outdir, metrics):
+    """Save metrics of the run into outdir and log a summary"""
+    def size(field):
+        return format_size(metrics[field]) \
+            if metrics.get(field) is not None else 'n/a'
+    lgr.info(
+        "Resources%s: wall %.1f sec, CPU %.1f sec (user %.1f, system %.1f), "
+        "peak RSS %s, read %s, written %s",
+        ' (failed)' if metrics.get('failed')
+        else ' (outputs restored from cache)' if metrics.get('cached')
+        else '',
+        metrics['wall_time'], metrics['cpu_user'] + metrics['cpu_system'],
+        metrics['cpu_user'], metrics['cpu_system'],
+        size('peak_rss'), size('read_bytes'), size('write_bytes'))
+    try:
+        write_if_changed(
+            opj(outdir, GEAR_METRICS_FILENAME), dump_json(metrics))
+    except (IOError, OSError) as exc:
+        lgr.warning("Failed to save metrics: %s", exc)
+
+
+def save_batch_metrics(outdir, names, errors, wall_time):
+    """Save metrics of the batch run, collected from its sets, into outdir
+
+    Parameters
+    ----------
+    names: list of str
+      Names of the input sets, the metrics of which were saved under the
+      subdirectories of outdir
+    errors: dict
+      name -> error message, for the failed sets
+    wall_time: float
+      Seconds the whole batch took
+    """
+    metrics = OrderedDict([
+        ('version', GEAR_METRICS_VERSION),
+        ('wall_time', wall_time),
+        ('failed', sorted(errors)),
+        ('sets', OrderedDict(
+            (name, load_json(opj(outdir, name, GEAR_METRICS_FILENAME),
+                             must_exist=False) or {'error': errors.get(name)})
+            for name in names)),
+    ])
+    lgr.info("Batch of %d input sets (%d failed) took %.1f sec",
+             len(names), len(errors), wall_time)
+    try:
+        write_if_changed(
+            opj(outdir, GEAR_METRICS_FILENAME), dump_json(metrics))
+    except (IOError, OSError) as exc:
+        lgr.warning("Failed to save metrics: %s", exc)
+
+
+class ResultsCache(object):
+    """Outputs of the interface runs, to not redo identical runs
+
+    Outputs are stored under path, keyed by the versions of gearificator, the
+    gear and the tool, the interface, content (and names) of the input files
+    and the resolved configuration.  They are staged (see
+    `utils.stage_file`) into/from the cache, so hardlinked or reflinked where
+    possible.  Hence outputs must not be modified in place.
+
+    Version of the tool is often unknown (e.g. for nipype interfaces not
+    reporting it), and the version of the gear changes only with the
+    versions of gearificator and the backend.  So entries are not
+    invalidated by a rebuild of a gear with updated tools (e.g. Debian
+    packages), and the cache should be cleared (or another path used) then.
+
+    Digests of the input files are cached (see `utils.DigestCache`) within
+    path, so the same files (e.g. hardlinked inputs of the tests) are not
+    read again to compute the key.
+
+    Parameters
+    ----------
+    path: str
+      Directory to store the results in.  Could be shared among the gears
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_env(cls):
+        """Return the cache if enabled via RESULTS_CACHE_ENVVAR, or None"""
+        path = os.environ.get(RESULTS_CACHE_ENVVAR)
+        return cls(path) if path else None
+
+    def get_key(self, plan, interface, config, input_files):
+        """Return the key for the run of the interface on the input_files"""
+        try:
+            # nipype interfaces might need to run the tool to figure it out
+            tool_version = getattr(interface, 'version', None)
+        except Exception as exc:
+            lgr.debug("Failed to get version of %s: %s", interface, exc)
+            tool_version = None
+        digests = DigestCache(opj(self.path, 'digests.json'))
+        key_data = OrderedDict([
+            ('cache', self.VERSION),
+            ('gearificator', __version__),
+            ('gear', plan.get('gear_version')),
+            ('interface', plan['interface']),
+            ('tool', str(tool_version) if tool_version else None),
+            # outputs could be named after the inputs
+            ('inputs', OrderedDict(
+                (i, [op.basename(f), digests.digest(f)])
+                for i, f in sorted(input_files.items()))),
+            ('config', get_config_kwargs(plan, config)),
+        ])
+        try:
+            if not op.exists(self.path):
+                os.makedirs(self.path)
+            digests.save()
+        except (IOError, OSError) as exc:
+            lgr.warning("Failed to save digests under %s: %s", self.path, exc)
+        return hashlib.sha256(
+            json.dumps(key_data, sort_keys=True, default=repr)
+            .encode('utf-8')
+        ).hexdigest()
+
+    def _get_entry_path(self, key):
+        return opj(self.path, key[:2], key)
+
+    def restore(self, key, outdir):
+        """Stage cached outputs for the key into outdir
+
+        Returns
+        -------
+        bool
+          False if there were no outputs cached for the key
+        """
+        entry = self._get_entry_path(key)
+        if not op.isdir(entry):
+            lgr.debug("No cached results for %s", key)
+            return False
+        staged = []
+        try:
+            methods = _stage_tree(entry, outdir, staged)
+        except (IOError, OSError) as exc:
+            # e.g. entry was removed meanwhile, so the run should be redone
+            lgr.warning("Failed to restore outputs from the cache %s: %s",
+                        entry, exc)
+            for path in reversed(staged):
+                try:
+                    if op.isdir(path) and not op.islink(path):
+                        os.rmdir(path)
+                    else:
+                        os.unlink(path)
+                except OSError as exc:
+                    lgr.warning("Failed to remove %s: %s", path, exc)
+            return False
+        lgr.info("Restored outputs from the cache %s (via %s)",
+                 entry, ', '.join(sorted(methods)) or 'nothing')
+        return True
+
+    def store(self, key, outdir):
+        """Store outputs in outdir under the key"""
+        entry = self._get_entry_path(key)
+        if op.exists(entry):
+            return
+        topdir = op.dirname(entry)
+        try:
+            if not op.exists(topdir):
+                os.makedirs(topdir)
+            # so the entry appears only once complete
+            tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=topdir)
+            try:
+                _stage_tree(outdir, tmpdir)
+                os.rename(tmpdir, entry)
+            except Exception:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                raise
+        except (IOError, OSError) as exc:
+            # e.g. stored meanwhile by some other run, or cache is read-only
+            lgr.warning("Failed to cache outputs under %s: %s", entry, exc)
+            return
+        lgr.debug("Cached outputs under %s", entry)
+
+
+def _stage_tree(srcdir, dstdir, staged=None):
+    """Stage all files from srcdir under dstdir
+
+    Parameters
+    ----------
+    staged: list, optional
+      To append paths of the created directories and staged files to, as
+      they get created
+
+    Returns
+    -------
+    set
+      Staging methods used
+    """
+    methods = set()
+    if staged is None:
+        staged = []
+    for root, dnames, fnames in os.walk(srcdir, onerror=_raise):
+        dstroot = opj(dstdir, op.relpath(root, srcdir))
+        if not op.exists(dstroot):
+            os.makedirs(dstroot)
+            staged.append(dstroot)
+        for fname in fnames:
+            if fname == GEAR_METRICS_FILENAME:
+                continue  # of the particular run
+            dst = opj(dstroot, fname)
+            existed = op.lexists(dst)
+            try:
+                methods.add(stage_file(opj(root, fname), dst))
+            finally:
+                # even if failed, e.g. partially copied
+                if not existed and op.lexists(dst):
+                    staged.append(dst)
+    return methods
+
+
+def _raise(exc):
+    raise exc
+
+
 # TODO: this one is nipype specific -- so we might want to move it into nipype
-def run(manifest, config, indir, outdir):
+def run(manifest, config, indir, outdir, plan=None, input_files=None):
     """Given manifest, config, indir and outdir perform the execution
 
     Parameters
     ----------
     manifest
+      Could be None if plan is provided
     config
     indir
     outdir
+    plan: dict, optional
+      Runtime plan (see `create_plan`), created from the manifest if not
+      provided
+    input_files: dict, optional
+      input -> file to use.  See `get_interface`
 
     Returns
     -------
-
+    results of the interface run, or None if the outputs were restored from
+    the ResultsCache (if enabled via RESULTS_CACHE_ENVVAR)
     """
     # should we wrap it into a node?
     # it has .base_dir specification
-    interface = None
+    if plan is None:
+        plan = create_plan(manifest)
+    if input_files is None:
+        input_files = get_single_input_files(plan, indir)
+    cache = ResultsCache.from_env()
+    cache_key = None
+    restored = False
+    interface = out = None
+    failed, error = True, None
+    monitor = ResourceMonitor()
     # TODO: we could check if config corresponds to manifest.  If not
     # (e.g. parameter in config is not known to interface/manifest config),
     # then it seems that nipype blows with cryptic/unrelated error message
     try:
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)  # assure that exists
-        # output filename might be generated relative to PWD (e.g. in fsl BET)
-        # so we better cd to outdir while generating the interface
-        # and for the sake of it while running
-        with chpwd(outdir):
-            interface = get_interface(manifest, config, indir, outdir)
-            out = interface.run()
-    except Exception as exc:
-        lgr.error("Error while running %s: %s",
-                  interface, exc)
-        raise
+        with monitor:
+            try:
+                if not os.path.exists(outdir):
+                    os.makedirs(outdir)  # assure that exists
+                # output filename might be generated relative to PWD (e.g. in
+                # fsl BET) so we better cd to outdir while generating the
+                # interface and for the sake of it while running
+                with chpwd(outdir):
+                    interface = get_interface(
+                        manifest, config, indir, outdir,
+                        plan=plan, input_files=input_files)
+                    if cache:
+                        cache_key = cache.get_key(plan, interface, config,
+                                                  input_files)
+                        restored = cache.restore(cache_key, outdir)
+                    if not restored:
+                        out = interface.run()
+                if out is not None:
+                    _relocate_outputs(out, plan, indir, outdir)
+            except Exception as exc:
+                lgr.error("Error while running %s: %s",
+                          interface, exc)
+                error = "%s: %s" % (exc.__class__.__name__, exc)
+                raise
+            finally:
+                # Should we clean up anything??  may be some workdir
+                pass
+        failed = False
     finally:
-        # Should we clean up anything??  may be some workdir
-        pass
+        # resources used are of interest for the failed runs as well
+        metrics = monitor.get_metrics()
+        metrics['interface'] = plan['interface']
+        metrics['cached'] = restored
+        metrics['failed'] = failed
+        metrics['error'] = error
+        save_metrics(outdir, metrics)
+    if cache_key and not restored:
+        cache.store(cache_key, outdir)
+    return out
 
-    # Handle outputs
+
+def _relocate_outputs(out, plan, indir, outdir):
+    """Move outputs which were placed under indir into outdir"""
     # Some interfaces, e.g. fsl's FAST, would dump outputs within input directory
     # alongside original file.  So we need to move them under outdir
-    for output_field in out.outputs.traits():
+    # outputs might not be known for plans from manifests of old gears
+    for output_field in plan['outputs'] or out.outputs.traits():
         try:
             output_files = getattr(out.outputs, output_field)
         except AttributeError:
@@ -167,57 +626,176 @@ def run(manifest, config, indir, outdir):
     #     # But there is may be nothing really todo in our case?
     #     # May be some other interfaces would want to do something custom, we will
     #     # just save results
-    return out
 
 
-def get_interface(manifest, config, indir, outdir):
-    """Load/parametrize and return the interface given the spec
+def get_input_files(plan, indir):
+    """Return files provided for the inputs under indir
+
+    Returns
+    -------
+    OrderedDict
+      input -> sorted list of files, only for the inputs with files
+    """
+    input_files = OrderedDict()
+    for input_, input_params in plan['inputs'].items():
+        filenames = sorted(glob(opj(indir, input_, '*')))
+        if filenames:
+            input_files[input_] = filenames
+        elif not input_params.get('optional', False):
+            lgr.warning("No input for %s was provided", input_)
+    return input_files
+
+
+# Default regular expression to pair up inputs by BIDS entities
+BIDS_PAIR_BY = r'sub-[a-zA-Z0-9]+(_ses-[a-zA-Z0-9]+)?'
+
+
+def _strip_extensions(filename):
+    name = op.basename(filename)
+    return name.split('.', 1)[0] or name
+
+
+def get_input_sets(input_files, pair_by=None):
+    """Pair up files across the inputs to run the interface on in a batch
+
+    E.g. for input/anat/sub-{1,2,3}.nii, input/mask/common.nii and
+    input/func/sub-{1,2,3}_bold.nii there would be 3 sets, all using the
+    same mask.
 
     Parameters
     ----------
-    manifest
-    config
-    indir
-    outdir
+    input_files: dict
+      input -> list of files, as returned by `get_input_files`.  Inputs with
+      a single file are used in all the sets
+    pair_by: str, optional
+      Regular expression to pair up files by what it matches in their
+      names, e.g. BIDS_PAIR_BY.  By default files are paired up by their
+      sorted order, so all the inputs with multiple files must have the same
+      number of them
 
     Returns
     -------
-
+    list of (name, dict)
+      name (to be used for the output subdirectory) and input -> file for
+      each set
     """
-    manifest = get_manifest(manifest)
-    interface_cls = load_interface_from_manifest(manifest)
-    # Prepare all kwargs to initialize that class instance
-    kwargs = {}
-    # Parametrize it with configuration options
-    inputs = manifest.get('inputs', {})
-    manifest_config = manifest.get('config', {})
-    # tricky ones, yet to handle
-    # probably analyze what inputs are present, and assign correspondingly
-    for input_, input_params in inputs.items():
-        input_dir = opj(indir, input_)
-        filenames = None
-        if exists(input_dir):
-            filenames = glob(input_dir + '/*')
-            if len(filenames) > 1:
-                errorout("We do not speak multiple files yet per input")
-                # TODO -- wild ideas. Provide an option to pair up
-                # inputs.  E.g. if we have input/anatomy/sub{1,2,3}.nii,
-                # input/mask/common.nii, input/func/sub{1,2,3}.nii
-                # we could then loop nicely, and produce multiple outputs in the
-                # same run.  Is it practiced in any gear?
-            elif len(filenames) == 1:
-                filename = filenames[0]
-                kwargs[input_] = filename
-        if not filenames:
-            if not input_params.get('optional', False):
-                lgr.warning("No input for %s was provided", input_)
+    multi = [i for i, files in input_files.items() if len(files) > 1]
+    if not multi:
+        return [('', dict((i, f[0]) for i, f in input_files.items()))]
+    if pair_by:
+        regex = re.compile(pair_by)
+        keyed = OrderedDict()
+        for input_ in multi:
+            keyed[input_] = OrderedDict()
+            for f in input_files[input_]:
+                m = regex.search(op.basename(f))
+                if not m:
+                    raise ValueError(
+                        "%s of input %s does not match %r"
+                        % (op.basename(f), input_, pair_by))
+                if m.group(0) in keyed[input_]:
+                    raise ValueError(
+                        "Multiple files of input %s match %r as %s"
+                        % (input_, pair_by, m.group(0)))
+                keyed[input_][m.group(0)] = f
+        names = list(keyed[multi[0]])
+        for input_ in multi[1:]:
+            if set(keyed[input_]) != set(names):
+                raise ValueError(
+                    "Inputs %s and %s could not be paired up, differing: %s"
+                    % (multi[0], input_, ', '.join(sorted(
+                        set(keyed[input_]).symmetric_difference(names)))))
+        files = [[keyed[i][name] for name in names] for i in multi]
+    else:
+        counts = set(len(input_files[i]) for i in multi)
+        if len(counts) > 1:
+            raise ValueError(
+                "Inputs have different numbers of files: %s. Use --pair-by"
+                % ', '.join('%s: %d' % (i, len(input_files[i])) for i in multi))
+        files = [input_files[i] for i in multi]
+        names = list(map(_strip_extensions, files[0]))
+        if len(set(names)) != len(names):
+            names = ['%04d' % i for i in range(len(names))]
+    input_sets = []
+    for name, set_files in zip(names, zip(*files)):
+        input_set = dict((i, f[0]) for i, f in input_files.items())
+        input_set.update(zip(multi, set_files))
+        input_sets.append((name, input_set))
+    return input_sets
+
+
+def _run_input_set(args):
+    """Run the interface on an input set, as a job within a process pool"""
+    name, input_files, config, indir, outdir, plan = args
+    try:
+        out = run(None, config, indir, outdir, plan=plan,
+                  input_files=input_files)
+    except Exception as exc:
+        return name, "%s: %s" % (exc.__class__.__name__, exc)
+    lgr.info("Finished %s", name)
+    # results themselves could be too heavy/impossible to pickle
+    return name, None
 
-    # We do need to pass defaults from manifest since we might have
-    # provided custom ones
-    for c, v in manifest_config.items():
-        if 'default' in v:
-            kwargs[c] = v['default']
 
+def run_batch(config, indir, outdir, plan, pair_by=None, jobs=None):
+    """Run the interface on all the sets of inputs, in parallel processes
+
+    Outputs for each set (see `get_input_sets`) are placed under the
+    subdirectory of outdir named after the set, along with the metrics of
+    its run.  Those are also collected into the metrics file at the top of
+    outdir (see `save_batch_metrics`).
+
+    Parameters
+    ----------
+    jobs: int, optional
+      Number of processes to use.  By default as many as CPUs available
+      (within the cgroup quota of the container)
+
+    Returns
+    -------
+    dict
+      name -> error message, for the failed sets
+    """
+    start = time.time()
+    input_sets = get_input_sets(get_input_files(plan, indir), pair_by)
+    jobs = min(jobs or get_cpu_count(), len(input_sets))
+    lgr.info("Running on %d input sets using %d processes",
+             len(input_sets), jobs)
+    # so it gets imported only once, before the workers are forked
+    load_interface(plan['interface'])
+    args = [(name, input_files, config, indir, opj(outdir, name), plan)
+            for name, input_files in input_sets]
+    if jobs <= 1:
+        results = list(map(_run_input_set, args))
+    else:
+        import multiprocessing
+        # chpwd is needed for every run, so processes not threads
+        pool = multiprocessing.get_context('fork').Pool(jobs)
+        try:
+            results = pool.map(_run_input_set, args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    errors = dict((name, error) for name, error in results if error)
+    save_batch_metrics(outdir, [name for name, _ in input_sets], errors,
+                       time.time() - start)
+    return errors
+
+
+def get_single_input_files(plan, indir):
+    """Return input -> file, for the inputs provided with a (single) file"""
+    input_files = get_input_files(plan, indir)
+    for input_, filenames in input_files.items():
+        if len(filenames) > 1:
+            errorout(
+                "We do not speak multiple files (got %d for %s) per input "
+                "unless ran with --batch" % (len(filenames), input_))
+    return dict((i, f[0]) for i, f in input_files.items())
+
+
+def get_config_kwargs(plan, config):
+    """Return configuration of the interface: defaults with config on top"""
+    kwargs = OrderedDict(plan['defaults'])
     # Further configuration
     if config:
         for c, v in config.items():
@@ -228,6 +806,44 @@ def get_interface(manifest, config, indir, outdir):
             #         c, inputs.keys()
             #     )
             kwargs[c] = v
+    return kwargs
+
+
+def get_interface(manifest, config, indir, outdir, plan=None,
+                  input_files=None):
+    """Load/parametrize and return the interface given the spec
+
+    Parameters
+    ----------
+    manifest
+      Could be None if plan is provided
+    config
+    indir
+    outdir
+    plan: dict, optional
+      Runtime plan (see `create_plan`), created from the manifest if not
+      provided
+    input_files: dict, optional
+      input -> file to use.  By default the (single) files present under
+      indir are used
+
+    Returns
+    -------
+
+    """
+    if plan is None:
+        plan = create_plan(manifest)
+    interface_cls = load_interface(plan['interface'])
+    # Prepare all kwargs to initialize that class instance
+    kwargs = {}
+    # tricky ones, yet to handle
+    # probably analyze what inputs are present, and assign correspondingly
+    if input_files is None:
+        input_files = get_single_input_files(plan, indir)
+    for input_, filename in input_files.items():
+        kwargs[plan['inputs'][input_]['kwarg']] = filename
+
+    kwargs.update(get_config_kwargs(plan, config))
 
     # Treat None's which could be our annotation for not specifying any value
     # and resort to the default imposed by the tool
@@ -253,6 +869,34 @@ def get_interface(manifest, config, indir, outdir):
     return interface
 
 
+_RUN_HELP = """
+Batch mode
+ --batch: run on all the files provided for the inputs, paired up across
+  the inputs by their sorted order.  Inputs with a single file (e.g. a
+  common mask) are used for every run.  Outputs of each run are placed
+  into a subdirectory of the output directory, with metrics of the run.
+  Metrics of all the runs are collected at the top of the output directory
+ --pair-by REGEX: pair up files by what REGEX matches in their names, e.g.
+  %r for BIDS datasets
+ --jobs N: number of runs to perform in parallel.  By default as many as
+  CPUs available to the container
+
+Set %s environment variable to a directory to cache outputs in, so
+identical runs (the same inputs, config and versions) are not redone""" \
+    % (BIDS_PAIR_BY, RESULTS_CACHE_ENVVAR)
+
+
+def _get_option_value(option):
+    """Return value of the option (given as "option value" or "option=value")
+    """
+    for i, arg in enumerate(sys.argv):
+        if arg == option and i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+        if arg.startswith(option + '='):
+            return arg.split('=', 1)[1]
+    return None
+
+
 def main(*args, **kwargs):
     """The main "executioner" """
 
@@ -265,8 +909,13 @@ def main(*args, **kwargs):
     indir = op.abspath(opj(topdir, GEAR_INPUTS_DIR))
     outdir = op.abspath(opj(topdir, GEAR_OUTPUT_DIR))
 
-    # Load interface
-    manifest = load_json(opj(topdir, GEAR_MANIFEST_FILENAME))
+    # Load interface.  The manifest is needed only if there is no plan, or
+    # to be reported
+    plan = load_plan(topdir)
+    manifest = None
+    if plan is None or '--help' in sys.argv \
+            or '--print-manifest' in sys.argv:
+        manifest = load_json(opj(topdir, GEAR_MANIFEST_FILENAME))
     config_file = opj(topdir, GEAR_CONFIG_FILENAME)
     config = load_json(config_file).get('config', {}) \
         if os.path.exists(config_file) \
@@ -288,16 +937,14 @@ def main(*args, **kwargs):
                 print(" %s: %s" % (k, v.get('description', '')))
                 if c in ('Inputs', 'Config') and k in config:
                     print("  = %s" % config[k])
-
+        print(_RUN_HELP)
         return
 
     if '--print-manifest' in sys.argv:
-        import json
         print(json.dumps(manifest, indent=2))
         return
 
     if '--print-config' in sys.argv:
-        import json
         print(json.dumps(config, indent=2))
         return
 
@@ -309,7 +956,11 @@ def main(*args, **kwargs):
             if not skip_types or not isinstance(v, skip_types):
                 print(" %s: %s" % (k, v))
 
-    pprint_dict("Manifest", manifest, (int, tuple, dict))
+    if plan is None:
+        pprint_dict("Manifest", manifest, (int, tuple, dict))
+        plan = create_plan(manifest)
+    else:
+        pprint_dict("Plan", plan, (int, list, dict))
     pprint_dict("Config", config)
 
     # Paranoia
@@ -320,8 +971,26 @@ def main(*args, **kwargs):
             % ', '.join(outputs)
         )
 
+    if '--batch' in sys.argv:
+        jobs = _get_option_value('--jobs')
+        try:
+            errors = run_batch(
+                config, indir, outdir, plan,
+                pair_by=_get_option_value('--pair-by'),
+                jobs=int(jobs) if jobs else None)
+        except ValueError as exc:
+            errorout(str(exc))
+        if errors:
+            errorout("Failed on %d input set(s): %s" % (
+                len(errors),
+                '; '.join('%s: %s' % i for i in sorted(errors.items()))))
+        return
+
     print('\nRunning')
-    out = run(manifest, config, indir, outdir)
+    out = run(manifest, config, indir, outdir, plan=plan)
+    if out is None:
+        print("\nOutputs were restored from the cache")
+        return out
     # TODO: actually does not include skull file even though it is generated!
     print("\nOutputs: ")
     print(out.outputs)  # could be rendered better
@@ -2,32 +2,46 @@
 """
 
 import click
+import multiprocessing
 import re
 import sys
 import os
 import os.path as op
 import shutil
 import tempfile
+import traceback
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from os.path import join as opj
-from inspect import ismodule
 from itertools import chain
 
 from .gear import (
     run_gear_native, run_gear_docker, create_gear, docker_push_gear,
-    fw_upload_gear, copy_to_exchange
+    fw_upload_gear, copy_to_exchange, get_docker_image_id
 )
 from . import get_logger
-from .utils import import_module_from_file
+from .engine import LANE_LIMITS, set_lane_limits
+from .index import InterfaceIndex
+from .utils import (
+    DEFAULT_DIGEST,
+    import_module_from_file,
+    load_json,
+    parse_size,
+)
 from .consts import (
     GEAR_FLYWHEEL_DIR,
+    GEAR_MANIFEST_FILENAME,
     GEAR_OUTPUT_DIR,
 )
 
 lgr = get_logger('spec')
 
-from .spec_tests import _prepare, _check
+from .spec_tests import (
+    DIGESTS, STAGING_CHOICES, TEST_ORDERS, TestJob, run_test_jobs,
+    summarize_test_results
+)
 
 
 def load_spec(path):
@@ -97,7 +111,7 @@ def get_object_from_path(path, attr=None):
         path_split = path.rsplit('.', 1)
         topmod = None if len(path_split) == 1 else path_split[0]
         try:
-            mod = __import__(path, fromlist=[topmod])
+            mod = __import__(path, fromlist=[topmod] if topmod else [])
         except ImportError:
             # Might have been not a module
             attr_full = path_split[-1] if not attr else '.'.join([path_split[-1], attr])
@@ -124,9 +138,25 @@ def get_gear_dir(path):
     interest and convert into directories
     """
     # TODO: figure out a better/more reliable way
-    comps = filter(lambda p: p not in {"interfaces"},
-                   path.split('.'))
-    return op.join(comps)
+    return [p for p in path.split('.') if p not in {"interfaces"}]
+
+
+# How many gears a worker process generates before it gets replaced by a
+# fresh one, so memory consumed by importing (all of) the backend interfaces
+# does not keep growing
+GEARS_PER_WORKER = 20
+
+# A single unit of work for the _process_gear.  All fields must be picklable
+# so it could be passed to a worker process
+GearJob = namedtuple(
+    'GearJob',
+    ['toppath', 'gear_actions', 'params', 'outputdir',
+     'run_tests', 'run_tests_regex', 'run_testsdir', 'gear_options']
+)
+# Outcome of a GearJob.  status is one of 'ok', 'skip', 'error'.
+# test_jobs are the TestJob's to run for the gear
+GearResult = namedtuple(
+    'GearResult', ['toppath', 'status', 'message', 'test_jobs'])
 
 
 def _process(
@@ -137,15 +167,141 @@ def _process(
         run_tests_regex=None,
         run_testsdir=None,
         gear_actions=None,
+        gear_options=None,
+        jobs=1,
+        gears_per_worker=GEARS_PER_WORKER,
+        threads=1,
+        lane_limits=None,
+        test_jobs=1,
+        staging='auto',
+        digest=DEFAULT_DIGEST,
+        test_cache=True,
+        test_limits=None,
+        test_order='spec',
+        fail_fast=False,
+        results_cache=None,
+):
+    """Traverse the spec and process all the gears it leads to
+
+    Tests of the gears (if run_tests) are ran after all the gears are
+    processed.
+
+    Parameters
+    ----------
+    spec: dict
+    outputdir: str
+    regex: str, optional
+      Regular expression as to which paths to process
+    gear_actions: tuple of str
+      What actions to perform to the gear, known ones: ...
+    gear_options: dict, optional
+      Additional options to pass into create_gear
+    jobs: int, optional
+      Number of worker processes to process gears with.  Each process has
+      its own engine, so lane limits apply per process
+    gears_per_worker: int, optional
+      Number of gears after which a worker process gets replaced
+    threads: int, optional
+      Number of gears to process concurrently within a process.  External
+      commands they run are limited by the lanes of the engine
+    lane_limits: dict, optional
+      Maximal number of concurrently running commands per lane (e.g.
+      'build', 'push', 'test').  With jobs > 1 they apply to each of the
+      worker processes (tests are ran by the main process)
+    test_jobs: int, optional
+      Number of tests to run concurrently
+    staging: str, optional
+      How to stage test inputs.  See `utils.stage_file`
+    digest: str, optional
+      Algorithm to compare test outputs with by their digests
+    test_cache: bool, optional
+      Do not rerun tests which passed before for the same gear image (or
+      fingerprint for native runs), inputs and test spec
+    test_limits: dict, optional
+      Default resource limits for the test runs (walltime, memory, cpus),
+      which test specs could override
+    test_order: str, optional
+      Order to run the tests in.  See `spec_tests.get_test_jobs_order`
+    fail_fast: bool, optional
+      Do not start any test after some test fails
+    results_cache: str, optional
+      Directory to cache outputs of the interface runs of the gears in
+      while testing (see `run.ResultsCache`)
+
+    Returns
+    -------
+    list of GearResult
+    """
+    if lane_limits:
+        set_lane_limits(**lane_limits)
+    gear_jobs = []
+    index = InterfaceIndex()
+    _traverse(
+        gear_jobs,
+        index,
+        outputdir,
+        spec=spec,
+        regex=regex,
+        run_tests=run_tests,
+        run_tests_regex=run_tests_regex,
+        run_testsdir=run_testsdir,
+        gear_actions=gear_actions,
+        gear_options=gear_options,
+    )
+    index.save()
+    lgr.debug("Collected %d gear(s) to process", len(gear_jobs))
+    results = _run_gear_jobs(gear_jobs, jobs, gears_per_worker, threads)
+    failed = [r for r in results if r.status == 'error']
+    for r in failed:
+        lgr.error("%s FAILED: %s", r.toppath, r.message)
+
+    all_test_jobs = sum((r.test_jobs for r in results), [])
+    failed_tests = []
+    if all_test_jobs:
+        failed_tests = summarize_test_results(
+            run_test_jobs(all_test_jobs, test_jobs, staging, digest,
+                          use_cache=test_cache, limits=test_limits,
+                          order=test_order, fail_fast=fail_fast,
+                          results_cache=results_cache))
+
+    errors = []
+    if failed:
+        errors.append(
+            "%d out of %d gear(s) failed: %s"
+            % (len(failed), len(results),
+               ', '.join(r.toppath for r in failed)))
+    if failed_tests:
+        errors.append(
+            "%d out of %d test(s) failed" % (len(failed_tests), len(all_test_jobs)))
+    if errors:
+        raise RuntimeError('; '.join(errors))
+    return results
+
+
+def _traverse(
+        gear_jobs,
+        index,
+        outputdir,
+        spec=None,
+        regex=None,
+        run_tests=False,
+        run_tests_regex=None,
+        run_testsdir=None,
+        gear_actions=None,
+        gear_options=None,
         toppath=None,
         params={
             'recurse': False
         }
 ):
-    """
+    """Traverse the spec and collect GearJob's into gear_jobs
 
     Parameters
     ----------
+    gear_jobs: list
+      List to append GearJob's to
+    index: InterfaceIndex
+      Index to consult about the objects instead of importing them
     spec: dict
     outputdir: str
     regex: str, optional
@@ -174,16 +330,20 @@ def _process(
     # Get updated parameters
     new_params = get_updated(params, params_update)
 
-    obj = None
     # TODO: move all the tests harnessing outside, since it should be global
     # and not straight in here
     if toppath:
         # if points to a class we need to process.  If to a module, then depends
         # on recurse
         try:
-            obj = _process_gear(toppath, gear_actions, new_params,
-                                outputdir, regex, run_tests, run_tests_regex,
-                                run_testsdir)
+            _select_gear(toppath, new_params, outputdir, regex, index)
+            # %include was already applied and could be an unpicklable lambda
+            job_params = new_params.__class__(
+                (k, v) for k, v in new_params.items() if k != 'include')
+            gear_jobs.append(
+                GearJob(toppath, gear_actions, job_params, outputdir,
+                        run_tests, run_tests_regex, run_testsdir,
+                        gear_options or {}))
         except SkipProcessing as exc:
             lgr.debug("SKIP(%s) %s", str(exc)[:100].replace('\n', ' '), toppath)
 
@@ -193,51 +353,137 @@ def _process(
         if not path.startswith('%')
     }
 
-    if new_params['recurse'] and obj and ismodule(obj):
+    rec = index[toppath] if new_params['recurse'] and toppath else None
+    if rec and rec['module']:
         # we were instructed to recurse so we will consider each path
         # which leads to either an object or another sub-module
-        for attr in dir(obj):
-            if attr.startswith('_'):
-                continue
-            subobj = getattr(obj, attr)
-            subpath = '%s.%s' % (obj, attr)
-            if attr not in paths_to_recurse and \
-                (not ismodule(subobj) or
-                    (ismodule(subobj) and
-                     subobj.__name__.startswith(obj.__name__ + '.'))):
-                    lgr.debug("Adding %s", subpath)
-                    paths_to_recurse[attr] = {}   # no custom spec
+        for attr in rec['children']:
+            if attr not in paths_to_recurse:
+                lgr.debug("Adding %s.%s", toppath, attr)
+                paths_to_recurse[attr] = {}   # no custom spec
 
     # after that we can traverse recursively for anything which is not %param
     for path, pathspec in paths_to_recurse.items():
         new_path = '.'.join([toppath, path]) if toppath else path
 
-        _process(
+        _traverse(
+                gear_jobs,
+                index,
                 outputdir,
                 spec=pathspec,
                 regex=regex,
                 run_tests=run_tests,
                 run_tests_regex=run_tests_regex,
+                run_testsdir=run_testsdir,
                 gear_actions=gear_actions,
+                gear_options=gear_options,
                 toppath=new_path,
                 params=new_params
         )
 
 
-def _process_gear(toppath, gear_actions, params, outputdir, regex,
-                  run_tests, run_tests_regex, run_testsdir):
+def _run_gear_jobs(gear_jobs, jobs=1, gears_per_worker=GEARS_PER_WORKER,
+                   threads=1):
+    """Run _process_gear_job for each of gear_jobs, possibly in parallel
+
+    Results are returned in the order of gear_jobs regardless of the order
+    of their completion.
+    """
+    if (jobs > 1 or threads > 1) and len(gear_jobs) > 1:
+        from .utils import _sys_excepthook
+        if sys.excepthook != _sys_excepthook:
+            lgr.warning("Processing gears serially since we would need to "
+                        "fall into pdb on error")
+            jobs = threads = 1
+    if len(gear_jobs) <= 1 or (jobs <= 1 and threads <= 1):
+        return [_process_gear_job(job) for job in gear_jobs]
+
+    if jobs > 1:
+        if threads > 1:
+            lgr.warning("Ignoring threads=%d since processing using "
+                        "processes", threads)
+        lgr.info("Processing %d gears using %d processes",
+                 len(gear_jobs), jobs)
+        pool = multiprocessing.Pool(
+            min(jobs, len(gear_jobs)), maxtasksperchild=gears_per_worker)
+        try:
+            # chunksize=1 so maxtasksperchild is in the units of gears
+            return list(pool.imap(_process_gear_job, gear_jobs, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+
+    lgr.info("Processing %d gears using %d threads", len(gear_jobs), threads)
+    executor = ThreadPoolExecutor(min(threads, len(gear_jobs)))
+    try:
+        return list(executor.map(_process_gear_job, gear_jobs))
+    finally:
+        executor.shutdown()
+
+
+def _process_gear_job(job):
+    """Process a single GearJob, collecting any failure into GearResult
+
+    Re-imports the object (so it could run within a worker process) and
+    returns GearResult
+    """
+    try:
+        obj = get_object_from_path(job.toppath)
+        test_jobs = _process_gear(
+            obj, job.toppath, job.gear_actions, job.params, job.outputdir,
+            job.run_tests, job.run_tests_regex, job.run_testsdir,
+            job.gear_options)
+    except SkipProcessing as exc:
+        lgr.debug("SKIP(%s) %s", str(exc)[:100].replace('\n', ' '), job.toppath)
+        return GearResult(job.toppath, 'skip', str(exc), [])
+    except SyntaxError:
+        # some grave error -- blow
+        raise
+    except Exception as exc:
+        from .utils import _sys_excepthook
+        if sys.excepthook != _sys_excepthook:
+            raise
+        lgr.debug("Failed to process %s: %s", job.toppath,
+                  traceback.format_exc())
+        return GearResult(job.toppath, 'error',
+                          "%s: %s" % (exc.__class__.__name__, exc), [])
+    return GearResult(job.toppath, 'ok', None, test_jobs)
+
+
+def _select_gear(toppath, params, outputdir, regex, index):
+    """Return the index record if a gear should be produced for the toppath
+
+    Raises SkipProcessing otherwise.  The object gets imported only if
+    it is not in the index (or its record is stale), or if %include needs to
+    be evaluated on it.
+    """
     lgr.log(5, "Considering %s:", toppath)
-    obj = get_object_from_path(toppath)
     if regex and not re.search(regex, toppath):
         raise SkipProcessing("regex")
-    if 'include' in params and not params['include'](obj):
-        raise SkipProcessing("%%include")
-    if not obj.input_spec:
+    rec = index[toppath]
+    if rec['module']:
+        raise SkipProcessing("module")
+    if not rec['input_spec']:
         raise SkipProcessing("no input spec")
-    if not obj.output_spec:
+    if not rec['output_spec']:
         raise SkipProcessing("no output spec")
     if not outputdir:
         raise SkipProcessing("output_dir")
+    if 'include' in params \
+            and not params['include'](get_object_from_path(toppath)):
+        raise SkipProcessing("%%include")
+    return rec
+
+
+def _process_gear(obj, toppath, gear_actions, params, outputdir,
+                  run_tests, run_tests_regex, run_testsdir, gear_options=None):
+    """Create the gear and perform gear_actions on it
+
+    Returns
+    -------
+    list of TestJob
+      Tests to be ran for the gear
+    """
     # relative within hierarchy
     geardir = opj(*get_gear_dir(toppath))
     # full output path
@@ -250,12 +496,15 @@ def _process_gear(toppath, gear_actions, params, outputdir, regex,
                 gearpath,
                 # Additional fields for the
                 manifest_fields=params.get('manifest', {}),
-                build_docker=gear_actions != "spec",  # For now
+                build_docker='spec' not in gear_actions,  # For now
                 dummy='dummy' in gear_actions,
-                **params.get('params', {})
+                **dict(params.get('params', {}), **(gear_options or {}))
             )
             docker_image = gear_report["docker_image"]
-            lgr.info("%s gear generated", toppath)
+            if gear_report.get('skipped'):
+                lgr.info("%s gear is up to date", toppath)
+            else:
+                lgr.info("%s gear generated", toppath)
         except SyntaxError:
             # some grave error -- blow
             raise
@@ -267,8 +516,12 @@ def _process_gear(toppath, gear_actions, params, outputdir, regex,
         #     raise SkipProcessing("ERROR happened: %s" % str(e))
     elif op.exists(gearpath):
         lgr.info("Processing %s:", toppath)
+        if 'docker-push' in gear_actions or (
+                run_tests == 'gear' and glob(opj(gearpath, 'tests', '*.yaml'))):
+            docker_image = get_existing_docker_image(gearpath)
     else:
         raise SkipProcessing("Gear is not built and there is no gear directory")
+    test_jobs = []
     if run_tests != "skip":
         # TODO Move away and generalize
         testspath = op.join(gearpath, 'tests')
@@ -279,73 +532,50 @@ def _process_gear(toppath, gear_actions, params, outputdir, regex,
             lgr.info(" TESTS: found %d tests", len(tests))
         for itest, test in enumerate(sorted(tests)):
             testname = op.splitext(op.basename(test))[0]
-            testmsg = "  test #%d: %s" % (itest + 1, testname)
             if run_tests_regex:
                 if not re.match(run_tests_regex, testname):
-                    lgr.info(testmsg + " skipped")
+                    lgr.info("  test #%d: %s skipped", itest + 1, testname)
                     continue
-            lgr.debug("  running" + testmsg)
-            # TODO: Redo all the below to just use one of the runners
-            # such as pytest internally
-            try:
-                if run_testsdir is not None:
-                    testdir = tempfile.mkdtemp(prefix='gf_test-%d_' % itest)
-                else:
-                    # create one under outputdir replicating testspath hierarchy
-                    testdir = op.join(
-                        params['path'], 'tests-run', geardir, testname)
-                    if op.exists(testdir):
-                        shutil.rmtree(testdir)
-
-                _prepare(test, testdir)
-
-                if run_tests == 'native':
-                    run_gear_native(gearpath, testdir)
-                elif run_tests == 'gear':
-                    if not gear_report:
-                        raise ValueError("-g option must not be 'skip-build'")
-                    run_gear_docker(docker_image, testdir)
-                    # change ownership back from root on output directory
-                    # Redone via uid:gid mapping into Docker container
-                    # and making all needed components readable with changes
-                    # to Dockerfile
-                    # run_gear_docker(docker_image, testdir,
-                    #                 ["chown", "-R", os.getuid(),
-                    #                  "%s/%s" % (GEAR_FLYWHEEL_DIR,
-                    # GEAR_OUTPUT_DIR)])
-                else:
-                    raise ValueError(run_tests)
-
-                _check(test, testdir)
-                #  verify correspondence of # of files with target outputs
-                #  run the tests specified in tests.yaml if any, if none -
-                #  assume that they all must be identical
-                lgr.info(testmsg + " passed")
-            except Exception as exc:
-                # for now pdb on generic --pdb if there was some setup
-                lgr.error(testmsg + " FAILED: %s", exc)
-                from .utils import _sys_excepthook
-                if sys.excepthook != _sys_excepthook:
-                    # TODO: we could call out to sys.excepthook with
-                    #   (type, value, tb) details instead of reraising
-                    #  that should allow to proceed after pdb session
-                    raise
-            finally:
-                # TODO shutil.rmtree(testdir)
-                import os
-                # os.system("ls -lRa %s/*" % testdir)
-                pass
-        pass
+            if run_testsdir is not None:
+                # each test gets its own directory, so they could run
+                # concurrently
+                if not op.exists(run_testsdir):
+                    os.makedirs(run_testsdir)
+                testdir = tempfile.mkdtemp(
+                    prefix='gf_test-%d_' % itest, dir=run_testsdir)
+            else:
+                # create one under outputdir replicating testspath hierarchy
+                testdir = op.join(
+                    params['path'], 'tests-run', geardir, testname)
+            test_jobs.append(
+                TestJob(toppath, testname, test, testdir, gearpath,
+                        run_tests, docker_image))
     if 'docker-push' in gear_actions:
-        if not gear_report:
-            raise ValueError("-g option must not be 'skip-build'")
         docker_push_gear(docker_image)
     if 'fw-upload' in gear_actions:
         fw_upload_gear(gearpath)
     if 'exchange' in gear_actions:
         for exchange in glob(opj(outputdir, '..', 'exchanges', '*')):
             copy_to_exchange(gearpath, exchange)
-    return obj
+    return test_jobs
+
+
+def get_existing_docker_image(gearpath):
+    """Return docker image of the previously generated gear
+
+    Raises
+    ------
+    SkipProcessing
+      if the manifest does not specify it or there is no such image locally
+    """
+    manifest = load_json(opj(gearpath, GEAR_MANIFEST_FILENAME), must_exist=False)
+    docker_image = manifest.get('custom', {}).get('docker-image')
+    if not docker_image:
+        raise SkipProcessing("No docker image is specified in the gear manifest")
+    if not get_docker_image_id(docker_image):
+        raise SkipProcessing(
+            "Docker image %s is not present, build it first" % docker_image)
+    return docker_image
 
 
 # CLI
@@ -378,6 +608,64 @@ def grp():
 #               help='Either actually build a docker image. "dummy" would generate'
 #                    ' a minimalistic image useful for quick upload to test '
 #                    'web UI')
+@click.option('--shared-base', is_flag=True,
+              help='Build gear images as thin layers on top of a base image '
+                   'shared among all gears of the backend')
+@click.option('--force', is_flag=True,
+              help='Regenerate (and rebuild) gears even if their fingerprints '
+                   'did not change')
+@click.option('--reuse-images', is_flag=True,
+              help='Do not rebuild gear images if present images were built '
+                   'from the same build context (as recorded in their label)')
+@click.option('-j', '--jobs', type=click.IntRange(1), default=1,
+              help='Number of processes to generate gears with.  Each '
+                   'process limits its external commands on its own, so '
+                   'could not be combined with --lane (use --threads)')
+@click.option('--gears-per-worker', type=click.IntRange(1),
+              default=GEARS_PER_WORKER,
+              help='Number of gears after which a worker process gets '
+                   'replaced with a fresh one to bound its memory use')
+@click.option('--threads', type=click.IntRange(1), default=1,
+              help='Number of gears to process concurrently within a '
+                   'process.  External commands they run (builds, pushes, '
+                   'etc) are limited per lane (see --lane)')
+@click.option('--lane', 'lanes', multiple=True, metavar='NAME=N',
+              help='Maximal number of concurrently running commands in a lane. '
+                   'Known lanes: %s' % ', '.join(
+                       '%s (default %d)' % i for i in sorted(LANE_LIMITS.items())))
+@click.option('--test-jobs', type=click.IntRange(1), default=1,
+              help='Number of tests to run concurrently, after all the gears '
+                   'are processed')
+@click.option('--staging', type=click.Choice(STAGING_CHOICES), default='auto',
+              help='How to stage test inputs: "auto" hardlinks if possible, '
+                   'then tries to reflink, and copies only as the last resort.  '
+                   '"symlink"ed inputs are bind-mounted read-only into gears')
+@click.option('--digest', type=click.Choice(DIGESTS), default=DEFAULT_DIGEST,
+              help='Digest to compare test outputs without dedicated '
+                   'comparison by.  Digests of target outputs are cached')
+@click.option('--no-test-cache', 'test_cache', is_flag=True, default=True,
+              flag_value=False,
+              help='Rerun tests even if they passed before for the same gear '
+                   'image, inputs and test spec')
+@click.option('--order', 'test_order', type=click.Choice(TEST_ORDERS),
+              default='spec',
+              help='Order to run the tests in.  "failed-first" and '
+                   '"fastest-first" use outcomes and durations of the past '
+                   'test runs')
+@click.option('--fail-fast', is_flag=True,
+              help='Do not start any test after some test fails')
+@click.option('--test-walltime', type=click.FloatRange(0), default=None,
+              help='Default limit (in seconds) on the duration of a test run. '
+                   'The gear (its processes or container) is killed and the '
+                   'test is marked as timed out upon reaching it')
+@click.option('--test-memory', default=None, metavar='SIZE',
+              help='Default memory limit for a test run, e.g. 4G')
+@click.option('--test-cpus', type=click.FloatRange(0), default=None,
+              help='Default number of CPUs a test run could use')
+@click.option('--results-cache', type=click.Path(file_okay=False),
+              help='Directory to cache outputs of the interface runs in while '
+                   'testing, so identical runs (e.g. of the rebuilt gears) '
+                   'are not redone.  Mounted into the gear containers')
 @click.option('--run-testsdir', help='Directory, under which run the tests. If none provided, will be tests-runs/ under outputdir')
 @click.option('-o', '--outputdir', help='Output directory, to not place under gears/ alongside the spec')
 @click.argument('inputdir') # , help='Directory with the spec.py and tests/, ...')
@@ -385,6 +673,13 @@ def process(
         inputdir,
         outputdir=None,  # if none provided -- nothing would be saved
         run_testsdir=None,
+        shared_base=False,
+        force=False,
+        reuse_images=False,
+        lanes=(),
+        test_walltime=None,
+        test_memory=None,
+        test_cpus=None,
         **kwargs
 ):
     """Load and process the spec
@@ -407,7 +702,32 @@ def process(
     Recommended to keep inputs/ and tests output directories content under
     git-annex to minimize storage requirement etc
     """
+    lane_limits = {}
+    if kwargs['test_jobs'] > LANE_LIMITS['test']:
+        # so the lane does not throttle the tests
+        lane_limits['test'] = kwargs['test_jobs']
+    if lanes and kwargs['jobs'] > 1:
+        raise click.UsageError(
+            "--lane could not be used with --jobs since lane limits apply "
+            "per process.  Use --threads to process gears concurrently "
+            "within a single process")
+    for lane in lanes:
+        name, _, limit = lane.partition('=')
+        if not limit.isdigit() or not int(limit):
+            raise click.BadParameter(
+                "%r must be NAME=N with N > 0" % lane, param_hint='--lane')
+        lane_limits[name] = int(limit)
+    try:
+        test_memory = parse_size(test_memory)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--test-memory')
+    test_limits = {'walltime': test_walltime, 'memory': test_memory,
+                   'cpus': test_cpus}
     spec = load_spec(inputdir)
     if outputdir is None:
         outputdir = op.join(inputdir, 'gears')
-    return _process(outputdir, spec=spec, run_testsdir=run_testsdir, **kwargs)
+    return _process(outputdir, spec=spec, run_testsdir=run_testsdir,
+                    gear_options={'shared_base': shared_base, 'force': force,
+                                  'reuse_image': reuse_images},
+                    lane_limits=lane_limits, test_limits=test_limits,
+                    **kwargs)
@@ -8,31 +8,148 @@ __author__ = 'yoh'
 __license__ = 'MIT'
 
 import click
+import fnmatch
+import gzip
+import hashlib
+import io
 import yaml
 import json
 import os
 import os.path as op
 import re
 import shutil
+import stat
+import sys
+import threading
+import time
+import traceback
 
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import islice
+
+from . import __version__
 from .cli_base import cli
 from .consts import \
-    GEAR_INPUTS_DIR, GEAR_OUTPUT_DIR, GEAR_MANIFEST_FILENAME
+    GEAR_INPUTS_DIR, GEAR_OUTPUT_DIR, GEAR_MANIFEST_FILENAME, \
+    GEAR_FINGERPRINT_FILENAME, GEAR_METRICS_FILENAME
+from .exceptions import CommandTimeout
+from .gear import get_docker_image_id, run_gear_native, run_gear_docker
 from .utils import (
-    md5sum,
-    PathRoot
+    DEFAULT_DIGEST,
+    DIGEST_CHUNK_SIZE,
+    dump_json,
+    file_digest,
+    get_cache_dir,
+    get_digest_cache,
+    JsonStore,
+    load_json,
+    parse_size,
+    PathRoot,
+    stage_file,
+    STAGING_METHODS,
+    write_if_changed,
 )
 
 from . import get_logger
 lgr = get_logger('spec_tests')
 
+# A single test to run.  testdir is the directory (must be unique among
+# all the jobs) to run the test in
+TestJob = namedtuple(
+    'TestJob',
+    ['toppath', 'testname', 'testfile', 'testdir', 'gearpath', 'run_tests',
+     'docker_image']
+)
+# Outcome of a TestJob.  status is one of 'passed', 'cached' (passed before),
+# 'failed', 'timed-out' (killed upon reaching the walltime limit), 'skipped'
+# (not ran since some other test failed, see run_test_jobs' fail_fast)
+# staging is the set of methods inputs were staged with
+TestResult = namedtuple(
+    'TestResult',
+    ['toppath', 'testname', 'status', 'message', 'duration', 'staging'])
+# Fingerprints of the target outputs, if stored instead of the outputs
+TEST_FINGERPRINT_SUFFIX = '.fingerprint.json'
+TEST_FINGERPRINT_VERSION = 3
+# Choices for digests to compare files by
+DIGESTS = ('blake2b', 'md5', 'sha1', 'sha256')
+# Choices for the staging of test inputs
+STAGING_CHOICES = ('auto', 'symlink') + STAGING_METHODS
+# Files produced by the runtime about the run, not to be compared wherever
+# within the outputs (e.g. in the subdirectories of batch runs)
+IGNORED_OUTPUTS = frozenset([GEAR_METRICS_FILENAME])
+# Orders to run the tests in.  'spec' is the order tests were collected in
+TEST_ORDERS = ('spec', 'failed-first', 'fastest-first')
+# Resource limits which could be specified for the test run, in the 'limits'
+# section of the test spec: walltime (seconds), memory (bytes, or e.g. '4G'),
+# cpus (number of, could be fractional for docker runs)
+TEST_LIMITS = ('walltime', 'memory', 'cpus')
+
 # This one doesn't allow to look for a specific dataset... TODO
 find_datasets_path = PathRoot(lambda s: op.exists(op.join(s, 'inputs')))
 
 
-def _prepare(testfile, outputdir):
+def get_test_inputs(testfile, test_spec):
+    """Return input name -> path of the input file, for the test spec"""
+    datasets_path = find_datasets_path(testfile)
+    if not datasets_path:
+        raise RuntimeError("Did not find 'inputs/' directory with datasets")
+    datasets_path = op.join(datasets_path, 'inputs')
+    lgr.debug(" considering datasets under %s", datasets_path)
+    inputs = OrderedDict()
+    for in_name, in_file in test_spec.get('inputs').items():
+        if '/' not in in_file:
+            raise ValueError("input file (got %r) is missing a path" % in_file)
+        inputs[in_name] = op.join(datasets_path, in_file)
+    return inputs
+
+
+def get_test_limits(test_spec, defaults=None):
+    """Return resource limits for the test run
+
+    Limits from the 'limits' section of the test spec override the defaults.
+    See TEST_LIMITS for the known ones.  Limits which are not set (or set to
+    None/0 in the spec) are not included
+
+    Returns
+    -------
+    dict
+    """
+    limits = dict(defaults or {})
+    spec_limits = test_spec.get('limits') or {}
+    unknown = set(spec_limits).difference(TEST_LIMITS)
+    if unknown:
+        raise ValueError(
+            "Unknown test limit(s) %s. Known are: %s"
+            % (', '.join(sorted(unknown)), ', '.join(TEST_LIMITS)))
+    limits.update(spec_limits)
+    if limits.get('walltime'):
+        limits['walltime'] = float(limits['walltime'])
+    if limits.get('memory'):
+        limits['memory'] = parse_size(limits['memory'])
+    if limits.get('cpus'):
+        limits['cpus'] = float(limits['cpus'])
+    return dict((k, v) for k, v in limits.items() if v)
+
+
+def _prepare(testfile, outputdir, staging='auto'):
+    """Prepare outputdir to run the test: stage inputs, generate config.json
+
+    Parameters
+    ----------
+    testfile: str
+    outputdir: str
+    staging: str, optional
+      How to stage input files.  See `utils.stage_file`
+
+    Returns
+    -------
+    dict
+      input name -> staging method used for it
+    """
     with open(testfile) as f:
-        test_spec = yaml.load(f)
+        test_spec = yaml.safe_load(f)
     lgr.debug("Loaded test spec: %s", test_spec)
     # TODO: validate test schema
     # we will allow to override for now
@@ -44,25 +161,20 @@ def _prepare(testfile, outputdir):
         if not os.path.exists(str(d)):
             os.makedirs(str(d))
 
-    # Copy inputs
-    lgr.debug(" copying inputs")
-    datasets_path = find_datasets_path(testfile)
-    if not datasets_path:
-        raise RuntimeError("Did not find 'inputs/' directory with datasets")
-    datasets_path = op.join(datasets_path, 'inputs')
-    lgr.debug(" considering datasets under %s", datasets_path)
-    for in_name, in_file in test_spec.get('inputs').items():
-        if '/' not in in_file:
-            raise ValueError("input file (got %r) is missing a path" % in_file)
-        in_dataset, in_dataset_path = in_file.split('/', 1)
-        in_path = op.join(datasets_path, in_file)
-        # copy under inputs/in_name/basename(in_file)
+    # Stage inputs
+    lgr.debug(" staging inputs")
+    staged = {}
+    for in_name, in_path in get_test_inputs(testfile, test_spec).items():
+        # stage under inputs/in_name/basename(in_file)
         dst_dir = op.join(gear_indir, in_name)
-        dst_path = op.join(dst_dir, op.basename(in_dataset_path))
+        dst_path = op.join(dst_dir, op.basename(in_path))
         if not op.exists(dst_dir):
             os.makedirs(dst_dir)
-        lgr.debug(" copying %s to %s", in_path, dst_path)
-        shutil.copyfile(in_path, dst_path)
+        if op.lexists(dst_path):
+            os.unlink(dst_path)
+        staged[in_name] = stage_file(in_path, dst_path, staging)
+        lgr.debug(" staged %s to %s via %s",
+                  in_path, dst_path, staged[in_name])
 
     # Generate config
     lgr.debug(" generating config.json")
@@ -78,93 +190,1168 @@ def _prepare(testfile, outputdir):
         )
 
     # Copy manifest.json for the gear should happen outside
+    return staged
+
+
+# Metadata of a file collected while scanning a tree.  Any field could be
+# None if not known (e.g. for targets known only by their fingerprints)
+FileInfo = namedtuple('FileInfo', ['size', 'mode', 'dev', 'ino'])
+# An entry of the tree diff.  status is one of
+#  'only-in-target', 'only-in-output' - present only in one of the trees
+#  'type' - types (regular file, symlink to a directory, ...) differ
+#  'size' - sizes differ (decided only for the files compared bytewise)
+#  'same' - the same file (e.g. hardlinked)
+#  'compare' - content needs to be compared
+TreeDiff = namedtuple('TreeDiff', ['path', 'status', 'target', 'output'])
+
+
+def scan_tree(topdir):
+    """Yield (relpath, FileInfo) for all but directories under topdir
+
+    A single pass via os.scandir, which on most systems provides the
+    type of an entry without a stat call.  Symlinks are followed (but not
+    descended into if pointing to directories).
+    """
+    dirs = ['']
+    while dirs:
+        reldir = dirs.pop()
+        with os.scandir(op.join(topdir, reldir)) as entries:
+            entries = list(entries)
+        for entry in entries:
+            relpath = op.join(reldir, entry.name) if reldir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(relpath)
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # broken symlink
+                st = entry.stat(follow_symlinks=False)
+            yield relpath, FileInfo(
+                st.st_size, st.st_mode, st.st_dev, st.st_ino)
 
 
 def get_files(d):
-    r = []
-    for path, dnames, fnames in os.walk(d):
-        # Relative to d path
-        dname = op.relpath(path, d)
-        r.extend([op.join(dname, f) for f in fnames])
-    return set(r)
-
-
-def check_nib_diff(target, output):
-    from nibabel.cmdline.diff import diff
-    nib_diff = diff([target, output])
-    if nib_diff:
-        diffs = [
-            "%10s: %s != %s" % (k, str(v1), str(v2))
-            for k, (v1, v2) in nib_diff.items()
-        ]
-        diffs = (os.linesep + "  ").join([''] + diffs)
-        return "nibabel diff (target, output):%s" % diffs
+    return set(relpath for relpath, _ in scan_tree(d))
+
+
+def diff_trees(target_infos, outputdir, bytewise=None):
+    """Yield TreeDiff's between the target files and the ones under outputdir
+
+    Decisions which could be made from the metadata alone are made without
+    reading any content.  Entries are yielded while scanning outputdir,
+    and the ones present only in the target at the end.  IGNORED_OUTPUTS
+    are not considered.
+
+    Parameters
+    ----------
+    target_infos: dict
+      relpath -> FileInfo of the target files
+    outputdir: str
+    bytewise: callable, optional
+      Given relpath, returns True if the content must be identical bytewise,
+      so a difference in size is sufficient to decide that files differ
+    """
+    seen = set()
+    for relpath, output_info in scan_tree(outputdir):
+        if op.basename(relpath) in IGNORED_OUTPUTS:
+            continue
+        seen.add(relpath)
+        target_info = target_infos.get(relpath)
+        if target_info is None:
+            status = 'only-in-output'
+        elif target_info.mode is not None \
+                and stat.S_IFMT(target_info.mode) \
+                != stat.S_IFMT(output_info.mode):
+            status = 'type'
+        elif target_info.ino is not None \
+                and (target_info.dev, target_info.ino) \
+                == (output_info.dev, output_info.ino):
+            status = 'same'
+        elif target_info.size is not None \
+                and target_info.size != output_info.size \
+                and bytewise and bytewise(relpath):
+            status = 'size'
+        else:
+            status = 'compare'
+        yield TreeDiff(relpath, status, target_info, output_info)
+    for relpath in sorted(set(target_infos) - seen):
+        if op.basename(relpath) in IGNORED_OUTPUTS:
+            continue
+        yield TreeDiff(relpath, 'only-in-target', target_infos[relpath], None)
+
+
+def get_test_fingerprint_path(testfile):
+    """Return path to the file with fingerprints of the target outputs"""
+    return op.splitext(testfile)[0] + TEST_FINGERPRINT_SUFFIX
+
+
+def get_nifti_summary(path):
+    """Return summary of the NIfTI file header"""
+    import nibabel as nib
+    return _get_nifti_header(nib.load(path))
+
+
+# Header fields which are compared as a part of the summary (shape, dtype)
+# or describe the layout of the file rather than the image
+NIFTI_HEADER_SKIP_FIELDS = frozenset([
+    'sizeof_hdr', 'magic', 'dim', 'datatype', 'bitpix', 'vox_offset'])
+# Header fields defining the geometry (with zooms and affine), compared
+# within header_atol of the tolerances
+NIFTI_HEADER_GEOMETRY_FIELDS = frozenset([
+    'pixdim', 'quatern_b', 'quatern_c', 'quatern_d',
+    'qoffset_x', 'qoffset_y', 'qoffset_z', 'srow_x', 'srow_y', 'srow_z'])
+
+
+def _get_header_value(value):
+    import numpy as np
+    value = np.asarray(value)
+    if value.dtype.kind == 'S':
+        return value.tolist().decode('latin-1')
+    return value.tolist()
+
+
+def _get_nifti_header(img):
+    header = img.header
+    return OrderedDict([
+        ('shape', [int(i) for i in img.shape]),
+        ('dtype', str(header.get_data_dtype())),
+        ('zooms', [float(z) for z in header.get_zooms()]),
+        ('affine', [[float(v) for v in row] for row in img.affine]),
+        ('fields', OrderedDict(
+            (k, _get_header_value(header[k])) for k in header.keys()
+            if k not in NIFTI_HEADER_SKIP_FIELDS)),
+    ])
+
+
+def _is_same_header_value(target, output, atol=0):
+    """Compare header values, NaNs are considered equal"""
+    import numpy as np
+    if isinstance(target, str) or isinstance(output, str):
+        return target == output
+    target, output = np.asarray(target, float), np.asarray(output, float)
+    return target.shape == output.shape \
+        and np.allclose(target, output, rtol=0, atol=atol, equal_nan=True)
+
+
+def _get_nifti_header_diffs(target, output, tolerances=None):
+    """Return differences between the NIfTI header summaries
+
+    Geometry (zooms, affine and the fields defining them) is compared within
+    header_atol of the tolerances (see NIFTI_TOLERANCES), and the other
+    fields, but the ones listed in ignore_header, exactly.
+    """
+    tolerances = dict(NIFTI_TOLERANCES, **(tolerances or {}))
+    atol = tolerances['header_atol']
+    same_shape = target['shape'] == output['shape']
+    diffs = [
+        "%10s: %s != %s" % (field, target[field], output[field])
+        for field, same in (
+            ('shape', same_shape),
+            ('dtype', target['dtype'] == output['dtype']),
+            ('zooms', same_shape and _is_same_header_value(
+                target['zooms'], output['zooms'], atol)),
+            ('affine', _is_same_header_value(
+                target['affine'], output['affine'], atol)),
+        )
+        if not same
+    ]
+    target_fields, output_fields = target['fields'], output['fields']
+    for field in target_fields:
+        if field in tolerances['ignore_header']:
+            continue
+        if not _is_same_header_value(
+                target_fields[field], output_fields.get(field),
+                atol if field in NIFTI_HEADER_GEOMETRY_FIELDS else 0):
+            diffs.append("%10s: %s != %s" % (
+                field, target_fields[field], output_fields.get(field)))
+    return diffs
+
+
+def get_nifti_stats(path, algorithm=DEFAULT_DIGEST):
+    """Return statistics of the voxel values of the NIfTI file
+
+    Those allow to compare voxel values within tolerances (see
+    check_fingerprint) in the absence of the file: digest of the (scaled)
+    values, number of non-finite values, and min, max, mean and standard
+    deviation of the finite ones.  Data is read slab by slab, as in
+    check_nifti.
+    """
+    import numpy as np
+    digest = hashlib.new(algorithm)
+    n = nonfinite = 0
+    mean = m2 = 0.
+    vmin = vmax = None
+    with _open_nifti(path) as img:
+        for slab in _iter_slabs(img.shape):
+            v = np.asarray(img.dataobj[slab], dtype=np.float64).ravel()
+            digest.update(v.tobytes())
+            finite = np.isfinite(v)
+            nonfinite += int(v.size - finite.sum())
+            v = v[finite]
+            if not v.size:
+                continue
+            slab_mean = v.mean()
+            slab_m2 = ((v - slab_mean) ** 2).sum()
+            total = n + v.size
+            delta = slab_mean - mean
+            m2 += slab_m2 + delta * delta * float(n) * v.size / total
+            mean += delta * v.size / total
+            n = total
+            vmin = v.min() if vmin is None else min(vmin, v.min())
+            vmax = v.max() if vmax is None else max(vmax, v.max())
+    return OrderedDict([
+        ('digest', digest.hexdigest()),
+        ('nonfinite', nonfinite),
+        ('min', None if vmin is None else float(vmin)),
+        ('max', None if vmax is None else float(vmax)),
+        ('mean', float(mean) if n else None),
+        ('std', (m2 / n) ** 0.5 if n else None),
+    ])
+
+
+def _get_gz_digest(path, algorithm):
+    """Digest of the decompressed content, which unlike the compressed one
+    does not depend on e.g. the timestamp in the header"""
+    digest = hashlib.new(algorithm)
+    with gzip.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_nifti(path):
+    return path.endswith('.nii') or path.endswith('.nii.gz')
+
+
+def get_file_fingerprint(path, digest=DEFAULT_DIGEST):
+    """Return fingerprint of the file: its size and digest
+
+    For .gz files those are of the decompressed content.  NIfTI files are
+    fingerprinted by the summary of the header and statistics of the voxel
+    values (see get_nifti_stats), so they could be compared within the
+    tolerances.
+    """
+    rec = OrderedDict()
+    if _is_nifti(path):
+        rec['nifti'] = get_nifti_summary(path)
+        rec['stats'] = get_nifti_stats(path, digest)
+    elif path.endswith('.gz'):
+        rec['digest'] = _get_gz_digest(path, digest)
+    else:
+        rec['size'] = os.stat(path).st_size
+        rec['digest'] = file_digest(path, digest)
+    return rec
+
+
+def get_outputs_fingerprint(outputdir, digest=DEFAULT_DIGEST):
+    """Return fingerprint of all the files under outputdir"""
+    return OrderedDict([
+        ('version', TEST_FINGERPRINT_VERSION),
+        ('digest', digest),
+        ('files', OrderedDict(
+            (f, get_file_fingerprint(op.join(outputdir, f), digest))
+            for f in sorted(get_files(outputdir))
+            if op.basename(f) not in IGNORED_OUTPUTS)),
+    ])
+
+
+def _get_nifti_stats_diffs(target, output, tolerances):
+    """Return differences between the statistics of NIfTI voxel values
+
+    Any of the statistics of the output could not deviate more than a
+    single voxel value is allowed to (within atol + rtol * max |target|),
+    if the values are to match within the tolerances.  So it is a necessary
+    (but not sufficient) condition for check_nifti to pass.
+    """
+    if target['digest'] == output['digest']:
+        return []
+    atol, rtol = tolerances['atol'], tolerances['rtol']
+    if not (atol or rtol):
+        return ["%10s: %s != %s" % ('digest', target['digest'],
+                                    output['digest'])]
+    diffs = []
+    if target['nonfinite'] != output['nonfinite']:
+        diffs.append("%10s: %s != %s" % (
+            'nonfinite', target['nonfinite'], output['nonfinite']))
+    if target['min'] is None or output['min'] is None:
+        return diffs
+    tol = atol + rtol * max(abs(target['min']), abs(target['max']))
+    for field in 'min', 'max', 'mean', 'std':
+        if not abs(output[field] - target[field]) <= tol:
+            diffs.append("%10s: %s != %s" % (
+                field, target[field], output[field]))
+    return diffs
+
+
+def check_fingerprint(target, output, digest=DEFAULT_DIGEST, tolerances=None):
+    """Compare the output file against the fingerprint of the target
+
+    Cheaper checks (size, NIfTI header) are done first, so the digest is
+    computed only if they pass.  Voxel values of NIfTI files are compared
+    by their statistics within the tolerances (see NIFTI_TOLERANCES).  As
+    for check_nifti, they must be identical unless atol or rtol is set.
+    min_corr could not be checked against a fingerprint.
+    """
+    if 'size' in target:
+        size = os.stat(output).st_size
+        if size != target['size']:
+            return "size mismatch (target, output): %s != %s" \
+                   % (target['size'], size)
+    if 'nifti' in target:
+        tolerances = dict(NIFTI_TOLERANCES, **(tolerances or {}))
+        diffs = _get_nifti_header_diffs(
+            target['nifti'], get_nifti_summary(output), tolerances)
+        if diffs:
+            diffs = (os.linesep + "  ").join([''] + diffs)
+            return "NIfTI header mismatch (target, output):%s" % diffs
+        diffs = _get_nifti_stats_diffs(
+            target['stats'], get_nifti_stats(output, digest), tolerances)
+        if diffs:
+            diffs = (os.linesep + "  ").join([''] + diffs)
+            return "NIfTI values mismatch (target, output):%s" % diffs
+        return
+    output_digest = _get_gz_digest(output, digest) \
+        if output.endswith('.gz') else file_digest(output, digest)
+    if output_digest != target['digest']:
+        return "%s mismatch (target, output): %s != %s" \
+               % (digest, target['digest'], output_digest)
+
+
+def record_test_fingerprint(testfile, outputdir, digest=DEFAULT_DIGEST):
+    """Record fingerprint of the outputs of a (passed) test run in outputdir
+
+    Returns
+    -------
+    str
+      Path to the fingerprint file
+    """
+    path = get_test_fingerprint_path(testfile)
+    fingerprint = get_outputs_fingerprint(
+        op.join(outputdir, GEAR_OUTPUT_DIR), digest)
+    write_if_changed(path, dump_json(fingerprint))
+    lgr.info("Recorded fingerprint of %d file(s) into %s",
+             len(fingerprint['files']), path)
+    return path
+
+
+# Default tolerances for comparison of NIfTI voxel values, could be
+# overridden in the test spec under "tolerances".  Values are considered
+# equal (as in numpy.isclose) if |output - target| <= atol + rtol * |target|,
+# and if min_corr is set, the correlation of the images must be at least it.
+# Geometry of the images is compared within header_atol, since it is stored
+# in float32 (so affines computed the same way could differ in rounding),
+# and all the other header fields but ignore_header (e.g. descrip) exactly
+NIFTI_TOLERANCES = {
+    'atol': 0,
+    'rtol': 0,
+    'min_corr': None,
+    'header_atol': 1e-6,
+    'ignore_header': (),
+}
+# Maximal number of voxels to load (of each image) at once
+NIFTI_SLAB_VOXELS = 2 ** 21
+
+
+def _iter_slabs(shape, max_voxels=None):
+    """Yield slicers for slabs along the last axis of at most max_voxels
+
+    Unless a single slice along the last axis is larger.  By default
+    max_voxels is NIFTI_SLAB_VOXELS
+    """
+    max_voxels = max_voxels or NIFTI_SLAB_VOXELS
+    if not shape:
+        yield ()
+        return
+    slice_voxels = 1
+    for n in shape[:-1]:
+        slice_voxels *= n
+    step = max(1, max_voxels // max(1, slice_voxels))
+    for i in range(0, shape[-1], step):
+        yield (Ellipsis, slice(i, min(i + step, shape[-1])))
+
+
+@contextmanager
+def _open_nifti(path):
+    """Open NIfTI image to read its data slab by slab, closing it after
+
+    The file is opened once (using indexed_gzip for .gz files if available),
+    and not for every slab, which without indexed_gzip would decompress .gz
+    file from its start every time.  Slabs (see _iter_slabs) go in the order
+    of the data in the file, so get read in a single pass.
+    """
+    import nibabel as nib
+    from nibabel.openers import ImageOpener
+    # only the header is read to figure out the type of the image
+    klass = type(nib.load(path))
+    with ImageOpener(path) as f:
+        yield klass.from_stream(f.fobj)
+
+
+class _CorrelationStats(object):
+    """Accumulate (over slabs) statistics needed for Pearson correlation
+
+    Uses pairwise merging of centered sums for numerical stability
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_x = self.mean_y = 0.
+        self.m2_x = self.m2_y = self.c_xy = 0.
+
+    def update(self, x, y):
+        n = x.size
+        if not n:
+            return
+        mean_x, mean_y = x.mean(), y.mean()
+        dx, dy = x - mean_x, y - mean_y
+        m2_x, m2_y, c_xy = (dx * dx).sum(), (dy * dy).sum(), (dx * dy).sum()
+        total = self.n + n
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        factor = float(self.n) * n / total
+        self.m2_x += m2_x + delta_x * delta_x * factor
+        self.m2_y += m2_y + delta_y * delta_y * factor
+        self.c_xy += c_xy + delta_x * delta_y * factor
+        self.mean_x += delta_x * n / total
+        self.mean_y += delta_y * n / total
+        self.n = total
+
+    def get_correlation(self):
+        """Return correlation, or None if any of the images is constant"""
+        if not (self.m2_x and self.m2_y):
+            return None
+        return self.c_xy / (self.m2_x * self.m2_y) ** 0.5
+
+
+def check_nifti(target, output, tolerances=None):
+    """Compare NIfTI files: headers, and then voxel values within tolerances
+
+    Voxel data is read slab by slab (see NIFTI_SLAB_VOXELS) in a single pass
+    over the files, so memory use is bounded regardless of the size of the
+    images, and the comparison stops at the first slab exceeding the
+    tolerances.
+
+    Parameters
+    ----------
+    target: str
+    output: str
+    tolerances: dict, optional
+      Overrides for NIFTI_TOLERANCES
+    """
+    import numpy as np
+    tolerances = dict(NIFTI_TOLERANCES, **(tolerances or {}))
+    atol, rtol = tolerances['atol'], tolerances['rtol']
+    min_corr = tolerances['min_corr']
+
+    with _open_nifti(target) as target_img, \
+            _open_nifti(output) as output_img:
+        diffs = _get_nifti_header_diffs(
+            _get_nifti_header(target_img), _get_nifti_header(output_img),
+            tolerances)
+        if diffs:
+            diffs = (os.linesep + "  ").join([''] + diffs)
+            return "NIfTI header mismatch (target, output):%s" % diffs
+
+        max_abs_diff = max_rel_error = 0.
+        corr_stats = _CorrelationStats() if min_corr is not None else None
+        for slab in _iter_slabs(target_img.shape):
+            t = np.asarray(
+                target_img.dataobj[slab], dtype=np.float64).ravel()
+            o = np.asarray(
+                output_img.dataobj[slab], dtype=np.float64).ravel()
+            # equal values, including the same non-finite ones (NaN, +-inf)
+            same = (t == o) | (np.isnan(t) & np.isnan(o))
+            with np.errstate(invalid='ignore'):
+                abs_diff = np.abs(o - t)
+                abs_diff[same] = 0
+                abs_t = np.abs(t)
+                # non-finite value in only one of them, or different
+                # infinities, is a mismatch regardless of the tolerances
+                exceeding = ~same & ~(np.isfinite(abs_diff)
+                                      & (abs_diff <= atol + rtol * abs_t))
+            finite = np.isfinite(abs_diff)
+            if finite.any():
+                max_abs_diff = max(max_abs_diff, abs_diff[finite].max())
+                nonzero = finite & (abs_t > 0)
+                if nonzero.any():
+                    max_rel_error = max(
+                        max_rel_error,
+                        (abs_diff[nonzero] / abs_t[nonzero]).max())
+            if exceeding.any():
+                return "%d voxel(s) differ beyond tolerances " \
+                       "(atol=%g, rtol=%g) in slab %s: max abs diff %g, " \
+                       "max rel error %g" \
+                       % (exceeding.sum(), atol, rtol, slab[-1:] or '',
+                          max_abs_diff, max_rel_error)
+            if corr_stats is not None:
+                valid = np.isfinite(t) & np.isfinite(o)
+                corr_stats.update(t[valid], o[valid])
+
+        if corr_stats is not None:
+            corr = corr_stats.get_correlation()
+            if corr is not None and corr < min_corr:
+                return "correlation %g < %g " \
+                       "(max abs diff %g, max rel error %g)" \
+                       % (corr, min_corr, max_abs_diff, max_rel_error)
+        lgr.log(5, "%s matches %s: max abs diff %g, max rel error %g",
+                output, target, max_abs_diff, max_rel_error)
+
+
+def check_digest(target, output, algorithm=DEFAULT_DIGEST):
+    """Compare digests of the files
+
+    Digests of the target files are cached, so they are not recomputed while
+    the files do not change
+    """
+    target_digest = get_digest_cache().digest(target, algorithm)
+    output_digest = file_digest(output, algorithm)
+    if target_digest != output_digest:
+        return "%s mismatch (target, output): %s != %s" \
+               % (algorithm, target_digest, output_digest)
 
 
 def check_md5(target, output):
-    target_md5 = md5sum(target)
-    output_md5 = md5sum(output)
-    if target_md5 != output_md5:
-        return "md5 mismatch (target, output): %s != %s" \
-               % (target_md5, output_md5)
+    return check_digest(target, output, 'md5')
+
+
+# Number of files of a test to compare concurrently
+CHECK_JOBS = 4
+# Maximal number of differences to report per file
+MAX_REPORTED_DIFFS = 10
+
+
+def _isclose(target, output, tolerances):
+    tolerances = tolerances or {}
+    return abs(output - target) \
+        <= tolerances.get('atol', 0) + tolerances.get('rtol', 0) * abs(target)
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _get_json_diffs(target, output, tolerances=None, path=''):
+    """Yield differences between the loaded json structures
+
+    Numbers are compared within atol/rtol of the tolerances
+    """
+    if isinstance(target, dict) and isinstance(output, dict):
+        for k in sorted(set(target) | set(output)):
+            kpath = '%s.%s' % (path, k) if path else k
+            if k not in output:
+                yield "%s: only in target" % kpath
+            elif k not in target:
+                yield "%s: only in output" % kpath
+            else:
+                for d in _get_json_diffs(
+                        target[k], output[k], tolerances, kpath):
+                    yield d
+    elif isinstance(target, list) and isinstance(output, list) \
+            and len(target) == len(output):
+        for i, (t, o) in enumerate(zip(target, output)):
+            for d in _get_json_diffs(t, o, tolerances, '%s[%d]' % (path, i)):
+                yield d
+    elif _is_number(target) and _is_number(output):
+        if not _isclose(target, output, tolerances):
+            yield "%s: %r != %r" % (path or '<top>', target, output)
+    elif target != output:
+        yield "%s: %r != %r" % (path or '<top>', target, output)
+
+
+def check_json(target, output, tolerances=None):
+    """Compare json files key by key
+
+    Numeric values are compared within atol/rtol of the tolerances
+    """
+    with io.open(target, encoding='utf-8') as f:
+        target_json = json.load(f)
+    with io.open(output, encoding='utf-8') as f:
+        output_json = json.load(f)
+    diffs = list(islice(
+        _get_json_diffs(target_json, output_json, tolerances),
+        MAX_REPORTED_DIFFS))
+    if diffs:
+        diffs = (os.linesep + "  ").join([''] + diffs)
+        return "json diff (target, output):%s" % diffs
+
+
+# Default tolerances for comparison of text files.  If ignore_newlines is
+# set, differences in line endings (e.g. \r\n vs \n) and in the presence of
+# the newline at the end of the file are ignored
+TEXT_TOLERANCES = {
+    'ignore_newlines': False,
+}
+
 
+def _read_lines(path, ignore_newlines):
+    with io.open(path, encoding='utf-8', errors='replace',
+                 newline=None if ignore_newlines else '') as f:
+        return f.read().splitlines(not ignore_newlines)
 
-from collections import defaultdict
 
+def check_text(target, output, tolerances=None):
+    """Compare text files line by line, reporting the (first) differences
 
-class TestDrivers(object):
-    """A helper to provide test "drivers" for a given file """
-    DRIVERS = {
-        '.*\.nii\.gz': check_nib_diff,
-    }
-    # heh, starts to bind to the instance etc... didn't know
-    #DEFAULT = check_md5
+    Files must be identical, unless ignore_newlines is set in the
+    tolerances (see TEXT_TOLERANCES)
+    """
+    import difflib
+    tolerances = dict(TEXT_TOLERANCES, **(tolerances or {}))
+    ignore_newlines = tolerances['ignore_newlines']
+    if not ignore_newlines:
+        with open(target, 'rb') as f:
+            target_content = f.read()
+        with open(output, 'rb') as f:
+            if f.read() == target_content:
+                return
+    target_lines = _read_lines(target, ignore_newlines)
+    output_lines = _read_lines(output, ignore_newlines)
+    if target_lines == output_lines:
+        return
+    diffs = [
+        l for l in difflib.unified_diff(
+            [l.rstrip('\r\n') for l in target_lines],
+            [l.rstrip('\r\n') for l in output_lines],
+            'target', 'output', n=0, lineterm='')
+        if not l.startswith('@@')
+    ]
+    if not diffs:
+        return "text differs only in newlines (see ignore_newlines)"
+    diffs = (os.linesep + "  ").join([''] + diffs[:MAX_REPORTED_DIFFS + 2])
+    return "text diff:%s" % diffs
+
+
+def check_numeric_text(target, output, tolerances=None):
+    """Compare text files with numeric arrays (e.g. bvec/bval)
+
+    Values are compared within atol/rtol of the tolerances
+    """
+    import numpy as np
+    target_array = np.loadtxt(target, ndmin=2)
+    output_array = np.loadtxt(output, ndmin=2)
+    if target_array.shape != output_array.shape:
+        return "shape mismatch (target, output): %s != %s" \
+               % (target_array.shape, output_array.shape)
+    tolerances = tolerances or {}
+    close = np.isclose(output_array, target_array,
+                       rtol=tolerances.get('rtol', 0),
+                       atol=tolerances.get('atol', 0),
+                       equal_nan=True)
+    if not close.all():
+        return "%d value(s) differ beyond tolerances, max abs diff %g" \
+               % ((~close).sum(),
+                  np.nanmax(np.abs(output_array - target_array)))
+
+
+class Comparators(object):
+    """Registry of comparators of the target and output files
+
+    Comparators are chosen by the first matching (by re.search on the
+    path) regular expression.  They are called as
+    comparator(target, output, tolerances, digest) and return a description
+    of the difference, or None if files match.  Files not matching any get
+    compared by their digests.
+    """
+
+    def __init__(self):
+        self._comparators = []
+
+    def register(self, name, regex, comparator, bytewise=False):
+        """Register comparator for the files matching regex
+
+        Registered later take precedence over the earlier ones.  bytewise
+        states that the comparator would consider files of different size
+        to differ, so it would not even be called for them.
+        """
+        self._comparators.insert(
+            0, (name, re.compile(regex), comparator, bytewise))
+
+    def _get(self, filename):
+        for rec in self._comparators:
+            if rec[1].search(filename):
+                return rec
+        return 'digest', None, _check_digest, True
 
     def __call__(self, filename):
-        matched_any = False
-        for file_regex, driver in self.DRIVERS.items():
-            if re.match(file_regex, filename):
-                matched_any = True
-                yield driver
-        if not matched_any:
-            yield check_md5
+        """Return (name, comparator) for the file"""
+        name, _, comparator, _ = self._get(filename)
+        return name, comparator
 
-test_drivers = TestDrivers()
+    def is_bytewise(self, filename):
+        """Return True if the file is compared bytewise"""
+        return self._get(filename)[3]
 
+    @property
+    def names(self):
+        return [rec[0] for rec in self._comparators]
 
-def _check(testfile, outputdir):
+
+def _check_digest(target, output, tolerances, digest):
+    return check_digest(target, output, digest)
+
+
+comparators = Comparators()
+comparators.register(
+    'text', r'\.(txt|csv|tsv|log)$',
+    lambda target, output, tolerances, digest:
+        check_text(target, output, tolerances))
+comparators.register(
+    'numeric', r'(^|/)(bvecs|bvals)$|\.(bvecs?|bvals?)$',
+    lambda target, output, tolerances, digest:
+        check_numeric_text(target, output, tolerances))
+comparators.register(
+    'json', r'\.json$',
+    lambda target, output, tolerances, digest:
+        check_json(target, output, tolerances))
+comparators.register(
+    'nifti', r'\.nii(\.gz)?$',
+    lambda target, output, tolerances, digest:
+        check_nifti(target, output, tolerances))
+
+
+def get_file_tolerances(tolerances, path):
+    """Return tolerances for the file at (relative) path
+
+    tolerances (as specified in the test spec) could contain defaults
+    (e.g. atol), and overrides for the files matching glob patterns under
+    "files", e.g.::
+
+      tolerances:
+        rtol: 1e-6
+        files:
+          "*_bold.nii.gz":
+            atol: 0.01
+            min_corr: 0.999
+            ignore_header: [descrip]
+          "*.log":
+            ignore_newlines: true
+    """
+    file_tolerances = dict(
+        (k, v) for k, v in tolerances.items() if k != 'files')
+    for pattern, overrides in sorted(tolerances.get('files', {}).items()):
+        if fnmatch.fnmatch(path, pattern):
+            file_tolerances.update(overrides)
+    return file_tolerances
+
+
+def _check(testfile, outputdir, digest=DEFAULT_DIGEST):
     """Given a testfile spec and output directory, perform all the tests
 
-    ATM would just compare produced outputs to the target ones 1-to-1
+    ATM would just compare produced outputs to the target ones 1-to-1,
+    CHECK_JOBS files at a time, using the comparators chosen by the file
+    type.  Whatever could be decided from the files metadata (presence,
+    type, size for bytewise comparisons, hardlinks) is decided without
+    reading their content.  Files without a dedicated comparator are compared by their digest
+    (algorithm).  NIfTI files are compared within the tolerances from the
+    test spec (see `get_file_tolerances`), also if only fingerprints of
+    the targets are available (see `check_fingerprint`).
     """
     # TODO: ATM just a basic comparator of files (without even subdirs etc)
     assert testfile.endswith('.yaml')
     target, _ = op.splitext(testfile)
     # target = op.join(target, 'output') # ??? do we need output there???
-    # TODO: later all tests might be just based on "fingerprints" so no
-    # target files might be needed
-    target_files = get_files(target) if os.path.exists(target) else set()
-    output_files = get_files(op.join(outputdir, GEAR_OUTPUT_DIR))
-    only_in_output = output_files - target_files
-    if only_in_output:
-        raise AssertionError("Unexpected files in output: %s" % only_in_output)
-    only_in_target = target_files - output_files
-    if only_in_target:
-        raise AssertionError("Expected files were not found in output: %s"
-                             % only_in_target)
-    failures = {}
-    for f in target_files:
+    fingerprint_path = get_test_fingerprint_path(testfile)
+    fingerprint = None
+    if os.path.exists(target):
+        target_infos = dict(scan_tree(target))
+    elif os.path.exists(fingerprint_path):
+        # no target files, only their fingerprints
+        fingerprint = load_json(fingerprint_path)
+        if fingerprint.get('version') != TEST_FINGERPRINT_VERSION:
+            raise AssertionError(
+                "Fingerprint %s is of version %s, while %s is supported. "
+                "Record it again" % (fingerprint_path,
+                                     fingerprint.get('version'),
+                                     TEST_FINGERPRINT_VERSION))
+        target_infos = dict(
+            (f, FileInfo(rec.get('size'), None, None, None))
+            for f, rec in fingerprint['files'].items())
+    else:
+        target_infos = {}
+    with open(testfile) as fp:
+        tolerances = (yaml.safe_load(fp) or {}).get('tolerances', {})
+
+    def is_bytewise(f):
+        if fingerprint:
+            # size is fingerprinted only for the files compared bytewise
+            return True
+        return comparators.is_bytewise(f)
+
+    def check_file(f):
         # verify the content match
         target_file = op.join(target, f)
         output_file = op.join(outputdir, 'output', f)
-        for test_driver in test_drivers(target_file):
-            test_failure = test_driver(target_file, output_file)
+        if fingerprint:
+            return check_fingerprint(
+                fingerprint['files'][f], output_file,
+                fingerprint.get('digest', DEFAULT_DIGEST),
+                get_file_tolerances(tolerances, f))
+        name, comparator = comparators(f)
+        lgr.log(5, "Comparing %s using %s comparator", f, name)
+        return comparator(target_file, output_file,
+                          get_file_tolerances(tolerances, f), digest)
+
+    only_in_output, only_in_target = set(), set()
+    failures = {}
+    checks = []
+    executor = ThreadPoolExecutor(CHECK_JOBS) if CHECK_JOBS > 1 else None
+    try:
+        for diff in diff_trees(
+                target_infos, op.join(outputdir, GEAR_OUTPUT_DIR),
+                bytewise=is_bytewise):
+            if diff.status == 'only-in-output':
+                only_in_output.add(diff.path)
+            elif diff.status == 'only-in-target':
+                only_in_target.add(diff.path)
+            elif diff.status == 'type':
+                failures[diff.path] = "type mismatch (target, output): " \
+                    "%s != %s" % (stat.filemode(diff.target.mode),
+                                  stat.filemode(diff.output.mode))
+            elif diff.status == 'size':
+                failures[diff.path] = "size mismatch (target, output): " \
+                    "%d != %d" % (diff.target.size, diff.output.size)
+            elif diff.status == 'compare':
+                if executor:
+                    checks.append(
+                        (diff.path, executor.submit(check_file, diff.path)))
+                else:
+                    checks.append((diff.path, check_file(diff.path)))
+        if only_in_output:
+            raise AssertionError(
+                "Unexpected files in output: %s" % only_in_output)
+        if only_in_target:
+            raise AssertionError(
+                "Expected files were not found in output: %s"
+                % only_in_target)
+        for f, check in checks:
+            test_failure = check.result() if executor else check
             if test_failure:
-                lgr.error("Failure %s: %s", f, test_failure)
                 failures[f] = test_failure
+    finally:
+        if executor:
+            # nothing to wait for if we have failed already
+            for _, check in checks:
+                check.cancel()
+            executor.shutdown()
+    for f in sorted(failures):
+        lgr.error("Failure %s: %s", f, failures[f])
+    get_digest_cache().save()
 
     if failures:
-        raise AssertionError("%d out of %d file(s) differ" % (len(failures), len(target_files)))
+        raise AssertionError("%d out of %d file(s) differ" % (len(failures), len(target_infos)))
+
+
+def get_test_cache_key(job, digest=DEFAULT_DIGEST):
+    """Return the key to cache the result of the TestJob under
+
+    The key is composed of the gear identity (ID of the docker image, or the
+    fingerprint of the gear for native runs, which does not account for the
+    software installed on the host), digests of the inputs and target
+    outputs, and the content of the test spec.
+
+    Returns
+    -------
+    str or None
+      None if the gear identity could not be established
+    """
+    if job.run_tests == 'gear':
+        gear_id = get_docker_image_id(job.docker_image) \
+            if job.docker_image else None
+    else:
+        gear_id = load_json(
+            op.join(job.gearpath, GEAR_FINGERPRINT_FILENAME),
+            must_exist=False).get('fingerprint')
+    if not gear_id:
+        return None
+    with open(job.testfile, 'rb') as f:
+        test_spec_content = f.read()
+    test_spec = yaml.safe_load(test_spec_content) or {}
+    digest_cache = get_digest_cache()
+    target, _ = op.splitext(job.testfile)
+    if op.exists(target):
+        targets = OrderedDict(
+            (f, digest_cache.digest(op.join(target, f), digest))
+            for f in sorted(get_files(target)))
+    else:
+        fingerprint_path = get_test_fingerprint_path(job.testfile)
+        targets = file_digest(fingerprint_path, digest) \
+            if op.exists(fingerprint_path) else None
+    key_data = OrderedDict([
+        ('gearificator', __version__),
+        ('run_tests', job.run_tests),
+        ('gear', gear_id),
+        ('test', test_spec_content.decode('utf-8')),
+        ('inputs', OrderedDict(
+            (name, digest_cache.digest(path, digest))
+            for name, path in get_test_inputs(job.testfile, test_spec).items())),
+        ('targets', targets),
+        ('digest', digest),
+    ])
+    digest_cache.save()
+    return hashlib.sha256(
+        json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _get_test_cache_path(cache_key):
+    return op.join(get_cache_dir('test-results'), cache_key + '.json')
+
+
+def _run_test_job(job, staging='auto', digest=DEFAULT_DIGEST, use_cache=True,
+                  limits=None, results_cache=None):
+    """Prepare, run and check a single TestJob
+
+    If use_cache, a test which has passed before with the same gear, inputs,
+    and spec (see `get_test_cache_key`) is not ran again.  limits are the
+    default resource limits for the run (see `get_test_limits`).
+    results_cache is passed to the gear run.
+
+    Returns
+    -------
+    TestResult
+    """
+    testmsg = "%s test %s" % (job.toppath, job.testname)
+    cache_key = None
+    if use_cache:
+        try:
+            cache_key = get_test_cache_key(job, digest)
+        except Exception as exc:
+            lgr.debug("Cannot get cache key for %s: %s", testmsg, exc)
+        if cache_key and op.exists(_get_test_cache_path(cache_key)):
+            lgr.info("%s passed (cached)", testmsg)
+            return TestResult(job.toppath, job.testname, 'cached', None,
+                              0., '')
+    lgr.debug("  running " + testmsg)
+    t0 = time.time()
+    staged = {}
+    status = 'failed'
+    try:
+        if op.exists(job.testdir):
+            shutil.rmtree(job.testdir)
+        staged = _prepare(job.testfile, job.testdir, staging)
+        with open(job.testfile) as f:
+            test_limits = get_test_limits(yaml.safe_load(f) or {}, limits)
+        if test_limits:
+            lgr.debug("  limiting %s to %s", testmsg, test_limits)
+
+        if job.run_tests == 'native':
+            run_gear_native(job.gearpath, job.testdir, limits=test_limits,
+                            results_cache=results_cache)
+        elif job.run_tests == 'gear':
+            run_gear_docker(job.docker_image, job.testdir,
+                            limits=test_limits, results_cache=results_cache)
+            # change ownership back from root on output directory
+            # Redone via uid:gid mapping into Docker container
+            # and making all needed components readable with changes
+            # to Dockerfile
+        else:
+            raise ValueError(job.run_tests)
+
+        _check(job.testfile, job.testdir, digest)
+        #  verify correspondence of # of files with target outputs
+        #  run the tests specified in tests.yaml if any, if none -
+        #  assume that they all must be identical
+    except Exception as exc:
+        if isinstance(exc, CommandTimeout):
+            status = 'timed-out'
+        # for now pdb on generic --pdb if there was some setup
+        lgr.error(testmsg + " %s: %s", status.upper(), exc)
+        from .utils import _sys_excepthook
+        if sys.excepthook != _sys_excepthook:
+            raise
+        lgr.debug("Failed %s: %s", testmsg, traceback.format_exc())
+        return TestResult(job.toppath, job.testname, status,
+                          "%s: %s" % (exc.__class__.__name__, exc),
+                          time.time() - t0, _get_staging(staged))
+    duration = time.time() - t0
+    staging_used = _get_staging(staged)
+    lgr.info("%s passed (inputs staged via %s)",
+             testmsg, staging_used or 'nothing')
+    if cache_key:
+        write_if_changed(
+            _get_test_cache_path(cache_key),
+            dump_json(OrderedDict([
+                ('toppath', job.toppath),
+                ('testname', job.testname),
+                ('duration', duration),
+            ])))
+    return TestResult(job.toppath, job.testname, 'passed', None,
+                      duration, staging_used)
+
+
+def _get_staging(staged):
+    return ','.join(sorted(set(staged.values())))
+
+
+class TestHistory(JsonStore):
+    """Outcomes and durations of the past test runs
+
+    Kept per test file, so tests could be ordered by how they went the last
+    time (see `get_test_jobs_order`)
+
+    Parameters
+    ----------
+    path: str, optional
+      File to store the history in.  By default test-history.json within
+      the cache directory
+    """
+
+    VERSION = 1
+    KEY = 'tests'
+    NAME = 'test history'
+    # so pytest does not try to collect it
+    __test__ = False
+
+    def __init__(self, path=None):
+        super(TestHistory, self).__init__(
+            path or op.join(get_cache_dir(), 'test-history.json'))
+
+    @staticmethod
+    def _get_key(job):
+        return op.abspath(job.testfile)
+
+    def get(self, job):
+        """Return the last record (status, duration, time) for the job, or None
+        """
+        return self._get(self._get_key(job))
+
+    def record(self, job, result):
+        """Record the TestResult of the job"""
+        if result.status == 'skipped':
+            return
+        rec = {'status': result.status, 'duration': result.duration,
+               'time': time.time()}
+        if result.status == 'cached':
+            # no new information on how long it takes to run
+            prev = self.get(job)
+            if not prev or prev['status'] != 'passed':
+                return
+            rec = dict(prev, time=rec['time'])
+        self._set(self._get_key(job), rec)
+
+
+def get_test_jobs_order(test_jobs, order='spec', history=None):
+    """Return indexes of test_jobs in the order to run them in
+
+    Parameters
+    ----------
+    order: {'spec', 'failed-first', 'fastest-first'}
+      'failed-first' runs tests which did not pass the last time first, then
+      tests without history, and then the ones which passed, the fastest
+      first within each group.  'fastest-first' runs tests by their last
+      duration, starting with the ones without history
+    history: TestHistory, optional
+    """
+    indexes = list(range(len(test_jobs)))
+    if order == 'spec':
+        return indexes
+    if order not in TEST_ORDERS:
+        raise ValueError("Unknown order %r" % order)
+    history = history or TestHistory()
+
+    def get_key(i):
+        rec = history.get(test_jobs[i])
+        if not rec:
+            return (1, 0.)
+        duration = rec['duration']
+        if order == 'failed-first':
+            return (2 if rec['status'] == 'passed' else 0, duration)
+        return (1, duration)
+    # sorted is stable, so ties remain in the spec order
+    return sorted(indexes, key=get_key)
+
+
+def run_test_jobs(test_jobs, jobs=1, staging='auto', digest=DEFAULT_DIGEST,
+                  use_cache=True, limits=None, order='spec', fail_fast=False,
+                  history=None, results_cache=None):
+    """Run all the test_jobs, possibly in parallel threads
+
+    Tests spend their time in external commands (gear runs), and those are
+    also limited by the 'test' lane of the engine.  Inputs are staged
+    according to staging (see `utils.stage_file`), and outputs compared
+    using digest algorithm where no better comparison is known.  If
+    use_cache, tests which passed before for the same gear, inputs and
+    spec are not ran again.  limits are the default resource limits for
+    the test runs, which test specs could override (see `get_test_limits`).
+    results_cache is the directory for the gears to cache outputs of the
+    interface runs in (see `run.ResultsCache`).
+
+    Outcomes and durations of the tests are recorded in the history
+    (`TestHistory` in the cache directory by default), so the tests could
+    be ran in the order (see `get_test_jobs_order`) to report likely
+    failures sooner.  If fail_fast, no test is started after some test
+    fails, and the remaining ones are reported as 'skipped'.
+
+    Returns
+    -------
+    list of TestResult
+      In the order of test_jobs
+    """
+    history = history or TestHistory()
+    indexes = get_test_jobs_order(test_jobs, order, history)
+    failed = threading.Event()
+
+    def run_test_job(i):
+        job = test_jobs[i]
+        if failed.is_set():
+            return TestResult(job.toppath, job.testname, 'skipped',
+                              "some other test failed", 0., '')
+        result = _run_test_job(job, staging, digest, use_cache, limits,
+                               results_cache)
+        history.record(job, result)
+        if fail_fast and result.status not in ('passed', 'cached'):
+            failed.set()
+        return result
+
+    try:
+        results = _run_test_jobs(run_test_job, indexes, jobs)
+    finally:
+        history.save()
+    # in the order of test_jobs
+    return [r for _, r in sorted(zip(indexes, results))]
+
+
+def _run_test_jobs(run_test_job, indexes, jobs):
+    if jobs > 1 and len(indexes) > 1:
+        from .utils import _sys_excepthook
+        if sys.excepthook != _sys_excepthook:
+            lgr.warning("Running tests serially since we would need to "
+                        "fall into pdb on error")
+            jobs = 1
+    if jobs <= 1 or len(indexes) <= 1:
+        return [run_test_job(i) for i in indexes]
+    lgr.info("Running %d tests using %d threads", len(indexes), jobs)
+    executor = ThreadPoolExecutor(min(jobs, len(indexes)))
+    try:
+        # submitted in the order, and started in it as threads free up
+        return list(executor.map(run_test_job, indexes))
+    finally:
+        executor.shutdown()
+
+
+def summarize_test_results(results):
+    """Log summary of the test results
+
+    Returns
+    -------
+    list of TestResult
+      Failed ones
+    """
+    failed = [r for r in results
+              if r.status not in ('passed', 'cached', 'skipped')]
+    skipped = [r for r in results if r.status == 'skipped']
+    for r in failed:
+        lgr.error("  %s test %s %s: %s",
+                  r.toppath, r.testname, r.status.upper(), r.message)
+    lgr.info("TESTS: %d passed (%d cached), %d failed (%d timed out), "
+             "%d skipped out of %d in %.1f sec total",
+             len(results) - len(failed) - len(skipped),
+             len([r for r in results if r.status == 'cached']),
+             len(failed),
+             len([r for r in results if r.status == 'timed-out']),
+             len(skipped),
+             len(results),
+             sum(r.duration for r in results))
+    return failed
 
 
 # CLI
@@ -177,13 +1364,32 @@ def grp():
 @grp.command(short_help="Prepare a test case")
 @click.argument('testfile', type=click.Path(exists=True))  #, doc='File with test specification')
 @click.argument('outputdir')  #, doc='Output directory.  Will be created if does not exist')
+@click.option('--staging', type=click.Choice(STAGING_CHOICES), default='auto',
+              help='How to stage input files')
 def prepare(*args, **kwargs):
     """Prepare a test case: inputs, config.json, etc"""
     return _prepare(*args, **kwargs)
 
 
+@grp.command(short_help="Record fingerprint of the outputs of a ran test")
+@click.argument('testfile', type=click.Path(exists=True))  #, doc='File with test specification')
+@click.argument('outputdir', type=click.Path(exists=True))  #, doc='Output directory of the ran test')
+@click.option('--digest', type=click.Choice(DIGESTS), default=DEFAULT_DIGEST,
+              help='Digest to fingerprint the files with')
+def record(testfile, outputdir, digest):
+    """Record fingerprint of the outputs of a passed test
+
+    The fingerprint (TESTNAME.fingerprint.json alongside the TESTFILE) is
+    used by the checks, if there is no directory with the target outputs,
+    so the latter do not need to be stored
+    """
+    return record_test_fingerprint(testfile, outputdir, digest)
+
+
 @grp.command(short_help="Check the results for a ran test")
 @click.argument('testfile', type=click.Path(exists=True))  #, doc='File with test specification')
 @click.argument('outputdir', type=click.Path(exists=True))  #, doc='Output directory.  Will be created if does not exist')
+@click.option('--digest', type=click.Choice(DIGESTS), default=DEFAULT_DIGEST,
+              help='Digest to compare files without dedicated comparison by')
 def check(*args, **kwargs):
     return _check(*args, **kwargs)
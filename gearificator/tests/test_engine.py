@@ -0,0 +1,88 @@
+import os.path as op
+import time
+
+from pytest import raises
+
+from gearificator.engine import CommandEngine, TAIL_SIZE
+from gearificator.exceptions import CommandError, CommandTimeout
+
+
+def _wait_for(cond, timeout=10):
+    t0 = time.time()
+    while not cond():
+        assert time.time() - t0 < timeout
+        time.sleep(0.05)
+
+
+def test_engine_lanes(tmpdir):
+    engine = CommandEngine({'slow': 2})
+    go = str(tmpdir.join('go'))
+    try:
+        # commands mark their start and then wait for the go
+        futures = [
+            engine.submit(engine.run(
+                ['sh', '-c',
+                 'touch "$0"; while [ ! -e "%s" ]; do sleep 0.05; done' % go,
+                 str(tmpdir.join('started%d' % i))],
+                lane='slow'))
+            for i in range(4)
+        ]
+        started = lambda: len(tmpdir.listdir('started*'))
+        _wait_for(lambda: started() == 2)
+        # and some other lane is not waiting for the 'slow' one
+        assert engine.call(['echo', '123'], lane='other')[0] == '123\n'
+        # while the 'slow' one stays at its limit
+        time.sleep(0.2)
+        assert started() == 2
+        assert not any(f.done() for f in futures)
+        tmpdir.join('go').write('')
+        for f in futures:
+            assert f.result(timeout=10) == ['', '']
+        assert started() == 4
+    finally:
+        engine.close()
+
+
+def test_engine_outputs(tmpdir):
+    engine = CommandEngine()
+    logsdir = str(tmpdir.join('logs'))
+    try:
+        out, err = engine.call(
+            ['sh', '-c', 'seq 100000; echo err >&2'], logsdir=logsdir)
+        full_out = open(op.join(logsdir, 'out')).read()
+        assert len(full_out) > TAIL_SIZE
+        assert out == full_out[-TAIL_SIZE:]
+        assert out.endswith('\n100000\n')
+        assert err == 'err\n'
+
+        with raises(CommandError) as cme:
+            engine.call(['sh', '-c', 'echo bad >&2; exit 3'], logsdir=logsdir)
+        assert cme.value.exit_code == 3
+        assert cme.value.outs == ['', 'bad\n']
+
+        stdin = tmpdir.join('stdin')
+        stdin.write('input')
+        with open(str(stdin), 'rb') as f:
+            assert engine.call(['cat'], stdin=f) == ['input', '']
+    finally:
+        engine.close()
+
+
+def test_engine_timeout(tmpdir, monkeypatch):
+    from gearificator import engine as engine_mod
+    monkeypatch.setattr(engine_mod, 'KILL_GRACE', 1)
+    engine = CommandEngine()
+    try:
+        t0 = time.time()
+        with raises(CommandTimeout) as cme:
+            # the child ignores TERM, and grandchild would hold the pipes
+            engine.call(
+                ['sh', '-c', 'trap "" TERM; echo started; sleep 30 & wait'],
+                timeout=0.5)
+        assert time.time() - t0 < 10
+        assert cme.value.timeout == 0.5
+        assert cme.value.outs[0] == 'started\n'
+        # finishes in time
+        assert engine.call(['echo', 'ok'], timeout=10) == ['ok\n', '']
+    finally:
+        engine.close()
@@ -0,0 +1,215 @@
+import io
+import os
+import os.path as op
+import shutil
+import sys
+import tarfile
+
+import pytest
+
+from gearificator import __version__
+from gearificator.consts import (
+    GEAR_MANIFEST_FILENAME,
+    GEAR_PLAN_FILENAME,
+    GEAR_RUN_FILENAME,
+    RESULTS_CACHE_ENVVAR,
+    RESULTS_CACHE_MOUNT,
+)
+from gearificator.gear import (
+    create_base_dockerfile,
+    create_dockerfile,
+    get_build_context_files,
+    get_context_digest,
+    get_uptodate_gear,
+    parse_dpkg_query,
+    run_gear_docker,
+    run_gear_native,
+    save_fingerprint,
+    write_build_context,
+)
+from gearificator.utils import load_json
+
+
+def test_get_uptodate_gear(tmpdir):
+    outdir = str(tmpdir)
+    assert get_uptodate_gear(outdir, 'fp1', False) is None
+    save_fingerprint(outdir, 'fp1', 'gearificator/some:1', False)
+    # no gear files yet
+    assert get_uptodate_gear(outdir, 'fp1', False) is None
+    for f in GEAR_MANIFEST_FILENAME, GEAR_RUN_FILENAME, 'Dockerfile':
+        tmpdir.join(f).write('')
+    # no plan
+    assert get_uptodate_gear(outdir, 'fp1', False) is None
+    tmpdir.join(GEAR_PLAN_FILENAME).write('')
+    spec = get_uptodate_gear(outdir, 'fp1', False)
+    assert spec['docker_image'] == 'gearificator/some:1'
+    assert spec['skipped']
+    assert get_uptodate_gear(outdir, 'fp2', False) is None
+    # image was not built yet
+    assert get_uptodate_gear(outdir, 'fp1', True) is None
+    save_fingerprint(outdir, 'fp1', 'gearificator/some:1', True)
+    assert get_uptodate_gear(outdir, 'fp1', True)
+    # and regenerating spec only does not loose knowledge about the build
+    save_fingerprint(outdir, 'fp1', 'gearificator/some:1', False)
+    assert get_uptodate_gear(outdir, 'fp1', True)
+
+
+def test_create_dockerfile_shared_base(tmpdir):
+    from pytest import raises
+    base = create_base_dockerfile('neurodebian:stretch', ['python-nipype'])
+    assert base.startswith('FROM neurodebian:stretch\n')
+    assert 'nd_freeze' in base
+    assert 'python-nipype' in base
+    # so it does not get stale within the shared image
+    assert '\nRUN pip install -e /srv/gearificator' not in base
+    assert 'COPY' not in base
+
+    fname = str(tmpdir.join('Dockerfile'))
+    thin = create_dockerfile(
+        fname, 'neurodebian:stretch', ['python-nipype'], ['fsl-core'], [],
+        shared_base_image='gearificator/base-nipype:123')
+    assert thin == tmpdir.join('Dockerfile').read()
+    assert thin.startswith('FROM gearificator/base-nipype:123\n')
+    for s in 'nd_freeze', 'python-nipype', 'RUN pip install  &&':
+        assert s not in thin
+    assert 'fsl-core' in thin
+    assert '/srv/gearificator && echo %s\n' % __version__ in thin
+    assert 'COPY manifest.json' in thin
+
+    full = create_dockerfile(
+        fname, 'neurodebian:stretch', ['python-nipype'], ['fsl-core'], [])
+    for s in 'nd_freeze', 'python-nipype', '/srv/gearificator', 'fsl-core':
+        assert s in full
+
+    with raises(NotImplementedError):
+        create_base_dockerfile('ubuntu:18.04')
+
+
+def test_parse_dpkg_query():
+    assert parse_dpkg_query("""\
+ii  fsl-core 5.0.9-4~nd90+1
+un  ants 
+ii  dcm2niix 1:1.0.20171215-1
+""") == {'fsl-core': '5.0.9-4~nd90+1', 'dcm2niix': '1:1.0.20171215-1'}
+    assert parse_dpkg_query("") == {}
+
+
+def test_build_context(tmpdir):
+    for f in GEAR_MANIFEST_FILENAME, GEAR_RUN_FILENAME:
+        tmpdir.join(f).write(f)
+    tmpdir.ensure('wheels', 'some.whl').write('wheel')
+    tmpdir.join('Dockerfile').write("""\
+FROM busybox
+COPY run /run
+# COPY commented /out
+ADD https://example.com/some /some
+COPY --chown=1:1 \\
+    manifest.json /manifest.json
+COPY ["wheels", "/wheels"]
+""")
+    files = get_build_context_files(str(tmpdir))
+    assert files == [
+        'Dockerfile', GEAR_MANIFEST_FILENAME, GEAR_RUN_FILENAME,
+        op.join('wheels', 'some.whl')]
+
+    context = io.BytesIO()
+    write_build_context(str(tmpdir), context)
+    context.seek(0)
+    with tarfile.open(fileobj=context) as tar:
+        assert sorted(tar.getnames()) == files
+        assert set(m.mtime for m in tar.getmembers()) == {0}
+        assert tar.extractfile(GEAR_RUN_FILENAME).read() == b'run'
+    # deterministic
+    context2 = io.BytesIO()
+    os.utime(str(tmpdir.join(GEAR_RUN_FILENAME)), (0, 0))
+    write_build_context(str(tmpdir), context2)
+    assert context2.getvalue() == context.getvalue()
+
+    digest = get_context_digest(str(tmpdir))
+    # other files do not matter
+    tmpdir.join('other').write('other')
+    assert get_context_digest(str(tmpdir)) == digest
+    tmpdir.join(GEAR_RUN_FILENAME).write('changed')
+    assert get_context_digest(str(tmpdir)) != digest
+
+
+@pytest.mark.skipif(
+    not (sys.platform.startswith('linux')
+         and shutil.which('prlimit') and shutil.which('taskset')),
+    reason="requires util-linux prlimit and taskset")
+def test_run_gear_native_limits(tmpdir):
+    gearpath = tmpdir.ensure('gear', dir=True)
+    gearpath.join(GEAR_MANIFEST_FILENAME).write('{}')
+    run = gearpath.join(GEAR_RUN_FILENAME)
+    run.write("""#!/bin/sh
+grep 'Max address space' /proc/self/limits > limits
+grep Cpus_allowed_list /proc/self/status >> limits
+""")
+    run.chmod(0o755)
+    testdir = tmpdir.ensure('test', dir=True)
+    run_gear_native(str(gearpath), str(testdir),
+                    {'memory': 2 ** 30, 'cpus': 1, 'walltime': 10})
+    address_space, cpus = testdir.join('limits').read().splitlines()
+    assert address_space.split()[3:5] == [str(2 ** 30)] * 2
+    assert cpus.split()[1] == str(min(os.sched_getaffinity(0)))
+
+
+def test_get_limits_cmd_fallbacks(monkeypatch):
+    from gearificator import gear
+    monkeypatch.delattr(os, 'sched_getaffinity', raising=False)
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    monkeypatch.setattr(shutil, 'which', lambda tool: '/usr/bin/' + tool)
+    assert gear._get_limits_cmd({'memory': 100, 'cpus': 2}) \
+        == ['prlimit', '--as=100', '--', 'taskset', '--cpu-list', '0,1']
+    # tools which are not available are skipped
+    monkeypatch.setattr(shutil, 'which', lambda tool: None)
+    assert gear._get_limits_cmd({'memory': 100, 'cpus': 2}) == []
+
+
+def test_run_gear_results_cache(tmpdir, monkeypatch):
+    from gearificator import gear
+    gearpath = tmpdir.ensure('gear', dir=True)
+    gearpath.join(GEAR_MANIFEST_FILENAME).write('{}')
+    run = gearpath.join(GEAR_RUN_FILENAME)
+    run.write("#!/bin/sh\necho \"$%s\" > cache\n" % RESULTS_CACHE_ENVVAR)
+    run.chmod(0o755)
+    testdir = tmpdir.ensure('test', dir=True)
+    cache = str(tmpdir.join('cache'))
+    run_gear_native(str(gearpath), str(testdir), results_cache=cache)
+    assert testdir.join('cache').read() == cache + '\n'
+
+    calls = []
+    monkeypatch.setattr(gear, 'subprocess_call',
+                        lambda cmd, **kwargs: calls.append(cmd))
+    run_gear_docker('some:image', str(testdir), results_cache=cache)
+    cmd = calls[0]
+    assert cmd[cmd.index('-e') + 1] \
+        == '%s=%s' % (RESULTS_CACHE_ENVVAR, RESULTS_CACHE_MOUNT)
+    assert '%s:%s' % (op.realpath(cache), RESULTS_CACHE_MOUNT) in cmd
+    assert op.isdir(cache)
+
+
+def test_get_pkg_versions_caches(tmpdir, monkeypatch):
+    from gearificator import gear
+    monkeypatch.setenv('GEARIFICATOR_CACHE_DIR', str(tmpdir))
+    monkeypatch.setattr(gear, '_pkg_versions_by_group', {})
+    image_ids = {'img1': 'sha256:1', 'img2': 'sha256:2'}
+    monkeypatch.setattr(gear, 'get_docker_image_id', image_ids.get)
+    calls = []
+
+    def query(cmd, **kwargs):
+        calls.append(cmd)
+        return 'ii  pkg 1.%d\n' % len(calls), ''
+    monkeypatch.setattr(gear, 'subprocess_call', query)
+
+    assert gear.get_pkg_versions('img1', ['pkg'], group='g') == {'pkg': '1.1'}
+    assert len(calls) == 1
+    assert load_json(str(tmpdir.join('pkg-versions', 'sha256_1.json'))) \
+        == {'pkg': '1.1'}
+    # other image of the group is not queried, but gets cached
+    assert gear.get_pkg_versions('img2', ['pkg'], group='g') == {'pkg': '1.1'}
+    assert len(calls) == 1
+    # cache of the image takes precedence over the group
+    tmpdir.join('pkg-versions', 'sha256_2.json').write('{"pkg": "2.0"}')
+    assert gear.get_pkg_versions('img2', ['pkg'], group='g') == {'pkg': '2.0'}
+    assert len(calls) == 1
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from gearificator.index import InterfaceIndex
+
+
+def test_interface_index(tmpdir, monkeypatch):
+    modpath = tmpdir.join('gf_index_sample.py')
+    modpath.write("""
+class Interface(object):
+    input_spec = output_spec = object
+""")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    index_path = str(tmpdir.join('index.json'))
+
+    index = InterfaceIndex(index_path)
+    rec = index['gf_index_sample.Interface']
+    assert rec['input_spec'] and rec['output_spec']
+    assert not rec['module']
+    assert index['gf_index_sample']['children'] == ['Interface']
+    index.save()
+
+    # a fresh index must not import the module again
+    del sys.modules['gf_index_sample']
+    index = InterfaceIndex(index_path)
+    assert index['gf_index_sample.Interface']['input_spec']
+    assert 'gf_index_sample' not in sys.modules
+
+    # but would re-import whenever module changes
+    modpath.write("""
+class Interface(object):
+    input_spec = object
+    output_spec = None
+""")
+    os.utime(str(modpath), (0, 0))
+    assert not index['gf_index_sample.Interface']['output_spec']
+    assert 'gf_index_sample' in sys.modules
@@ -0,0 +1,300 @@
+import json
+import os
+import os.path as op
+import subprocess
+import sys
+
+import pytest
+
+from gearificator.consts import (
+    GEAR_MANIFEST_FILENAME,
+    GEAR_METRICS_FILENAME,
+    GEAR_PLAN_FILENAME,
+)
+from gearificator.run import (
+    BIDS_PAIR_BY,
+    ResourceMonitor,
+    create_plan,
+    get_input_sets,
+    get_interface,
+    load_plan,
+    run_batch,
+)
+
+# Upper bound (in seconds) on the cumulative time of gearificator imports
+# to get the runtime going.  Importing nipype alone takes longer
+RUNTIME_IMPORT_BUDGET = 0.3
+# Modules which must not be imported until the interface is instantiated
+HEAVY_MODULES = ('nipype', 'numpy', 'nibabel', 'scipy')
+
+
+def _get_import_times(stderr):
+    """Return list of (module, self, cumulative times) from -X importtime"""
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # the header
+        # nesting is indicated by indentation, which we keep
+        times.append((module.rstrip()[1:],
+                      int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return times
+
+
+def test_runtime_import_time(tmpdir):
+    tmpdir.join(GEAR_MANIFEST_FILENAME).write(json.dumps({
+        'inputs': {'in_file': {'description': 'input file'}},
+        'custom': {'gearificator': {
+            'interface': 'nipype.interfaces.fsl.preprocess:BET'}},
+    }))
+    topdir = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+    env = dict(os.environ, FLYWHEEL=str(tmpdir),
+               PYTHONPATH=os.pathsep.join(
+                   [topdir] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'gearificator', '--help'],
+        cwd=str(tmpdir), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    assert proc.returncode == 0, proc.stderr
+    assert 'in_file: input file' in proc.stdout
+    times = _get_import_times(proc.stderr)
+    modules = [m.strip() for m, _, _ in times]
+    assert 'gearificator.run' in modules
+    heavy = [m for m in modules if m.split('.')[0] in HEAVY_MODULES]
+    assert not heavy
+    # only top level imports, so nothing is counted twice
+    gearificator_time = sum(
+        cumulative for m, _, cumulative in times
+        if not m.startswith(' ') and m.split('.')[0] == 'gearificator')
+    assert gearificator_time < RUNTIME_IMPORT_BUDGET, \
+        "Runtime imports took %.3f sec" % gearificator_time
+
+
+class DummyInterface(object):
+    """Records what it was parametrized with"""
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+def test_plan(tmpdir):
+    manifest = {
+        'inputs': {'in_file': {}, 'mask': {'optional': True}},
+        'config': {'frac': {'default': 0.5}, 'flag': {'default': None},
+                   'other': {}},
+        'custom': {'gearificator': {
+            'interface': '%s:DummyInterface' % __name__,
+            'outputs': {'out_file': {}}}},
+    }
+    plan = create_plan(manifest)
+    assert plan['interface'] == '%s:DummyInterface' % __name__
+    assert plan['inputs'] == {
+        'in_file': {'kwarg': 'in_file', 'optional': False},
+        'mask': {'kwarg': 'mask', 'optional': True}}
+    assert plan['defaults'] == {'frac': 0.5, 'flag': None}
+    assert plan['outputs'] == ['out_file']
+    # stays the same whenever saved/loaded
+    assert json.loads(json.dumps(plan)) == plan
+
+    indir = tmpdir.ensure('input', dir=True)
+    in_file = str(indir.ensure('in_file', 'in.nii'))
+    outdir = str(tmpdir.join('output'))
+    # the same with the plan, or with the manifest only
+    for interface in (
+            get_interface(None, {'frac': 0.3}, str(indir), outdir, plan=plan),
+            get_interface(manifest, {'frac': 0.3}, str(indir), outdir)):
+        assert isinstance(interface, DummyInterface)
+        assert interface.kwargs == {'in_file': in_file, 'frac': 0.3}
+
+    assert load_plan(str(tmpdir)) is None
+    tmpdir.join(GEAR_PLAN_FILENAME).write(json.dumps(plan))
+    assert load_plan(str(tmpdir)) == plan
+    tmpdir.join(GEAR_PLAN_FILENAME).write(json.dumps(dict(plan, version=0)))
+    assert load_plan(str(tmpdir)) is None
+
+
+def test_get_input_sets():
+    assert get_input_sets({'a': ['1.nii']}) == [('', {'a': '1.nii'})]
+    input_files = {
+        'anat': ['/in/anat/sub-01_T1w.nii.gz', '/in/anat/sub-02_T1w.nii.gz'],
+        'func': ['/in/func/sub-01_bold.nii', '/in/func/sub-02_bold.nii'],
+        'mask': ['/in/mask/mask.nii'],
+    }
+    input_sets = get_input_sets(input_files)
+    assert input_sets == [
+        ('sub-01_T1w', {'anat': '/in/anat/sub-01_T1w.nii.gz',
+                        'func': '/in/func/sub-01_bold.nii',
+                        'mask': '/in/mask/mask.nii'}),
+        ('sub-02_T1w', {'anat': '/in/anat/sub-02_T1w.nii.gz',
+                        'func': '/in/func/sub-02_bold.nii',
+                        'mask': '/in/mask/mask.nii'}),
+    ]
+    # the same pairs by the entities, named after them
+    assert get_input_sets(input_files, BIDS_PAIR_BY) == [
+        ('sub-01', input_sets[0][1]), ('sub-02', input_sets[1][1])]
+
+    input_files['func'] = ['/in/func/sub-02_bold.nii']
+    input_files['anat'].append('/in/anat/sub-03_T1w.nii.gz')
+    with pytest.raises(ValueError):
+        # the single func would be used for all anats
+        get_input_sets(dict(input_files, func=input_files['func'] * 2))
+    input_files['func'] = [
+        '/in/func/sub-03_bold.nii', '/in/func/sub-01_bold.nii']
+    with pytest.raises(ValueError) as cme:
+        get_input_sets(input_files, BIDS_PAIR_BY)
+    assert 'sub-02' in str(cme.value)
+
+
+class BatchInterface(DummyInterface):
+    """Writes its inputs into the output, fails on the 'fail' input"""
+    class Results(object):
+        pass
+
+    def run(self):
+        with open(self.kwargs['in_file']) as f:
+            content = f.read()
+        if content == 'fail':
+            raise RuntimeError("failing")
+        with open('out.txt', 'w') as f:
+            f.write('%s %s' % (content, open(self.kwargs['mask']).read()))
+        out = self.Results()
+        out.outputs = self.Results()
+        out.outputs.out_file = op.abspath('out.txt')
+        return out
+
+
+def test_run_batch(tmpdir):
+    plan = create_plan({
+        'inputs': {'in_file': {}, 'mask': {}},
+        'custom': {'gearificator': {
+            'interface': '%s:BatchInterface' % __name__,
+            'outputs': {'out_file': {}}}},
+    })
+    indir = tmpdir.ensure('input', dir=True)
+    outdir = tmpdir.join('output')
+    for sub in '01', '02', '03':
+        indir.ensure('in_file', 'sub-%s.txt' % sub).write(sub)
+    indir.ensure('mask', 'mask.txt').write('mask')
+    for jobs in 1, 2:
+        errors = run_batch({}, str(indir), str(outdir.join(str(jobs))), plan,
+                           jobs=jobs)
+        assert errors == {}
+        for sub in '01', '02', '03':
+            assert outdir.join(str(jobs), 'sub-%s' % sub, 'out.txt').read() \
+                == '%s mask' % sub
+
+    indir.join('in_file', 'sub-02.txt').write('fail')
+    errors = run_batch({}, str(indir), str(outdir.join('failed')), plan,
+                       jobs=2)
+    assert list(errors) == ['sub-02']
+    assert 'failing' in errors['sub-02']
+    assert outdir.join('failed', 'sub-03', 'out.txt').exists()
+    # metrics are saved for the failed run as well
+    metrics = json.loads(
+        outdir.join('failed', 'sub-02', GEAR_METRICS_FILENAME).read())
+    assert metrics['failed']
+    assert metrics['error'] == 'RuntimeError: failing'
+    assert metrics['wall_time'] >= 0
+    # and summarized at the top
+    metrics = json.loads(
+        outdir.join('failed', GEAR_METRICS_FILENAME).read())
+    assert metrics['failed'] == ['sub-02']
+    assert list(metrics['sets']) == ['sub-01', 'sub-02', 'sub-03']
+    assert metrics['sets']['sub-02']['error'] == 'RuntimeError: failing'
+    assert not metrics['sets']['sub-03']['failed']
+
+
+def test_results_cache(tmpdir, monkeypatch):
+    from gearificator.consts import RESULTS_CACHE_ENVVAR
+    from gearificator.run import run
+    monkeypatch.setenv(RESULTS_CACHE_ENVVAR, str(tmpdir.join('cache')))
+    plan = create_plan({
+        'inputs': {'in_file': {}, 'mask': {}},
+        'config': {'frac': {'default': 0.5}},
+        'custom': {'gearificator': {
+            'interface': '%s:BatchInterface' % __name__,
+            'outputs': {'out_file': {}}}},
+    })
+    indir = tmpdir.ensure('input', dir=True)
+    indir.ensure('in_file', 'sub-01.txt').write('01')
+    indir.ensure('mask', 'mask.txt').write('mask')
+
+    def _run(name, config={}):
+        outdir = str(tmpdir.join(name))
+        out = run(None, config, str(indir), outdir, plan=plan)
+        assert open(op.join(outdir, 'out.txt')).read() \
+            == open(str(indir.join('in_file', 'sub-01.txt'))).read() + ' mask'
+        return out, op.join(outdir, 'out.txt')
+
+    out, out_file = _run('out1')
+    assert out is not None
+    out, cached_file = _run('out2')
+    assert out is None  # restored
+    assert os.stat(out_file).st_ino == os.stat(cached_file).st_ino
+    # metrics are of the particular run
+    metrics = [
+        json.load(open(str(tmpdir.join(d, GEAR_METRICS_FILENAME))))
+        for d in ('out1', 'out2')]
+    assert [m['cached'] for m in metrics] == [False, True]
+    assert [m['failed'] for m in metrics] == [False, False]
+    # config matters
+    assert _run('out3', {'frac': 0.3})[0] is not None
+    assert _run('out4', {'frac': 0.5})[0] is None
+    # content of the inputs matters
+    indir.join('in_file', 'sub-01.txt').write('02')
+    assert _run('out5')[0] is not None
+
+    # failure to restore falls back to running the interface
+    from gearificator import run as run_mod
+    stage_file = run_mod.stage_file
+
+    def failing_stage_file(src, dst):
+        stage_file(src, dst)
+        raise OSError("No space left on device")
+    monkeypatch.setattr(run_mod, 'stage_file', failing_stage_file)
+    assert _run('out6')[0] is not None
+    cache_dir = str(tmpdir.join('cache'))
+    # digests of the inputs are cached along with the entries
+    assert op.exists(op.join(cache_dir, 'digests.json'))
+    prefix = [d for d in os.listdir(cache_dir)
+              if op.isdir(op.join(cache_dir, d))][0]
+    key = os.listdir(op.join(cache_dir, prefix))[0]
+    outdir = tmpdir.ensure('partial', dir=True)
+    assert not run_mod.ResultsCache(cache_dir).restore(key, str(outdir))
+    # and whatever was staged gets removed
+    assert outdir.listdir() == []
+    monkeypatch.undo()
+
+    monkeypatch.delenv(RESULTS_CACHE_ENVVAR, raising=False)
+    assert _run('out7')[0] is not None
+
+
+def test_resource_monitor(tmpdir):
+    out_file = str(tmpdir.join('out'))
+    with ResourceMonitor(interval=0.05) as monitor:
+        # a child which allocates ~100MB and writes 1MB
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import time; x = bytearray(100 * 2 ** 20); '
+            'open(%r, "wb").write(x[:2 ** 20]); time.sleep(0.3)' % out_file])
+    metrics = monitor.get_metrics()
+    assert 0.3 < metrics['wall_time'] < 10
+    assert metrics['cpu_user'] + metrics['cpu_system'] > 0
+    assert metrics['peak_rss'] > 100 * 2 ** 20
+    if metrics['write_chars'] is not None:  # /proc/self/io is available
+        assert metrics['write_chars'] >= 2 ** 20
+    assert metrics['cpus'] >= 1
+    assert metrics['lifetime_peak_rss_children'] > 100 * 2 ** 20
+
+    # peak of the earlier allocation is not attributed to the later context
+    x = bytearray(300 * 2 ** 20)
+    x[::4096] = b'x' * len(x[::4096])  # so it is resident
+    del x
+    with ResourceMonitor(interval=0.05) as monitor:
+        pass
+    metrics = monitor.get_metrics()
+    assert metrics['lifetime_peak_rss_self'] > 300 * 2 ** 20
+    if metrics['peak_rss'] is not None:  # /proc is available
+        assert metrics['peak_rss'] < 300 * 2 ** 20
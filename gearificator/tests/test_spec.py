@@ -27,7 +27,14 @@
 import sys
 
 from gearificator import get_logger
-from gearificator.spec import get_updated, get_object_from_path
+from gearificator.index import InterfaceIndex
+from gearificator.spec import (
+    get_updated,
+    get_object_from_path,
+    GearJob,
+    _run_gear_jobs,
+    _traverse,
+)
 
 __author__ = 'yoh'
 __license__ = 'MIT'
@@ -45,4 +52,63 @@ def test_get_object_from_path():
     f = get_object_from_path
     assert f('sys.stdout') is sys.stdout
     assert f('gearificator.get_logger') is get_logger
-    assert f('gearificator', 'get_logger') is get_logger
\ No newline at end of file
+    assert f('gearificator', 'get_logger') is get_logger
+
+
+def test_run_gear_jobs_collects_failures():
+    jobs = [
+        GearJob('gearificator_nonexisting%d' % i, (), {}, None,
+                'skip', None, None, {})
+        for i in range(3)
+    ]
+    for njobs in 1, 2:
+        results = _run_gear_jobs(jobs, njobs, gears_per_worker=1)
+        # order is preserved and failures do not abort the processing
+        assert [r.toppath for r in results] == [j.toppath for j in jobs]
+        assert all(r.status == 'error' for r in results)
+
+
+_FAKE_INTERFACES = """
+class Interface1(object):
+    input_spec = output_spec = object
+
+
+class NoOutputs(object):
+    input_spec = object
+
+
+def function():
+    pass
+"""
+
+
+def test_traverse_recurse(tmpdir, monkeypatch):
+    pkg = tmpdir.ensure('fakeifaces', dir=True)
+    pkg.join('__init__.py').write('from . import sub\n' + _FAKE_INTERFACES)
+    pkg.join('sub.py').write(_FAKE_INTERFACES.replace('1', '2'))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    index = InterfaceIndex(str(tmpdir.join('index.json')))
+
+    def _get_jobs(spec):
+        gear_jobs = []
+        _traverse(gear_jobs, index, str(tmpdir.join('gears')), spec=spec)
+        return sorted(j.toppath for j in gear_jobs)
+
+    # without %recurse only explicitly listed are considered
+    assert _get_jobs({'fakeifaces': {}}) == []
+    assert _get_jobs({'fakeifaces': {'Interface1': {}}}) \
+        == ['fakeifaces.Interface1']
+    # with it -- all interfaces of the module and its submodules
+    assert _get_jobs({'fakeifaces': {'%recurse': True}}) \
+        == ['fakeifaces.Interface1', 'fakeifaces.sub.Interface2']
+    assert _get_jobs({'fakeifaces.sub': {'%recurse': True}}) \
+        == ['fakeifaces.sub.Interface2']
+
+
+def test_process_lanes_with_jobs(tmpdir):
+    from click.testing import CliRunner
+    from gearificator.cli import cli
+    result = CliRunner().invoke(
+        cli, ['spec', 'process', '-j', '2', '--lane', 'build=1', str(tmpdir)])
+    assert result.exit_code == 2
+    assert "--lane could not be used with --jobs" in result.output
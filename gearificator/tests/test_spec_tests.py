@@ -0,0 +1,462 @@
+import json
+import os
+import os.path as op
+import shutil
+
+import pytest
+
+from gearificator.consts import (
+    GEAR_MANIFEST_FILENAME,
+    GEAR_METRICS_FILENAME,
+    GEAR_RUN_FILENAME,
+)
+# not importing TestJob directly so pytest does not try to collect it
+from gearificator import spec_tests, utils
+from gearificator.spec_tests import (
+    run_test_jobs,
+    summarize_test_results,
+)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    """Do not pollute user's cache (e.g. test history) while testing"""
+    monkeypatch.setenv('GEARIFICATOR_CACHE_DIR', str(tmpdir.join('cache')))
+
+
+def _make_spec(tmpdir):
+    """A spec with a "gear" which just copies its input into output"""
+    tmpdir.ensure('inputs', 'ds', 'in.txt').write('content')
+    gearpath = tmpdir.ensure('gears', 'copy', dir=True)
+    gearpath.join(GEAR_MANIFEST_FILENAME).write('{}')
+    run = gearpath.join(GEAR_RUN_FILENAME)
+    run.write("#!/bin/sh\ncp input/in/in.txt output/out.txt\n")
+    run.chmod(0o755)
+    tests = tmpdir.ensure('gears', 'copy', 'tests', dir=True)
+    for test, target in ('good', 'content'), ('bad', 'other'):
+        tests.join(test + '.yaml').write("inputs:\n  in: ds/in.txt\n")
+        tests.ensure(test, 'out.txt').write(target)
+    return str(gearpath), str(tests)
+
+
+def test_run_test_jobs(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        utils, '_digest_cache', utils.DigestCache(str(tmpdir.join('digests'))))
+    gearpath, tests = _make_spec(tmpdir)
+    test_jobs = [
+        spec_tests.TestJob('copy', test, op.join(tests, test + '.yaml'),
+                str(tmpdir.join('runs', test, str(i))), gearpath,
+                'native', None)
+        for i in range(3)
+        for test in ('good', 'bad')
+    ]
+    for jobs in 1, 4:
+        results = run_test_jobs(test_jobs, jobs)
+        assert [r.testname for r in results] \
+            == [j.testname for j in test_jobs]
+        assert [r.status for r in results] == ['passed', 'failed'] * 3
+        assert 'differ' in results[1].message
+        failed = summarize_test_results(results)
+        assert failed == results[1::2]
+        assert results[0].staging == 'hardlink'
+        # ran in their own directories
+        assert op.exists(op.join(test_jobs[0].testdir, 'output', 'out.txt'))
+
+    results = run_test_jobs(test_jobs[:1], staging='symlink')
+    assert results[0].status == 'passed'
+    assert results[0].staging == 'symlink'
+    assert op.islink(op.join(test_jobs[0].testdir, 'input', 'in', 'in.txt'))
+
+
+def test_check_fingerprint(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        utils, '_digest_cache', utils.DigestCache(str(tmpdir.join('digests'))))
+    gearpath, tests = _make_spec(tmpdir)
+    testfile = op.join(tests, 'good.yaml')
+    testdir = str(tmpdir.join('run'))
+    results = run_test_jobs([spec_tests.TestJob(
+        'copy', 'good', testfile, testdir, gearpath, 'native', None)])
+    assert results[0].status == 'passed'
+
+    fingerprint_path = spec_tests.record_test_fingerprint(testfile, testdir)
+    assert fingerprint_path == op.join(tests, 'good.fingerprint.json')
+    # target outputs are no longer needed
+    shutil.rmtree(op.join(tests, 'good'))
+    spec_tests._check(testfile, testdir)
+
+    with open(op.join(testdir, 'output', 'out.txt'), 'w') as f:
+        f.write('changed')
+    with pytest.raises(AssertionError):
+        spec_tests._check(testfile, testdir)
+    os.unlink(op.join(testdir, 'output', 'out.txt'))
+    with pytest.raises(AssertionError) as cme:
+        spec_tests._check(testfile, testdir)
+    assert 'not found' in str(cme.value)
+
+    fingerprint = utils.load_json(fingerprint_path)
+    fingerprint['version'] = 1
+    with open(fingerprint_path, 'w') as f:
+        json.dump(fingerprint, f)
+    with pytest.raises(AssertionError) as cme:
+        spec_tests._check(testfile, testdir)
+    assert 'Record it again' in str(cme.value)
+
+
+def test_nifti_fingerprint(tmpdir):
+    nib = pytest.importorskip('nibabel')
+    import numpy as np
+    data = np.arange(24, dtype=np.int16).reshape((2, 3, 4))
+    nib.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(
+        str(tmpdir.join('float.nii.gz')))
+    paths = []
+    for i, (d, zoom) in enumerate([(data, 1), (data, 1), (data + 1, 1),
+                                   (data, 2)]):
+        paths.append(str(tmpdir.join('%d.nii.gz' % i)))
+        img = nib.Nifti1Image(d, np.diag([zoom, zoom, zoom, 1]))
+        img.to_filename(paths[-1])
+    # through json, as it would be stored
+    target = json.loads(json.dumps(spec_tests.get_file_fingerprint(paths[0])))
+    assert target['nifti']['shape'] == [2, 3, 4]
+    assert 'size' not in target
+    assert spec_tests.check_fingerprint(target, paths[1]) is None
+    assert 'mismatch' in spec_tests.check_fingerprint(target, paths[2])
+    assert 'header' in spec_tests.check_fingerprint(target, paths[3])
+    img = nib.load(paths[1])
+    img.header['intent_code'] = 1001
+    img.to_filename(paths[1])
+    assert 'intent_code' in spec_tests.check_fingerprint(target, paths[1])
+
+    # values are compared within the tolerances, as check_nifti does
+    noisy = str(tmpdir.join('noisy.nii.gz'))
+    nib.Nifti1Image(data + np.float32(0.01), np.eye(4)).to_filename(noisy)
+    shuffled = str(tmpdir.join('shuffled.nii.gz'))
+    nib.Nifti1Image(data[::-1].astype(np.float32), np.eye(4)).to_filename(
+        shuffled)
+    target = json.loads(json.dumps(spec_tests.get_file_fingerprint(
+        str(tmpdir.join('float.nii.gz')))))
+    check = spec_tests.check_fingerprint
+    assert 'values mismatch' in check(target, noisy)
+    assert check(target, noisy, tolerances={'atol': 0.02}) is None
+    assert 'mean' in check(target, noisy, tolerances={'atol': 0.001})
+    # the same statistics, but not the same values
+    assert 'digest' in check(target, shuffled)
+    assert check(target, shuffled, tolerances={'atol': 0.001}) is None
+
+
+def test_check_nifti(tmpdir, monkeypatch):
+    nib = pytest.importorskip('nibabel')
+    import numpy as np
+    # so even small images are compared in multiple slabs
+    monkeypatch.setattr(spec_tests, 'NIFTI_SLAB_VOXELS', 10)
+    data = np.arange(1, 121, dtype=np.float32).reshape((2, 3, 4, 5))
+
+    def _save(name, d, affine=np.eye(4)):
+        path = str(tmpdir.join(name))
+        nib.Nifti1Image(d, affine).to_filename(path)
+        return path
+
+    target = _save('target.nii.gz', data)
+    check = spec_tests.check_nifti
+    assert check(target, _save('same.nii.gz', data)) is None
+
+    noisy = data.copy()
+    noisy[..., 3] += 0.01
+    noisy = _save('noisy.nii.gz', noisy)
+    assert 'beyond tolerances' in check(target, noisy)
+    assert check(target, noisy, {'atol': 0.02}) is None
+    assert check(target, noisy, {'rtol': 0.01}) is None
+    assert 'slice(3, 4' in check(target, noisy, {'rtol': 0.001})
+    assert check(target, noisy, {'atol': 0.02, 'min_corr': 0.99}) is None
+
+    shuffled = _save(
+        'shuffled.nii.gz',
+        np.random.RandomState(0).permutation(data.ravel()).reshape(data.shape))
+    msg = check(target, shuffled, {'atol': 1000, 'min_corr': 0.99})
+    assert msg.startswith('correlation')
+
+    # the same non-finite values match, within any tolerances
+    nonfinite = data.copy()
+    nonfinite[0, 0, 0, 0] = np.nan
+    nonfinite[1, 0, 0, 0] = np.inf
+    nonfinite[0, 1, 0, 0] = -np.inf
+    nonfinite_target = _save('nonfinite_target.nii.gz', nonfinite)
+    for tolerances in None, {'rtol': 0.01}, {'atol': 1, 'min_corr': 0.99}:
+        assert check(nonfinite_target,
+                     _save('nonfinite.nii.gz', nonfinite), tolerances) is None
+    for value in np.nan, -np.inf, 1:
+        other = nonfinite.copy()
+        other[1, 0, 0, 0] = value
+        assert '1 voxel(s) differ' in check(
+            nonfinite_target, _save('other.nii.gz', other), {'rtol': 1})
+
+    # all the header fields are compared
+    def _save_header(name, **fields):
+        img = nib.Nifti1Image(data, np.eye(4))
+        for field, value in fields.items():
+            img.header[field] = value
+        path = str(tmpdir.join(name))
+        img.to_filename(path)
+        return path
+    for field, value in (('intent_code', 1001), ('xyzt_units', 10),
+                         ('qform_code', 1), ('descrip', b'other')):
+        msg = check(target, _save_header('header.nii.gz', **{field: value}))
+        assert field in msg
+    described = _save_header('described.nii.gz', descrip=b'other')
+    assert check(target, described, {'ignore_header': ['descrip']}) is None
+    # geometry within header_atol
+    shifted = _save('shifted.nii.gz', data,
+                    np.diag([1, 1, 1 + 1e-5, 1]))
+    assert 'affine' in check(target, shifted)
+    assert check(target, shifted, {'header_atol': 1e-4}) is None
+
+    assert 'shape' in check(target, _save('shape.nii.gz', data[..., :3]))
+    assert 'affine' in check(
+        target, _save('affine.nii.gz', data, np.diag([2, 2, 2, 1])))
+
+    tolerances = {'atol': 1, 'files': {'*.nii.gz': {'min_corr': 0.9},
+                                       'sub/*': {'atol': 2}}}
+    assert spec_tests.get_file_tolerances(tolerances, 'some.nii.gz') \
+        == {'atol': 1, 'min_corr': 0.9}
+    assert spec_tests.get_file_tolerances(tolerances, 'sub/some.txt') \
+        == {'atol': 2}
+
+
+def test_check_nifti_single_pass(tmpdir, monkeypatch):
+    nib = pytest.importorskip('nibabel')
+    import numpy as np
+    from nibabel import openers
+    monkeypatch.setattr(spec_tests, 'NIFTI_SLAB_VOXELS', 6)
+    data = np.arange(120, dtype=np.float32).reshape((2, 3, 4, 5))
+    paths = [str(tmpdir.join('%s.nii.gz' % n)) for n in ('target', 'output')]
+    for path in paths:
+        nib.Nifti1Image(data, np.eye(4)).to_filename(path)
+
+    opened = []
+
+    class ImageOpener(openers.ImageOpener):
+        def __init__(self, *args, **kwargs):
+            super(ImageOpener, self).__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(openers, 'ImageOpener', ImageOpener)
+    assert spec_tests.check_nifti(*paths) is None
+    # data of each file is read in 20 slabs but decompressed only once
+    opened = [o for o in opened if o.name in paths]
+    assert sorted(o.name for o in opened) == sorted(paths)
+    # and files are closed afterwards
+    assert all(o.closed for o in opened)
+
+
+def test_correlation_stats():
+    import numpy as np
+    x = np.random.RandomState(1).normal(size=1000)
+    y = x + np.random.RandomState(2).normal(size=1000)
+    stats = spec_tests._CorrelationStats()
+    for i in range(0, 1000, 300):
+        stats.update(x[i:i + 300], y[i:i + 300])
+    assert np.allclose(stats.get_correlation(), np.corrcoef(x, y)[0, 1])
+
+
+def test_comparators(tmpdir):
+    comparators = spec_tests.comparators
+    for f, name in (('sub/out.nii.gz', 'nifti'), ('out.nii', 'nifti'),
+                    ('out.json', 'json'), ('dwi.bvec', 'numeric'),
+                    ('bvals', 'numeric'), ('log.txt', 'text'),
+                    ('out.nii.gz.md5', 'digest')):
+        assert comparators(f)[0] == name
+
+    def _write(name, content):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    target = _write('t.json', json.dumps({'a': 1, 'b': {'c': [1, 2.0]}}))
+    same = _write('s.json', json.dumps({'b': {'c': [1, 2.0]}, 'a': 1}))
+    close = _write('c.json', json.dumps({'b': {'c': [1, 2.01]}, 'a': 1}))
+    other = _write('o.json', json.dumps({'b': {'c': [1, 3]}, 'd': 1}))
+    assert spec_tests.check_json(target, same) is None
+    assert spec_tests.check_json(target, close, {'atol': 0.1}) is None
+    diff = spec_tests.check_json(target, other)
+    for d in "a: only in target", "b.c[1]: 2.0 != 3", "d: only in output":
+        assert d in diff
+
+    target = _write('t.txt', 'line1\nline2\nline3\n')
+    assert spec_tests.check_text(
+        target, _write('s.txt', 'line1\nline2\nline3\n')) is None
+    assert '+line4' in spec_tests.check_text(
+        target, _write('o.txt', 'line1\nline4\nline3\n'))
+    # newlines must match unless ignored explicitly
+    for content in 'line1\nline2\nline3', 'line1\r\nline2\r\nline3\r\n':
+        with open(str(tmpdir.join('n.txt')), 'wb') as f:
+            f.write(content.encode())
+        output = str(tmpdir.join('n.txt'))
+        assert 'only in newlines' in spec_tests.check_text(target, output)
+        assert spec_tests.check_text(
+            target, output, {'ignore_newlines': True}) is None
+    assert '+line4' in spec_tests.check_text(
+        target, _write('o.txt', 'line1\nline4\nline3'),
+        {'ignore_newlines': True})
+
+    target = _write('t.bvec', '0 1 0\n0 0 1\n')
+    close = _write('c.bvec', '0 1.001 0\n0 0 1\n')
+    assert spec_tests.check_numeric_text(target, target) is None
+    assert 'beyond tolerances' in spec_tests.check_numeric_text(target, close)
+    assert spec_tests.check_numeric_text(target, close, {'atol': 0.01}) \
+        is None
+    assert 'shape' in spec_tests.check_numeric_text(
+        target, _write('o.bvec', '0 1 0\n'))
+
+
+def test_diff_trees(tmpdir):
+    target = tmpdir.ensure('target', dir=True)
+    output = tmpdir.ensure('output', dir=True)
+    for d in target, output:
+        d.ensure('sub', 'same_size').write('abc')
+        d.ensure('only_in_%s' % d.basename).write('')
+    target.join('size').write('abc')
+    output.join('size').write('abcd')
+    target.join('size.json').write('{}')
+    output.join('size.json').write('{ }')
+    target.join('linked').write('content')
+    os.link(str(target.join('linked')), str(output.join('linked')))
+    target.join('type').write('')
+    output.ensure('type', 'sub', dir=True)
+    output.join('type_link').mksymlinkto(output.join('sub'))
+    target.join('type_link').write('')
+    # metrics of the runs are not compared, even if copied into the target
+    output.join(GEAR_METRICS_FILENAME).write('{}')
+    # also of the batch runs
+    output.join('sub', GEAR_METRICS_FILENAME).write('{}')
+
+    target_infos = dict(spec_tests.scan_tree(str(target)))
+    assert sorted(target_infos) == [
+        'linked', 'only_in_target', 'size', 'size.json',
+        op.join('sub', 'same_size'), 'type', 'type_link']
+    target_infos[GEAR_METRICS_FILENAME] = spec_tests.FileInfo(
+        2, None, None, None)
+    target_infos[op.join('sub', GEAR_METRICS_FILENAME)] = \
+        spec_tests.FileInfo(2, None, None, None)
+    diffs = dict(
+        (d.path, d.status)
+        for d in spec_tests.diff_trees(
+            target_infos, str(output),
+            bytewise=spec_tests.comparators.is_bytewise))
+    assert diffs == {
+        'linked': 'same',
+        'only_in_output': 'only-in-output',
+        'only_in_target': 'only-in-target',
+        'size': 'size',
+        # json is not compared bytewise
+        'size.json': 'compare',
+        op.join('sub', 'same_size'): 'compare',
+        # directories themselves are not listed
+        'type': 'only-in-target',
+        'type_link': 'type',
+    }
+
+
+def test_test_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('GEARIFICATOR_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(utils, '_digest_cache', None)
+    gearpath, tests = _make_spec(tmpdir)
+    job = spec_tests.TestJob(
+        'copy', 'good', op.join(tests, 'good.yaml'), str(tmpdir.join('run')),
+        gearpath, 'native', None)
+
+    def _run(**kwargs):
+        return run_test_jobs([job], **kwargs)[0].status
+
+    # without gear fingerprint results are not cached
+    assert _run() == 'passed'
+    assert _run() == 'passed'
+    with open(op.join(gearpath, '.gearificator-fingerprint.json'), 'w') as f:
+        json.dump({'fingerprint': '123'}, f)
+    assert _run() == 'passed'
+    assert _run() == 'cached'
+    assert _run(use_cache=False) == 'passed'
+    assert summarize_test_results(
+        run_test_jobs([job, job], use_cache=True)) == []
+
+    # changes to inputs or targets invalidate
+    tmpdir.join('inputs', 'ds', 'in.txt').write('changed')
+    assert _run() == 'failed'
+    assert _run() == 'failed'
+    with open(op.join(tests, 'good', 'out.txt'), 'w') as f:
+        f.write('changed')
+    assert _run() == 'passed'
+    assert _run() == 'cached'
+
+
+def test_test_limits(tmpdir, monkeypatch):
+    from gearificator import engine
+    monkeypatch.setattr(engine, 'KILL_GRACE', 1)
+    assert spec_tests.get_test_limits({}) == {}
+    # None in the spec lifts the default limit
+    assert spec_tests.get_test_limits(
+        {'limits': {'memory': '1G', 'walltime': None}},
+        {'walltime': 10, 'cpus': 2}) \
+        == {'memory': 1024 ** 3, 'cpus': 2.}
+    with pytest.raises(ValueError):
+        spec_tests.get_test_limits({'limits': {'time': 1}})
+
+    gearpath, tests = _make_spec(tmpdir)
+    with open(op.join(gearpath, GEAR_RUN_FILENAME), 'a') as f:
+        f.write("sleep 30\n")
+    with open(op.join(tests, 'good.yaml'), 'a') as f:
+        f.write("limits:\n  walltime: 0.5\n")
+    test_jobs = [
+        spec_tests.TestJob('copy', test, op.join(tests, test + '.yaml'),
+                           str(tmpdir.join('runs', test)), gearpath,
+                           'native', None)
+        for test in ('good', 'bad')
+    ]
+    # default limit is overridden by the test spec
+    results = run_test_jobs(test_jobs, jobs=2, limits={'walltime': 3})
+    assert [r.status for r in results] == ['timed-out', 'timed-out']
+    assert results[0].duration < results[1].duration < 10
+    assert summarize_test_results(results) == results
+
+
+def test_test_order(tmpdir):
+    history = spec_tests.TestHistory(str(tmpdir.join('history.json')))
+    gearpath, tests = _make_spec(tmpdir)
+    tests_ = ('good', 'bad', 'good2', 'bad2')
+    for test in tests_[2:]:
+        shutil.copy(op.join(tests, test[:-1] + '.yaml'),
+                    op.join(tests, test + '.yaml'))
+        shutil.copytree(op.join(tests, test[:-1]), op.join(tests, test))
+    test_jobs = [
+        spec_tests.TestJob('copy', test, op.join(tests, test + '.yaml'),
+                           str(tmpdir.join('runs', test)), gearpath,
+                           'native', None)
+        for test in tests_
+    ]
+    get_order = spec_tests.get_test_jobs_order
+    assert get_order(test_jobs, 'failed-first', history) == [0, 1, 2, 3]
+
+    results = run_test_jobs(test_jobs[:2], history=history)
+    assert [r.status for r in results] == ['passed', 'failed']
+    # and it got saved
+    history = spec_tests.TestHistory(history.path)
+    assert history.get(test_jobs[0])['status'] == 'passed'
+    assert history.get(test_jobs[2]) is None
+    assert get_order(test_jobs, 'spec', history) == [0, 1, 2, 3]
+    # failed, without history, passed
+    assert get_order(test_jobs, 'failed-first', history) == [1, 2, 3, 0]
+    history.record(test_jobs[3], spec_tests.TestResult(
+        'copy', 'bad2', 'failed', '', 0., ''))
+    history.record(test_jobs[1], spec_tests.TestResult(
+        'copy', 'bad', 'failed', '', 100., ''))
+    assert get_order(test_jobs, 'failed-first', history) == [3, 1, 2, 0]
+    assert get_order(test_jobs, 'fastest-first', history)[-1] == 1
+
+    # the first failure stops scheduling of the others
+    for jobs in 1, 2:
+        results = run_test_jobs(test_jobs, jobs=jobs, order='failed-first',
+                                fail_fast=True, history=history)
+        statuses = [r.status for r in results]
+        assert statuses[3] == 'failed'
+        assert statuses[0] == 'skipped'
+        failed = summarize_test_results(results)
+        assert all(r.status == 'failed' for r in failed)
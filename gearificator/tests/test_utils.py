@@ -0,0 +1,151 @@
+import hashlib
+import os
+import stat
+
+from pytest import raises
+
+from gearificator import utils
+from gearificator.utils import (
+    DigestCache,
+    file_digest,
+    JsonStore,
+    parse_size,
+    stage_file,
+    write_if_changed,
+)
+
+
+def test_write_if_changed(tmpdir):
+    fname = str(tmpdir.join('file'))
+    assert write_if_changed(fname, u'content')
+    with open(fname) as f:
+        assert f.read() == 'content'
+    os.utime(fname, (0, 0))
+    assert not write_if_changed(fname, b'content')
+    assert os.stat(fname).st_mtime == 0
+    # no temporary files left behind
+    assert os.listdir(str(tmpdir)) == ['file']
+
+    # only the mode gets changed
+    assert not write_if_changed(fname, 'content', mode=0o755)
+    assert os.stat(fname).st_mtime == 0
+    assert stat.S_IMODE(os.stat(fname).st_mode) == 0o755
+
+    assert write_if_changed(fname, 'new content')
+    with open(fname) as f:
+        assert f.read() == 'new content'
+    # mode is retained
+    assert stat.S_IMODE(os.stat(fname).st_mode) == 0o755
+    assert os.listdir(str(tmpdir)) == ['file']
+
+    # new files get the umask in effect at the time of writing
+    umask = os.umask(0o027)
+    try:
+        fname2 = str(tmpdir.join('file2'))
+        assert write_if_changed(fname2, 'content')
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(fname2).st_mode) == 0o640
+
+
+def test_stage_file(tmpdir):
+    src = tmpdir.join('src')
+    src.write('content')
+    # e.g. git-annex'ed files are symlinks
+    tmpdir.join('link').mksymlinkto(src)
+    link = str(tmpdir.join('link'))
+
+    dst = str(tmpdir.join('hardlinked'))
+    assert stage_file(link, dst) == 'hardlink'
+    assert os.stat(dst).st_ino == os.stat(str(src)).st_ino
+
+    dst = str(tmpdir.join('copied'))
+    assert stage_file(link, dst, 'copy') == 'copy'
+    assert not os.path.islink(dst)
+    assert os.stat(dst).st_ino != os.stat(str(src)).st_ino
+
+    dst = str(tmpdir.join('symlinked'))
+    assert stage_file(link, dst, 'symlink') == 'symlink'
+    assert os.readlink(dst) == str(src)
+
+    for dst in ('hardlinked', 'copied', 'symlinked'):
+        assert tmpdir.join(dst).read() == 'content'
+
+
+def test_digest_cache(tmpdir, monkeypatch):
+    fname = str(tmpdir.join('file'))
+    with open(fname, 'wb') as f:
+        f.write(b'content' * 1000000)
+    digest = file_digest(fname)
+    assert digest == hashlib.blake2b(b'content' * 1000000).hexdigest()
+    assert file_digest(fname, 'md5') \
+        == hashlib.md5(b'content' * 1000000).hexdigest()
+
+    cache_path = str(tmpdir.join('cache.json'))
+    cache = DigestCache(cache_path)
+    assert cache.digest(fname) == digest
+    cache.save()
+
+    # a new cache (e.g. in another run) does not recompute it
+    cache = DigestCache(cache_path)
+    computed = []
+    monkeypatch.setattr(
+        utils, 'file_digest', lambda *args: computed.append(args) or 'new')
+    assert cache.digest(fname) == digest
+    assert computed == []
+    # but does when the file changes
+    with open(fname, 'ab') as f:
+        f.write(b'more')
+    assert cache.digest(fname) == 'new'
+    assert len(computed) == 1
+
+
+def test_json_store(tmpdir):
+    path = str(tmpdir.join('store.json'))
+    store1, store2 = JsonStore(path), JsonStore(path)
+    assert store1._get('a') is None
+    store1._set('a', 1)
+    store2._set('b', [2])
+    store1.save()
+    store2.save()
+    # changes of both got merged
+    assert JsonStore(path)._get('a') == 1
+    assert JsonStore(path)._get('b') == [2]
+
+    class OtherStore(JsonStore):
+        VERSION = 2
+    assert OtherStore(path)._get('a') is None
+    with open(path, 'w') as f:
+        f.write('{corrupted')
+    assert JsonStore(path)._get('a') is None
+
+
+def test_parse_size():
+    assert parse_size(None) is None
+    assert parse_size(100) == 100
+    assert parse_size('100') == 100
+    assert parse_size('1.5k') == 1536
+    assert parse_size('512MiB') == 512 * 1024 ** 2
+    assert parse_size('4G') == 4 * 1024 ** 3
+    with raises(ValueError):
+        parse_size('4 apples')
+
+
+def test_get_cpu_count(monkeypatch):
+    ncpus = utils.get_cpu_count()
+    assert ncpus >= 1
+    files = {}
+    monkeypatch.setattr(utils, '_read_sys_file', files.get)
+    assert utils._get_cgroup_cpu_quota() is None
+    files['/sys/fs/cgroup/cpu.max'] = 'max 100000'
+    assert utils._get_cgroup_cpu_quota() is None
+    files['/sys/fs/cgroup/cpu.max'] = '150000 100000'
+    assert utils._get_cgroup_cpu_quota() == 1.5
+    assert utils.get_cpu_count() == min(ncpus, 2)
+    files.clear()
+    files['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '-1'
+    files['/sys/fs/cgroup/cpu/cpu.cfs_period_us'] = '100000'
+    assert utils._get_cgroup_cpu_quota() is None
+    files['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '50000'
+    assert utils._get_cgroup_cpu_quota() == 0.5
+    assert utils.get_cpu_count() == 1
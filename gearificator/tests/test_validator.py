@@ -0,0 +1,84 @@
+import json
+import os.path as op
+
+import pytest
+
+from click.testing import CliRunner
+from jsonschema import ValidationError
+
+from gearificator.cli import cli
+from gearificator.validator import (
+    Manifest,
+    find_manifests,
+    get_errors,
+    get_validator,
+    validate_manifest,
+)
+
+
+def _get_manifest(**kwargs):
+    manifest = {
+        'author': 'Some One',
+        'config': {},
+        'description': 'Does things',
+        'inputs': {},
+        'label': 'Thing',
+        'license': 'MIT',
+        'name': 'thing',
+        'source': 'https://example.com',
+        'url': 'https://example.com',
+        'version': '0.0.1',
+    }
+    manifest.update(kwargs)
+    return manifest
+
+
+def _save(path, manifest):
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+
+
+def test_get_validator():
+    assert get_validator(Manifest) is get_validator(Manifest)
+
+
+def test_validate_manifest(tmpdir):
+    validate_manifest(_get_manifest())
+    with pytest.raises(ValidationError):
+        validate_manifest(_get_manifest(name=1))
+
+    path = str(tmpdir.join('manifest.json'))
+    _save(path, _get_manifest())
+    validate_manifest(path)
+    assert get_errors(Manifest, path) == []
+
+
+def test_get_errors():
+    manifest = _get_manifest(name=1)
+    del manifest['label']
+    errors = get_errors(Manifest, manifest)
+    assert len(errors) == 2
+    assert "<top>: 'label' is a required property" in errors
+    assert "name: 1 is not of type 'string'" in errors
+
+
+def test_validate_cmd(tmpdir):
+    for name in ('good', 'bad', op.join('sub', 'bad'), '.hidden'):
+        tmpdir.ensure(name, dir=True)
+        _save(str(tmpdir.join(name, 'manifest.json')),
+              _get_manifest(**({} if name == 'good' else {'name': 1})))
+    assert sorted(find_manifests([str(tmpdir)])) == [
+        str(tmpdir.join(name, 'manifest.json'))
+        for name in ('bad', 'good', op.join('sub', 'bad'))
+    ]
+
+    runner = CliRunner()
+    for jobs in ('1', '2'):
+        result = runner.invoke(cli, ['validate', '-j', jobs, str(tmpdir)])
+        assert result.exit_code == 1
+        assert "2 out of 3 manifest(s) are invalid" in result.output
+        assert "name: 1 is not of type 'string'" in result.output
+
+    result = runner.invoke(
+        cli, ['validate', str(tmpdir.join('good', 'manifest.json'))])
+    assert result.exit_code == 0, result.output
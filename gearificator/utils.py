@@ -1,5 +1,9 @@
+import io
 import json
+import math
 import os
+import re
+import shutil
 from os.path import (
     basename,
     isabs,
@@ -8,6 +12,8 @@ from os.path import (
     join as opj,
 )
 import sys
+import threading
+import uuid
 
 from . import get_logger
 lgr = get_logger('utils')
@@ -65,14 +71,233 @@ class chpwd(object):
             self.__class__(self._prev_pwd, logsuffix="(coming back)")
 
 
+def get_cache_dir(*subdirs):
+    """Return (and create if needed) a directory for gearificator's caches
+
+    Could be overridden with GEARIFICATOR_CACHE_DIR environment variable,
+    otherwise it is under XDG_CACHE_HOME (~/.cache by default)
+    """
+    topdir = os.environ.get('GEARIFICATOR_CACHE_DIR')
+    if not topdir:
+        topdir = opj(
+            os.environ.get('XDG_CACHE_HOME') or opj(
+                os.path.expanduser('~'), '.cache'),
+            'gearificator')
+    path = opj(topdir, *subdirs)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
 def load_json(filename, must_exist=True):
     if not os.path.exists(filename):
         if not must_exist:
             return {}
         else:
             raise ValueError("File %s does not exist!" % filename)
-    with open(filename) as f:
-        return json.load(f, encoding='utf-8')
+    with io.open(filename, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dump_json(content):
+    """Serialize content into json the same way for all files we generate
+
+    Order of the keys is retained, so the result is deterministic as long
+    as content is constructed in the same order.
+    """
+    return json.dumps(content, indent=2, separators=(',', ': '))
+
+
+def write_if_changed(filename, content, mode=None):
+    """Atomically (re)write the file only if its content (or mode) changes
+
+    Unchanged files keep their mtime, so e.g. docker build cache and
+    syncs of the generated trees are not invalidated.
+
+    Parameters
+    ----------
+    filename: str
+    content: str or bytes
+      str is encoded into utf-8
+    mode: int, optional
+      Permissions for the file
+
+    Returns
+    -------
+    bool
+      True if the file was (re)written
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    if os.path.exists(filename):
+        if mode is None:
+            # keep whatever it had
+            mode = os.stat(filename).st_mode & 0o7777
+        try:
+            with open(filename, 'rb') as f:
+                unchanged = f.read() == content
+        except (IOError, OSError):
+            unchanged = False
+        if unchanged:
+            if mode is not None \
+                    and (os.stat(filename).st_mode & 0o7777) != mode:
+                os.chmod(filename, mode)
+            return False
+    # a temporary file within the same directory, so it could be just renamed.
+    # Not via mkstemp, which creates it accessible only to the user, while
+    # here the umask gets applied to it as to any newly created file
+    tempname = opj(dirname(filename) or os.curdir,
+                   '.%s.%s' % (basename(filename), uuid.uuid4().hex[:8]))
+    fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tempname, mode)
+        os.rename(tempname, filename)
+    except BaseException:
+        os.unlink(tempname)
+        raise
+    return True
+
+
+def get_cpu_count():
+    """Return the number of CPUs the process could use
+
+    Accounts for the CPU affinity and the CFS quota of the cgroup (e.g. as
+    set by docker run --cpus), so within a container it is not the number
+    of CPUs of the host
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        count = os.cpu_count() or 1
+    quota = _get_cgroup_cpu_quota()
+    if quota:
+        count = min(count, max(1, int(math.ceil(quota))))
+    return count
+
+
+def _get_cgroup_cpu_quota():
+    """Return CPU quota (in CPUs) of the cgroup, or None if not limited"""
+    content = _read_sys_file('/sys/fs/cgroup/cpu.max')
+    if content:
+        # cgroup v2: "$QUOTA $PERIOD", $QUOTA is "max" if not limited
+        quota, _, period = content.partition(' ')
+    else:
+        # cgroup v1: quota is -1 if not limited
+        quota = _read_sys_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_sys_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    try:
+        quota, period = float(quota), float(period)
+    except (TypeError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return quota / period
+
+
+def _read_sys_file(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+_SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """Parse size in bytes given as a number or as e.g. '512M', '4GiB', '2g'
+
+    Units are binary (1k = 1024).  None is returned as is
+    """
+    if size is None or isinstance(size, int):
+        return size
+    if isinstance(size, float):
+        return int(size)
+    m = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([kmgt]?)(i?b)?\s*$', size, re.I)
+    if not m:
+        raise ValueError("Cannot parse size %r" % size)
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2).lower()])
+
+
+def format_size(size):
+    """Format size in bytes for humans, e.g. 1536 -> '1.5K'"""
+    for unit in ('', 'K', 'M', 'G'):
+        if abs(size) < 1024:
+            break
+        size /= 1024.
+    else:
+        unit = 'T'
+    return ('%d%s' if unit == '' else '%.1f%s') % (size, unit or 'B')
+
+
+# Ways to stage (test input) files, in the order of preference for 'auto'
+STAGING_METHODS = ('hardlink', 'reflink', 'copy')
+# ioctl to clone a file (on btrfs, xfs, ...) on Linux
+_FICLONE = 0x40049409
+
+
+def stage_file(src, dst, method='auto'):
+    """Make src available as dst, without copying it if possible
+
+    Parameters
+    ----------
+    src: str
+      Symlinks (e.g. git-annex'ed files) get resolved
+    dst: str
+    method: {'auto', 'hardlink', 'reflink', 'symlink', 'copy'}, optional
+      'auto' tries to hardlink (works only within the same filesystem), then
+      to reflink (copy-on-write clone, where the filesystem supports it), and
+      copies as the last resort.  'symlink' creates a symlink to the
+      (resolved) src
+
+    Returns
+    -------
+    str
+      The method which was used
+    """
+    src = os.path.realpath(src)
+    if method == 'symlink':
+        os.symlink(src, dst)
+        return method
+    if method == 'auto':
+        methods = STAGING_METHODS
+    elif method in STAGING_METHODS:
+        methods = (method,)
+    else:
+        raise ValueError("Unknown staging method %r" % method)
+    for m in methods[:-1]:
+        try:
+            _stage_file(src, dst, m)
+            return m
+        except (IOError, OSError) as exc:
+            lgr.log(5, "Failed to %s %s to %s: %s", m, src, dst, exc)
+    _stage_file(src, dst, methods[-1])
+    return methods[-1]
+
+
+def _stage_file(src, dst, method):
+    if method == 'hardlink':
+        os.link(src, dst)
+    elif method == 'reflink':
+        _reflink(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        try:
+            with open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.unlink(dst)
+            raise
 
 
 #
@@ -197,7 +422,139 @@ class PathRoot(object):
             path = os.path.dirname(path)
 
 
-def md5sum(filename):
+# Size of the chunks files are read in while computing their digests
+DIGEST_CHUNK_SIZE = 1024 * 1024
+DEFAULT_DIGEST = 'blake2b'
+
+
+def file_digest(filename, algorithm=DEFAULT_DIGEST):
+    """Return hexdigest of the file content, reading it in chunks
+
+    Parameters
+    ----------
+    filename: str
+    algorithm: str, optional
+      Any algorithm known to hashlib
+    """
     import hashlib
+    digest = hashlib.new(algorithm)
     with open(filename, 'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def md5sum(filename):
+    return file_digest(filename, 'md5')
+
+
+class JsonStore(object):
+    """Persistent store of json records shared among processes
+
+    Records are loaded on the first access, and only the ones set within
+    this process get saved, merged with the ones other processes could have
+    saved meanwhile.  Stores of other VERSION are ignored.
+
+    Subclasses define VERSION, KEY to store the records under in the file,
+    and NAME to refer to the store in the messages.
+
+    Parameters
+    ----------
+    path: str
+      File to store the records in
+    """
+
+    VERSION = 1
+    KEY = 'records'
+    NAME = 'store'
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = None
+        self._changed = {}
+
+    def _load(self):
+        try:
+            rec = load_json(self.path, must_exist=False)
+        except ValueError as exc:
+            lgr.warning("Ignoring corrupted %s %s: %s",
+                        self.NAME, self.path, exc)
+            rec = {}
+        if rec.get('version') != self.VERSION:
+            return {}
+        return rec.get(self.KEY, {})
+
+    def _get(self, key):
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+            return self._records.get(key)
+
+    def _set(self, key, rec):
+        with self._lock:
+            if self._records is None:
+                self._records = self._load()
+            self._records[key] = self._changed[key] = rec
+
+    def save(self):
+        """Save new records, merging them with others' changes"""
+        with self._lock:
+            if not self._changed:
+                return
+            # other processes could have saved their records meanwhile
+            records = self._load()
+            records.update(self._changed)
+            write_if_changed(
+                self.path,
+                json.dumps({'version': self.VERSION, self.KEY: records}))
+            self._changed = {}
+
+
+class DigestCache(JsonStore):
+    """Persistent cache of file digests
+
+    A digest is reused as long as the (resolved) path of the file has the same
+    size, mtime and inode as it had when the digest was computed.  Intended
+    for files which do not change often, such as target outputs of the tests.
+
+    Parameters
+    ----------
+    path: str, optional
+      File to store the cache in.  By default digests.json within the
+      cache directory
+    """
+
+    VERSION = 1
+    KEY = 'digests'
+    NAME = 'digests cache'
+
+    def __init__(self, path=None):
+        super(DigestCache, self).__init__(
+            path or opj(get_cache_dir(), 'digests.json'))
+
+    def digest(self, filename, algorithm=DEFAULT_DIGEST):
+        """Return digest of the file, computing it only if not known"""
+        path = os.path.realpath(filename)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        key = '%s:%s' % (algorithm, path)
+        rec = self._get(key)
+        if rec and rec[:3] == stamp:
+            return rec[3]
+        digest = file_digest(path, algorithm)
+        self._set(key, stamp + [digest])
+        return digest
+
+
+_digest_cache = None
+_digest_cache_lock = threading.Lock()
+
+
+def get_digest_cache():
+    """Return the DigestCache for the process"""
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is None:
+            _digest_cache = DigestCache()
+        return _digest_cache
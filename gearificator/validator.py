@@ -1,9 +1,17 @@
 """Utilities for validation of the generated files etc"""
+import click
+import multiprocessing
+import os
+
 from os.path import (
     join as opj, pardir, dirname
 )
+
+from six import string_types
+
 import gearificator
 import gearificator.borrowed
+from gearificator.consts import GEAR_MANIFEST_FILENAME
 from gearificator.utils import load_json
 
 # TODO: just refactor into classes
@@ -15,16 +23,116 @@ class Manifest(object):
     schema = opj(dirname(gearificator.borrowed.__file__), 'manifest.schema.json')
 
 
-def validate(cls, path):
-    if cls.type == 'json':
+# compiled validators, per class
+_validators = {}
+
+
+def get_validator(cls):
+    """Return the validator for the cls schema, which gets built only once"""
+    if cls not in _validators:
+        if cls.type != 'json':
+            raise ValueError("nothing else ATM")
         import jsonschema
         schema = load_json(cls.schema, must_exist=True)
-        content = load_json(path, must_exist=True)
-        jsonschema.validate(content, schema)  # will throw exceptions if smth is not rightr
-    else:
-        raise ValueError("nothing else ATM")
+        validator_cls = jsonschema.validators.validator_for(schema)
+        validator_cls.check_schema(schema)
+        _validators[cls] = validator_cls(schema)
+    return _validators[cls]
+
+
+def validate(cls, path):
+    """Validate the file (or already loaded content) against cls schema
+
+    Will throw exceptions if smth is not right
+    """
+    get_validator(cls).validate(_get_content(path))
+
+
+def get_errors(cls, path):
+    """Return a list of all validation errors, as str's, for the file"""
+    try:
+        content = _get_content(path)
+    except Exception as exc:
+        return ["failed to load: %s" % exc]
+    return [
+        "%s: %s" % ('/'.join(map(str, e.absolute_path)) or '<top>', e.message)
+        for e in sorted(get_validator(cls).iter_errors(content),
+                        key=lambda e: list(map(str, e.absolute_path)))
+    ]
+
+
+def _get_content(path):
+    if isinstance(path, string_types):
+        return load_json(path, must_exist=True)
+    return path
 
 
 def validate_manifest(path):
     """Validate gears manifest.json"""
-    validate(Manifest, path)
\ No newline at end of file
+    validate(Manifest, path)
+
+
+def find_manifests(paths):
+    """Yield paths to all gears manifests under the paths (files or dirs)"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dnames, fnames in os.walk(path):
+            # no need to go into hidden (e.g. .git) directories
+            dnames[:] = sorted(d for d in dnames if not d.startswith('.'))
+            if GEAR_MANIFEST_FILENAME in fnames:
+                yield opj(root, GEAR_MANIFEST_FILENAME)
+
+
+def _get_manifest_errors(path):
+    return path, get_errors(Manifest, path)
+
+
+def validate_manifests(paths, jobs=1):
+    """Validate all the manifests under paths, possibly in parallel
+
+    Returns
+    -------
+    dict
+      path -> list of errors, for all validated manifests
+    """
+    manifests = list(find_manifests(paths))
+    # build it before workers get forked so they all get it
+    get_validator(Manifest)
+    if jobs > 1 and len(manifests) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(manifests)))
+        try:
+            return dict(pool.imap_unordered(
+                _get_manifest_errors, manifests, chunksize=16))
+        finally:
+            pool.close()
+            pool.join()
+    return dict(map(_get_manifest_errors, manifests))
+
+
+# CLI
+
+from .cli_base import cli
+
+
+@cli.command('validate')
+@click.option('-j', '--jobs', type=click.IntRange(1), default=1,
+              help='Number of processes to validate with')
+@click.argument('paths', nargs=-1, required=True)
+def validate_cmd(paths, jobs):
+    """Validate all gears manifests under the PATHS
+
+    All errors are reported at once
+    """
+    results = validate_manifests(paths, jobs=jobs)
+    invalid = sorted(path for path, errors in results.items() if errors)
+    for path in invalid:
+        click.echo("%s:" % path)
+        for error in results[path]:
+            click.echo("  %s" % error)
+    if invalid:
+        raise click.ClickException(
+            "%d out of %d manifest(s) are invalid"
+            % (len(invalid), len(results)))
+    click.echo("All %d manifest(s) are valid" % len(results))